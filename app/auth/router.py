@@ -2,8 +2,9 @@ from sqlite3 import IntegrityError
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from app.db.database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.database import get_async_db
 from app.auth import models, utils
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
@@ -33,8 +34,8 @@ def generate_unique_invite_code():
 
 
 @router.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = utils.authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = await utils.authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -50,28 +51,32 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 
 @router.post("/register")
-async def register_user(username: str, password: str, invite_code: str, db: Session = Depends(get_db)):
-    organization = db.query(models.Organization).filter(models.Organization.invite_code == invite_code).first()
+async def register_user(username: str, password: str, invite_code: str, db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(select(models.Organization).filter(models.Organization.invite_code == invite_code))
+    organization = result.scalars().first()
     if not organization:
         raise HTTPException(status_code=400, detail="Invalid invite code")
 
-    existing_user = db.query(models.User).filter(models.User.username == username).first()
+    result = await db.execute(select(models.User).filter(models.User.username == username))
+    existing_user = result.scalars().first()
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
+    # Hand the connection back while the password is hashed
+    await db.commit()
 
-    hashed_password = utils.get_password_hash(password)
+    hashed_password = await utils.password_hasher.hash(password)
     new_user = models.User(username=username, hashed_password=hashed_password, organization_id=organization.id)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
     return {"message": "User registered successfully"}
 
 
 
 @router.post("/create_organization/")
-def create_organization(name: str, db: Session = Depends(get_db)):
+async def create_organization(name: str, db: AsyncSession = Depends(get_async_db)):
     # Check if the organization name already exists
-    existing_org = db.query(models.Organization).filter(models.Organization.name == name).first()
+    result = await db.execute(select(models.Organization).filter(models.Organization.name == name))
+    existing_org = result.scalars().first()
     if existing_org:
         raise HTTPException(status_code=400, detail="Organization with this name already exists")
 
@@ -79,8 +84,7 @@ def create_organization(name: str, db: Session = Depends(get_db)):
     invite_code = generate_unique_invite_code()
     new_org = models.Organization(name=name, invite_code=invite_code)
     db.add(new_org)
-    db.commit()
-    db.refresh(new_org)
+    await db.commit()
     return {"message": "Organization created successfully", "invite_code": invite_code}
 
 
@@ -1,6 +1,16 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
 from passlib.context import CryptContext
-from jose import jwt
+from sqlalchemy import select
+from jose import JWTError, jwt
 from datetime import datetime, timedelta
+from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from app.auth import models
 
@@ -13,17 +23,65 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = "your-secret-key"
 ALGORITHM = "HS256"
 
+# Threads that run bcrypt; each hash keeps one busy for 100-300 ms
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 4))
+if PASSWORD_HASH_WORKERS < 1:
+    raise ValueError(f"PASSWORD_HASH_WORKERS must be at least 1, got {PASSWORD_HASH_WORKERS}")
+# Verified tokens remembered so repeat callers skip the signature check and JSON parsing
+AUTH_CLAIMS_CACHE_SIZE = int(os.getenv('AUTH_CLAIMS_CACHE_SIZE', 4096))
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-def authenticate_user(db, username: str, password: str):
-    user = db.query(models.User).filter(models.User.username == username).first()
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded thread pool instead of the event loop.
+
+    The bcrypt package (see requirements.txt) releases the GIL while hashing,
+    so the pool gives real parallelism while other requests keep being served. Calls beyond the pool size wait in
+    the executor's queue; stats() reports how many are running and waiting.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS):
+        self.workers = workers
+        self.in_flight = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+
+    async def _run(self, fn, *args):
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+
+    async def verify(self, plain_password, hashed_password) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password) -> str:
+        return await self._run(get_password_hash, password)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "busy": min(self.in_flight, self.workers),
+            "waiting": max(self.in_flight - self.workers, 0),
+            "saturation": self.in_flight / self.workers,
+        }
+
+
+password_hasher = PasswordHasher()
+
+async def authenticate_user(db, username: str, password: str):
+    result = await db.execute(select(models.User).filter(models.User.username == username))
+    user = result.scalars().first()
+    # End the read so the connection goes back to the pool for the length of the hash
+    await db.commit()
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await password_hasher.verify(password, user.hashed_password):
         return False
     return user
 
@@ -39,3 +97,74 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
 
 def generate_invite_code():
     return secrets.token_urlsafe(16)
+
+
+@dataclass(frozen=True)
+class Principal:
+    username: Optional[str]
+    organization_id: int
+
+
+class ClaimsCache:
+    """Bounded LRU of verified token claims.
+
+    Entries are keyed by the raw token and dropped once the token's exp has
+    passed, so a cached token is never accepted for longer than jwt.decode
+    would accept it. Tokens without exp are not cached.
+    """
+
+    def __init__(self, max_size: int = AUTH_CLAIMS_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[dict, float]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token: str) -> Optional[dict]:
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        claims, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[token]
+            return None
+        self._entries.move_to_end(token)
+        return claims
+
+    def put(self, token: str, claims: dict):
+        if self.max_size <= 0 or claims.get("exp") is None:
+            return
+        self._entries[token] = (claims, float(claims["exp"]))
+        self._entries.move_to_end(token)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+claims_cache = ClaimsCache()
+
+
+def decode_token(token: str) -> dict:
+    claims = claims_cache.get(token)
+    if claims is None:
+        try:
+            claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid token",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        claims_cache.put(token, claims)
+    return claims
+
+
+async def current_principal(token: str = Depends(oauth2_scheme)) -> Principal:
+    """The caller behind the bearer token; every scoped endpoint depends on this."""
+    claims = decode_token(token)
+    organization_id = claims.get("organization_id")
+    if organization_id is None:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Token is not bound to an organization")
+    return Principal(username=claims.get("sub"), organization_id=int(organization_id))
@@ -7,7 +7,7 @@ class Cluster(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
-    organization_id = Column(Integer, ForeignKey("organizations.id"))
+    organization_id = Column(Integer, ForeignKey("organizations.id"), index=True)
     total_ram = Column(Integer)
     total_cpu = Column(Integer)
     total_gpu = Column(Integer)
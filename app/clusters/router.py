@@ -1,35 +1,54 @@
-from fastapi import APIRouter, Depends, HTTPException
-from jose import jwt, JWTError
-from sqlalchemy.orm import Session
-from app.db.database import get_db
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.database import get_async_db
+from app.db.pagination import LIST_MAX_PAGE_SIZE, LIST_PAGE_SIZE, columns, fetch_page, keyset, stream_ndjson
+from app.db.versions import conditional_page, versions
 from app.clusters import models
-from app.auth.utils import oauth2_scheme
-from pydantic import BaseModel
+from app.auth.utils import Principal, current_principal
+from app.scheduler import capacity, simulator
+from app.scheduler.engine import scheduler_engine
+from pydantic import BaseModel, Field
 
 router = APIRouter()
 
-SECRET_KEY = "your-secret-key"
-ALGORITHM = "HS256"
-
 class ClusterCreate(BaseModel):
     name: str
     total_ram: int
     total_cpu: int
     total_gpu: int
 
+class ClusterOut(BaseModel):
+    id: int
+    name: Optional[str]
+    organization_id: Optional[int]
+    total_ram: Optional[int]
+    total_cpu: Optional[int]
+    total_gpu: Optional[int]
+    available_ram: Optional[int]
+    available_cpu: Optional[int]
+    available_gpu: Optional[int]
+
+class SimulationRequest(BaseModel):
+    # Hypothetical cluster sizes; omitted resources keep their current size
+    total_ram: Optional[int] = None
+    total_cpu: Optional[int] = None
+    total_gpu: Optional[int] = None
+    # Deployment id -> hypothetical priority
+    priorities: Dict[int, int] = {}
+    # Defaults to the scheduler's SCHEDULER_PREEMPTION
+    preemption: Optional[bool] = None
+    # Priority levels gained per minute queued; defaults to SCHEDULER_PRIORITY_AGING
+    aging: Optional[float] = Field(None, ge=0)
 
-def retrive_organization_id(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        organization_id = payload.get("organization_id")
-        return organization_id
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
 @router.post("/create")
-async def create_cluster(cluster: ClusterCreate, db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    # get the user's organization from the token
-    org = retrive_organization_id(token)
-    organization_id = int(org) if org else 1
+async def create_cluster(cluster: ClusterCreate, db: AsyncSession = Depends(get_async_db),
+                         principal: Principal = Depends(current_principal)):
+    # the cluster belongs to the caller's organization
+    organization_id = principal.organization_id
 
     new_cluster = models.Cluster(
         name=cluster.name,
@@ -42,14 +61,63 @@ async def create_cluster(cluster: ClusterCreate, db: Session = Depends(get_db),
         available_gpu=cluster.total_gpu
     )
     db.add(new_cluster)
-    db.commit()
-    db.refresh(new_cluster)
+    await db.commit()
+    versions.bump(organization_id=organization_id)
+    scheduler_engine.add_cluster(new_cluster)
 
     return {"message": "Cluster created successfully", "cluster_id": new_cluster.id , "organization_id": organization_id}
 
-@router.get("/list")
-async def list_clusters(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    org = retrive_organization_id(token)
-    organization_id = int(org) if org else 1
-    clusters = db.query(models.Cluster).filter(models.Cluster.organization_id == organization_id).all()
-    return clusters
+@router.get("/list", response_model=List[ClusterOut])
+async def list_clusters(request: Request, cursor: Optional[int] = None,
+                        limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_MAX_PAGE_SIZE), stream: bool = False,
+                        db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(current_principal)):
+    # Pass the X-Next-Cursor header back as cursor for the next page; stream=true returns every row as NDJSON.
+    # Pages carry an ETag; until a cluster is added or its capacity changes they come from memory, or 304.
+    etag = versions.organization(principal.organization_id)
+    statement = keyset(select(*columns(models.Cluster, ClusterOut)).filter(
+        models.Cluster.organization_id == principal.organization_id
+    ), models.Cluster.id, cursor)
+    if stream:
+        return await stream_ndjson(db, statement, models.Cluster.id, ClusterOut)
+    return await conditional_page(request, principal.organization_id, etag,
+                                  lambda page: fetch_page(db, statement, ClusterOut, limit, page))
+
+@router.get("/summary")
+async def cluster_summary(per_cluster: bool = True, db: AsyncSession = Depends(get_async_db),
+                          principal: Principal = Depends(current_principal)):
+    """Totals, allocated, free and queued demand for the organization and each of its clusters.
+
+    Served from the scheduler's in-memory aggregates, which change with every
+    allocation and release, so polling it does not touch the database once
+    the organization's clusters are loaded. Clusters owned by other scheduler
+    workers are at most SCHEDULER_REMOTE_REFRESH seconds old.
+    """
+    index = await db.run_sync(scheduler_engine.organization, principal.organization_id)
+    totals = index.totals if index is not None else capacity.CapacityTotals()
+    summary = {"organization_id": principal.organization_id, **totals.describe()}
+    if per_cluster:
+        clusters = sorted(index.clusters.items()) if index is not None else []
+        summary["per_cluster"] = [
+            {"cluster_id": cluster_id, "name": queue.name, **capacity.describe(capacity.snapshot(queue))}
+            for cluster_id, queue in clusters
+        ]
+    return summary
+
+@router.post("/{cluster_id}/simulate")
+async def simulate_cluster(cluster_id: int, changes: SimulationRequest, db: AsyncSession = Depends(get_async_db),
+                           principal: Principal = Depends(current_principal)):
+    """Which queued deployments would start, and the resulting utilization, after the given changes.
+
+    Replays the scheduler's admission rules on a copy of the cluster's queued
+    and running deployments; nothing is changed.
+    """
+    cluster = await db.get(models.Cluster, cluster_id)
+    if not cluster or cluster.organization_id != principal.organization_id:
+        raise HTTPException(status_code=404, detail="Cluster not found")
+    snapshot = await db.run_sync(simulator.load_snapshot, cluster_id)
+    snapshot = simulator.with_changes(snapshot, (changes.total_ram, changes.total_cpu, changes.total_gpu),
+                                      changes.priorities)
+    preemption = simulator.SCHEDULER_PREEMPTION if changes.preemption is None else changes.preemption
+    aging = simulator.SCHEDULER_PRIORITY_AGING if changes.aging is None else changes.aging
+    # Large backlogs take milliseconds of NumPy work; keep it off the event loop
+    return await run_in_threadpool(simulator.simulate, snapshot, preemption, aging)
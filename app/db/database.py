@@ -1,18 +1,113 @@
-from sqlalchemy import create_engine
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from contextlib import contextmanager
+from time import perf_counter
 import os
 from dotenv import load_dotenv
 
+from app.metrics.registry import DB_QUERY_DURATION
+
 # Load environment variables from .env file
 load_dotenv()
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sql_app.db")
+# Connections kept open by the async engine, and how many more it may open under bursts
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+# Milliseconds a SQLite connection waits for a writer's lock before failing
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+# Seconds a client is told to wait when the database stayed locked past that
+DB_BUSY_RETRY_AFTER = int(os.getenv("DB_BUSY_RETRY_AFTER", 1))
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def async_database_url(url: str) -> str:
+    """The same database addressed through its asyncio driver."""
+    url = make_url(url)
+    if url.drivername not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver known for {url.drivername!r}, expected one of {sorted(ASYNC_DRIVERS)}")
+    return str(url.set(drivername=ASYNC_DRIVERS[url.drivername]))
+
+
+def _is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def _is_sqlite_file(url: str) -> bool:
+    return _is_sqlite(url) and make_url(url).database not in (None, "", ":memory:")
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run while the scheduler commits; NORMAL sync is durable
+    # across application crashes and only fsyncs at checkpoints
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-16000")
+    cursor.close()
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = perf_counter()
+
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("query_started", None)
+    if started is not None:
+        DB_QUERY_DURATION.observe(perf_counter() - started)
+
+
+def time_queries(sync_engine):
+    """Record every statement the engine executes in DB_QUERY_DURATION."""
+    event.listen(sync_engine, "before_cursor_execute", _query_started)
+    event.listen(sync_engine, "after_cursor_execute", _query_finished)
+
+
+def create_async_db_engine(url: str = SQLALCHEMY_DATABASE_URL, **kwargs):
+    options = {}
+    if _is_sqlite_file(url):
+        # aiosqlite defaults to opening a connection per checkout; pool them instead
+        options.update(poolclass=AsyncAdaptedQueuePool, connect_args={"check_same_thread": False})
+    if not _is_sqlite(url) or _is_sqlite_file(url):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    if "poolclass" in kwargs:
+        # NullPool and the like take none of the sizing options
+        for option in ("pool_size", "max_overflow", "pool_timeout"):
+            options.pop(option, None)
+    options.update(kwargs)
+    async_engine = create_async_engine(async_database_url(url), **options)
+    if _is_sqlite_file(url):
+        event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+    time_queries(async_engine.sync_engine)
+    return async_engine
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL,
+                       connect_args={"check_same_thread": False} if _is_sqlite(SQLALCHEMY_DATABASE_URL) else {})
+if _is_sqlite_file(SQLALCHEMY_DATABASE_URL):
+    event.listen(engine, "connect", set_sqlite_pragmas)
+time_queries(engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_db_engine()
+# Objects stay usable after commit: reloading them would need another awaited query
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 # Create a Base class for declarative models
 Base = declarative_base()
 
@@ -24,6 +119,43 @@ def get_db():
     finally:
         db.close()
 
+
+async def get_async_db():
+    """Async session for request handlers, so queries never block the event loop.
+
+    Code written against a synchronous Session (the scheduler engine, for
+    instance) runs through ``await db.run_sync(fn, ...)`` on the same session.
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def database_locked(request: Request, exc: OperationalError):
+    """503 with Retry-After for a write that another process held SQLite's lock through; other errors stay 500s."""
+    if "database is locked" not in str(exc.orig):
+        raise exc
+    return JSONResponse(status_code=503, content={"detail": "Database is busy, retry shortly"},
+                        headers={"Retry-After": str(DB_BUSY_RETRY_AFTER)})
+
+
 def init_db():
-    """Initialize the database by creating all tables."""
+    """Initialize the database by creating all tables and applying pending migrations."""
+    # Every model has to be imported for create_all to know its table
+    from app.auth import models as auth_models  # noqa: F401
+    from app.clusters import models as cluster_models  # noqa: F401
+    from app.db.migrations import migrate
+    from app.deployments import models as deployment_models  # noqa: F401
+    from app.scheduler import models as scheduler_models  # noqa: F401
+
     Base.metadata.create_all(bind=engine)
+    migrate(engine)
+
+
+_schema_ready = False
+
+
+def ensure_schema():
+    """init_db(), once per process."""
+    global _schema_ready
+    if not _schema_ready:
+        init_db()
+        _schema_ready = True
@@ -0,0 +1,77 @@
+from datetime import datetime
+from typing import Callable, List, Tuple, Union
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+# create_all only creates missing tables, so changes to tables that already
+# exist (new indexes, new columns) are listed here. Each entry runs once, in
+# version order, and is recorded in schema_migrations. Models declare the same
+# objects so fresh databases get them from create_all; statements must
+# therefore tolerate objects that already exist. A step is SQL text, or a
+# callable taking the connection when that needs checking first.
+Step = Union[str, Callable[[Connection], None]]
+
+
+def add_column(table: str, column: str, ddl: str) -> Callable[[Connection], None]:
+    """ALTER TABLE ... ADD COLUMN, skipped if create_all already made the column."""
+    def apply(connection: Connection):
+        if column not in {c["name"] for c in inspect(connection).get_columns(table)}:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return apply
+
+
+MIGRATIONS: List[Tuple[int, str, List[Step]]] = [
+    (1, "scheduler hot query indexes", [
+        "CREATE INDEX IF NOT EXISTS ix_deployments_cluster_status_priority "
+        "ON deployments (cluster_id, status, priority)",
+        "CREATE INDEX IF NOT EXISTS ix_clusters_organization_id ON clusters (organization_id)",
+    ]),
+    (2, "deployment trace ids", [
+        add_column("deployments", "trace_id", "VARCHAR(64)"),
+    ]),
+    (3, "deployment groups", [
+        add_column("deployments", "group_id", "VARCHAR(64)"),
+        "CREATE INDEX IF NOT EXISTS ix_deployments_group_id ON deployments (group_id)",
+    ]),
+    (4, "priority aging", [
+        add_column("deployments", "queued_since", "FLOAT"),
+    ]),
+]
+
+
+def applied_versions(engine: Engine) -> List[int]:
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at DATETIME NOT NULL)"
+        ))
+        return [version for (version,) in connection.execute(text("SELECT version FROM schema_migrations"))]
+
+
+def migrate(engine: Engine) -> List[int]:
+    """Apply pending migrations, each in its own transaction; returns the versions applied."""
+    applied = set(applied_versions(engine))
+    newly_applied = []
+    for version, name, statements in sorted(MIGRATIONS):
+        if version in applied:
+            continue
+        try:
+            with engine.begin() as connection:
+                for statement in statements:
+                    if callable(statement):
+                        statement(connection)
+                    else:
+                        connection.execute(text(statement))
+                connection.execute(
+                    text("INSERT INTO schema_migrations (version, name, applied_at) "
+                         "VALUES (:version, :name, :applied_at)"),
+                    {"version": version, "name": name, "applied_at": datetime.utcnow()}
+                )
+        except IntegrityError:
+            # Another process starting at the same time applied it first
+            continue
+        print(f"Applied migration {version}: {name}")
+        newly_applied.append(version)
+    return newly_applied
@@ -0,0 +1,68 @@
+import os
+from typing import AsyncIterator, Optional, Type
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Rows per page when the caller does not pass limit, and the most it may ask for
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', 100))
+LIST_MAX_PAGE_SIZE = int(os.getenv('LIST_MAX_PAGE_SIZE', 1000))
+# Rows read per query, each in its own short session, while streaming
+LIST_STREAM_BATCH = int(os.getenv('LIST_STREAM_BATCH', 500))
+if not 1 <= LIST_PAGE_SIZE <= LIST_MAX_PAGE_SIZE:
+    raise ValueError(f"LIST_PAGE_SIZE must be between 1 and LIST_MAX_PAGE_SIZE ({LIST_MAX_PAGE_SIZE}), "
+                     f"got {LIST_PAGE_SIZE}")
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def columns(entity, model: Type[BaseModel]) -> list:
+    """The entity's columns named by the model's fields, so only those are loaded."""
+    return [getattr(entity, field) for field in model.__fields__]
+
+
+def keyset(statement, key, cursor: Optional[int]):
+    """Order by key and continue after cursor, the key of the last row already seen.
+
+    Unlike OFFSET this costs the same on the last page as on the first.
+    """
+    if cursor is not None:
+        statement = statement.filter(key > cursor)
+    return statement.order_by(key)
+
+
+async def fetch_page(db: AsyncSession, statement, model: Type[BaseModel], limit: int, response: Response):
+    """One page of rows as model instances; the cursor for the next page goes in a header."""
+    rows = (await db.execute(statement.limit(limit + 1))).all()
+    items = [model(**row._mapping) for row in rows[:limit]]
+    if len(rows) > limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(items[-1].id)
+    return items
+
+
+async def stream_ndjson(db: AsyncSession, statement, key, model: Type[BaseModel]) -> StreamingResponse:
+    """Every row of a keyset() statement as newline-delimited JSON.
+
+    Rows are read LIST_STREAM_BATCH at a time, each batch in its own short
+    session continuing after the last key sent, so no connection is held
+    while a slow client reads. The request's session is closed here for the
+    same reason.
+    """
+    bind = db.bind
+    await db.close()
+
+    async def lines() -> AsyncIterator[str]:
+        last = None
+        while True:
+            batch = statement if last is None else statement.filter(key > last)
+            async with AsyncSession(bind) as session:
+                rows = (await session.execute(batch.limit(LIST_STREAM_BATCH))).all()
+            if rows:
+                yield "".join(model(**row._mapping).json() + "\n" for row in rows)
+            if len(rows) < LIST_STREAM_BATCH:
+                return
+            last = getattr(rows[-1], key.key)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
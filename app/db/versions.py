@@ -0,0 +1,152 @@
+"""Version counters for list endpoints, their ETags, and a cache of the pages they serve.
+
+Writes bump the version of the organization or cluster they change after
+committing. A list page is cached with the ETag of the version it was read
+at, so a repeated request for an unchanged list is answered from memory, or
+with 304 if the client sent that ETag in If-None-Match, without a query or
+any JSON encoding. A page is only cached after its request was authorized,
+and cache keys include the organization, so a hit is always one the caller
+was allowed to read.
+
+Counters only see writes made by this process. When other processes write
+too (several API workers, or scheduler workers), versions also change every
+RESPONSE_CACHE_REFRESH seconds, which bounds how stale a page can be.
+"""
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import Request, Response
+from pydantic import BaseModel
+
+from app.db.pagination import NEXT_CURSOR_HEADER
+from app.metrics.registry import RESPONSE_CACHE_REQUESTS
+
+# List pages kept in memory, least recently used dropped first
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+# Seconds a page can be served while other processes may have changed it
+RESPONSE_CACHE_REFRESH = float(os.getenv('RESPONSE_CACHE_REFRESH', 1.0))
+if RESPONSE_CACHE_REFRESH <= 0:
+    raise ValueError(f"RESPONSE_CACHE_REFRESH must be positive, got {RESPONSE_CACHE_REFRESH}")
+
+# Set at startup when other processes write to the same database
+shared = False
+
+# Counters restart at zero with the process; ETags handed out before must not match again
+_BOOT = uuid.uuid4().hex[:8]
+
+_hits = RESPONSE_CACHE_REQUESTS.labels("hit")
+_misses = RESPONSE_CACHE_REQUESTS.labels("miss")
+
+
+class Versions:
+    def __init__(self):
+        self._organizations: Dict[int, int] = {}
+        self._clusters: Dict[int, int] = {}
+
+    def bump(self, organization_id: Optional[int] = None, cluster_id: Optional[int] = None):
+        """Call after committing a change to an organization's clusters or to a cluster's deployments."""
+        if organization_id is not None:
+            self._organizations[organization_id] = self._organizations.get(organization_id, 0) + 1
+        if cluster_id is not None:
+            self._clusters[cluster_id] = self._clusters.get(cluster_id, 0) + 1
+
+    def organization(self, organization_id: int) -> str:
+        """ETag of the organization's cluster list."""
+        return _etag(f"o{organization_id}", self._organizations.get(organization_id, 0))
+
+    def cluster(self, cluster_id: int) -> str:
+        """ETag of the cluster's deployment list."""
+        return _etag(f"c{cluster_id}", self._clusters.get(cluster_id, 0))
+
+    def clear(self):
+        self._organizations.clear()
+        self._clusters.clear()
+
+
+def _etag(scope: str, version: int) -> str:
+    if shared:
+        return f'"{_BOOT}-{scope}-{version}-{int(time.time() // RESPONSE_CACHE_REFRESH)}"'
+    return f'"{_BOOT}-{scope}-{version}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # The body is the same for equal ETags, so a weak comparison is enough
+    return any(tag.strip()[2:] == etag if tag.strip().startswith("W/") else tag.strip() == etag
+               for tag in if_none_match.split(","))
+
+
+@dataclass
+class CachedPage:
+    etag: str
+    body: bytes
+    headers: Dict[str, str]
+
+
+class ResponseCache:
+    """Bounded LRU of encoded list pages, one per organization and URL.
+
+    An entry is only served while its ETag is current; a newer page for the
+    same URL replaces it.
+    """
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple, CachedPage]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple, etag: str) -> Optional[CachedPage]:
+        entry = self._entries.get(key)
+        if entry is None or entry.etag != etag:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, entry: CachedPage):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+versions = Versions()
+response_cache = ResponseCache()
+
+
+async def conditional_page(request: Request, organization_id: int, etag: str,
+                           load: Callable[[Response], Awaitable[List[BaseModel]]]) -> Response:
+    """A list page served from the cache while etag is current, or 304 if the client has it.
+
+    load reads the page (and raises for callers that may not see it), as
+    fetch_page does, setting the next cursor on the response it is given.
+    """
+    key = (organization_id, request.url.path, tuple(sorted(request.query_params.multi_items())))
+    entry = response_cache.get(key, etag)
+    if entry is not None:
+        _hits.inc()
+    else:
+        _misses.inc()
+        page = Response()
+        items = await load(page)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if page.headers.get(NEXT_CURSOR_HEADER) is not None:
+            headers[NEXT_CURSOR_HEADER] = page.headers[NEXT_CURSOR_HEADER]
+        entry = CachedPage(etag, ("[" + ",".join(item.json() for item in items) + "]").encode(), headers)
+        response_cache.put(key, entry)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=entry.headers)
+    return Response(entry.body, media_type="application/json", headers=entry.headers)
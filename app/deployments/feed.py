@@ -0,0 +1,253 @@
+"""Deployment status changes pushed to subscribers as Server-Sent Events.
+
+Every status change writes a deployment_events row in the transaction that
+makes it, in whichever process makes it. One task per process tails that
+table and fans the new rows out to the streams connected to the process, so
+any number of watching clients costs one query per poll rather than one list
+request each. Code that commits a status change wakes the task, so changes
+made in this process go out at once; those made by other processes (the
+scheduler's leader) arrive within STATUS_FEED_POLL seconds.
+
+Event ids are deployment_events ids. A client reconnecting with Last-Event-ID,
+or a stream that fell more than STATUS_FEED_BUFFER events behind, catches up
+from the table instead of from memory.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from itertools import chain
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func, or_, select
+
+from app.db.database import AsyncSessionLocal
+from app.deployments.models import DeploymentEvent, DeploymentStage
+
+# Events a stream may have waiting to be sent; beyond that it is caught up from the database
+STATUS_FEED_BUFFER = int(os.getenv('STATUS_FEED_BUFFER', 256))
+# Seconds between reads of changes made by other processes
+STATUS_FEED_POLL = float(os.getenv('STATUS_FEED_POLL', 0.5))
+# Events replayed to a resuming stream before it is told to re-list instead
+STATUS_FEED_REPLAY_LIMIT = int(os.getenv('STATUS_FEED_REPLAY_LIMIT', 1000))
+# Seconds of silence before a comment is sent to keep proxies from closing the stream
+STATUS_FEED_KEEPALIVE = float(os.getenv('STATUS_FEED_KEEPALIVE', 15))
+for _name, _value in (("STATUS_FEED_BUFFER", STATUS_FEED_BUFFER), ("STATUS_FEED_POLL", STATUS_FEED_POLL),
+                      ("STATUS_FEED_REPLAY_LIMIT", STATUS_FEED_REPLAY_LIMIT),
+                      ("STATUS_FEED_KEEPALIVE", STATUS_FEED_KEEPALIVE)):
+    if _value <= 0:
+        raise ValueError(f"{_name} must be positive, got {_value}")
+
+# Milliseconds a disconnected EventSource waits before reconnecting
+RECONNECT_DELAY_MS = 1000
+# Seconds an id skipped by the tail is watched for, in case its transaction commits after a newer one
+GAP_GRACE = 5.0
+
+# Stages that change a deployment's status, and the status they change it to.
+# FINISHED events carry the final status as their reason.
+STATUS_STAGES: Dict[DeploymentStage, Optional[str]] = {
+    DeploymentStage.SUBMITTED: "queued",
+    DeploymentStage.ADMITTED: "running",
+    DeploymentStage.PREEMPTED: "queued",
+    DeploymentStage.FINISHED: None,
+}
+
+COLUMNS = (DeploymentEvent.id, DeploymentEvent.deployment_id, DeploymentEvent.cluster_id, DeploymentEvent.stage,
+           DeploymentEvent.at, DeploymentEvent.reason)
+
+
+def frame(row) -> Optional[str]:
+    """The SSE message for a deployment_events row, or None if it is not a status change."""
+    stage = DeploymentStage(row.stage)
+    if stage not in STATUS_STAGES:
+        return None
+    data = json.dumps({"deployment_id": row.deployment_id, "cluster_id": row.cluster_id,
+                       "status": STATUS_STAGES[stage] or row.reason, "stage": stage.name.lower(), "at": row.at,
+                       "reason": row.reason})
+    return f"id: {row.id}\nevent: status\ndata: {data}\n\n"
+
+
+class Subscriber:
+    """One stream's events, for a cluster or a single deployment, waiting to be sent."""
+
+    def __init__(self, cluster_id: Optional[int], deployment_id: Optional[int]):
+        self.cluster_id = cluster_id
+        self.deployment_id = deployment_id
+        self.pending: Deque[Tuple[int, str]] = deque()
+        # Set when the buffer overflowed and was dropped; the stream replays what it missed
+        self.lagged = False
+        self.ready = asyncio.Event()
+
+    def offer(self, event_id: int, message: str):
+        if self.lagged:
+            return
+        if len(self.pending) >= STATUS_FEED_BUFFER:
+            self.pending.clear()
+            self.lagged = True
+        else:
+            self.pending.append((event_id, message))
+        self.ready.set()
+
+
+class StatusFeed:
+    """Fans deployment_events rows out to the subscribers of this process.
+
+    The tail task only runs while someone is subscribed, and subscribers are
+    indexed by cluster and by deployment so each row reaches its subscribers
+    without looking at the others.
+    """
+
+    def __init__(self):
+        # Newest event id read from the table
+        self.position: Optional[int] = None
+        self._by_cluster: Dict[int, Set[Subscriber]] = {}
+        self._by_deployment: Dict[int, Set[Subscriber]] = {}
+        # Ids the tail skipped over, and when
+        self._missing: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        # Resolved once the tail knows where the table ends
+        self._started: Optional[asyncio.Future] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    @property
+    def subscribers(self) -> int:
+        return sum(map(len, self._by_cluster.values())) + sum(map(len, self._by_deployment.values()))
+
+    def wake(self):
+        """Read new events now; called after committing a status change."""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def subscribe(self, cluster_id: Optional[int] = None, deployment_id: Optional[int] = None) -> Subscriber:
+        subscriber = Subscriber(cluster_id, deployment_id)
+        if cluster_id is not None:
+            self._by_cluster.setdefault(cluster_id, set()).add(subscriber)
+        else:
+            self._by_deployment.setdefault(deployment_id, set()).add(subscriber)
+        if self._task is None:
+            loop = asyncio.get_running_loop()
+            self._started, self._wake = loop.create_future(), asyncio.Event()
+            self._task = loop.create_task(self._tail(self._started))
+        try:
+            # Shielded: one subscriber giving up must not cancel the others' wait
+            await asyncio.shield(self._started)
+        except BaseException:
+            self.unsubscribe(subscriber)
+            raise
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        index, key = ((self._by_cluster, subscriber.cluster_id) if subscriber.cluster_id is not None
+                      else (self._by_deployment, subscriber.deployment_id))
+        subscribers = index.get(key, set())
+        subscribers.discard(subscriber)
+        if not subscribers:
+            index.pop(key, None)
+        if not self._by_cluster and not self._by_deployment and self._task is not None:
+            self._task.cancel()
+            self._task = self._started = self._wake = None
+            self.position = None
+            self._missing.clear()
+
+    async def _tail(self, started: asyncio.Future):
+        try:
+            async with AsyncSessionLocal() as db:
+                self.position = (await db.execute(select(func.max(DeploymentEvent.id)))).scalar() or 0
+        except Exception as e:
+            started.set_exception(e)
+            return
+        started.set_result(None)
+        wake = self._wake
+        while True:
+            try:
+                await asyncio.wait_for(wake.wait(), STATUS_FEED_POLL)
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+            try:
+                await self.poll()
+            except Exception as e:
+                print(f"Status feed poll failed: {e}")
+
+    async def poll(self):
+        now = time.monotonic()
+        self._missing = {event_id: seen for event_id, seen in self._missing.items() if now - seen < GAP_GRACE}
+        condition = DeploymentEvent.id > self.position
+        if self._missing:
+            condition = or_(condition, DeploymentEvent.id.in_(list(self._missing)))
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(select(*COLUMNS).filter(condition).order_by(DeploymentEvent.id))).all()
+        for row in rows:
+            if row.id > self.position:
+                # Ids are taken at insert and can commit out of order; watch the skipped ones for a while
+                for skipped in range(self.position + 1, row.id):
+                    self._missing[skipped] = now
+                self.position = row.id
+            else:
+                self._missing.pop(row.id, None)
+            message = frame(row)
+            if message is not None:
+                for subscriber in chain(self._by_cluster.get(row.cluster_id, ()),
+                                        self._by_deployment.get(row.deployment_id, ())):
+                    subscriber.offer(row.id, message)
+
+    async def replay(self, subscriber: Subscriber, after: int) -> Tuple[List[Tuple[int, str]], bool]:
+        """Status events for the subscriber with ids after `after`, and whether that is all of them."""
+        key = (DeploymentEvent.cluster_id == subscriber.cluster_id if subscriber.cluster_id is not None
+               else DeploymentEvent.deployment_id == subscriber.deployment_id)
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(select(*COLUMNS).filter(
+                key,
+                DeploymentEvent.id > after,
+                DeploymentEvent.stage.in_([int(stage) for stage in STATUS_STAGES])
+            ).order_by(DeploymentEvent.id).limit(STATUS_FEED_REPLAY_LIMIT + 1))).all()
+        return [(row.id, frame(row)) for row in rows[:STATUS_FEED_REPLAY_LIMIT]], len(rows) <= STATUS_FEED_REPLAY_LIMIT
+
+    async def stream(self, cluster_id: Optional[int] = None, deployment_id: Optional[int] = None,
+                     last_event_id: Optional[int] = None) -> AsyncIterator[str]:
+        """SSE messages for a cluster's or one deployment's status changes, until the client leaves.
+
+        Starts with the events after last_event_id if given, otherwise with
+        the changes made from now on. A stream with more to catch up on than
+        STATUS_FEED_REPLAY_LIMIT gets a "reset" event instead, after which
+        the client should re-list and carries on from the newest event.
+        """
+        subscriber = await self.subscribe(cluster_id, deployment_id)
+        catch_up = last_event_id is not None
+        sent = last_event_id if catch_up else self.position
+        replayed: Set[int] = set()
+        try:
+            yield f"retry: {RECONNECT_DELAY_MS}\n\n"
+            while True:
+                if catch_up or subscriber.lagged:
+                    # Events offered from here on are buffered again; the replay covers the ones before
+                    subscriber.lagged = False
+                    catch_up = False
+                    messages, complete = await self.replay(subscriber, sent)
+                    if not complete:
+                        subscriber.pending.clear()
+                        sent = self.position
+                        replayed = set()
+                        yield f"id: {sent}\nevent: reset\ndata: {{}}\n\n"
+                        continue
+                    replayed = {event_id for event_id, _ in messages}
+                    for event_id, message in messages:
+                        sent = max(sent, event_id)
+                        yield message
+                if not subscriber.pending:
+                    subscriber.ready.clear()
+                    try:
+                        await asyncio.wait_for(subscriber.ready.wait(), STATUS_FEED_KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                    continue
+                event_id, message = subscriber.pending.popleft()
+                if event_id not in replayed:
+                    sent = max(sent, event_id)
+                    yield message
+        finally:
+            self.unsubscribe(subscriber)
+
+
+status_feed = StatusFeed()
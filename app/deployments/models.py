@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Enum
+from sqlalchemy import Column, Float, Integer, SmallInteger, String, ForeignKey, Enum, Index
 from sqlalchemy.orm import relationship
 from app.db.database import Base
 import enum
@@ -6,11 +6,16 @@ import enum
 class DeploymentStatus(enum.Enum):
     QUEUED = "queued"
     RUNNING = "running"
-    COMPLETED = "completed" # current no idea when to complete it
+    COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
 
 class Deployment(Base):
     __tablename__ = "deployments"
+    __table_args__ = (
+        # Queued/running deployments of a cluster, by priority; see app/db/migrations.py
+        Index("ix_deployments_cluster_status_priority", "cluster_id", "status", "priority"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     cluster_id = Column(Integer, ForeignKey("clusters.id"))
@@ -20,5 +25,39 @@ class Deployment(Base):
     gpu_required = Column(Integer)
     priority = Column(Integer)
     status = Column(Enum(DeploymentStatus))
+    # Correlation id of the request that submitted it, carried in scheduler messages
+    trace_id = Column(String(64))
+    # Shared by the deployments of a group, which only start all together
+    group_id = Column(String(64), index=True)
+    # Unix time it last entered the queue, from which priority aging counts
+    queued_since = Column(Float)
 
     cluster = relationship("Cluster", back_populates="deployments")
+
+class DeploymentStage(enum.IntEnum):
+    SUBMITTED = 1   # the API accepted it
+    ENQUEUED = 2    # published for the scheduler
+    DEQUEUED = 3    # the scheduler consumed the message
+    REJECTED = 4    # a scheduling pass could not start it; reason says why
+    ADMITTED = 5    # started on the cluster
+    PREEMPTED = 6   # evicted and queued again; reason names the deployment that took its place
+    FINISHED = 7    # completed, failed or cancelled; reason is the status
+
+class DeploymentEvent(Base):
+    """One state transition of a deployment, for its timeline.
+
+    Rows are written in the transactions that make the transitions. The stage
+    is stored as a small integer and the time as Unix seconds to keep the
+    table narrow.
+    """
+    __tablename__ = "deployment_events"
+    __table_args__ = (
+        Index("ix_deployment_events_cluster_at", "cluster_id", "at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    deployment_id = Column(Integer, ForeignKey("deployments.id"), index=True, nullable=False)
+    cluster_id = Column(Integer, nullable=False)
+    stage = Column(SmallInteger, nullable=False)
+    at = Column(Float, nullable=False)
+    reason = Column(String)
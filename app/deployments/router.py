@@ -1,47 +1,431 @@
-from fastapi import APIRouter, Depends, HTTPException
+import os
+import time
+import uuid
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.db.database import get_db
-from app.deployments import models
+from app.db.database import get_async_db
+from app.db.pagination import LIST_MAX_PAGE_SIZE, LIST_PAGE_SIZE, columns, fetch_page, keyset, stream_ndjson
+from app.db.versions import conditional_page, versions
+from app.deployments import models, timeline
+from app.deployments.feed import status_feed
 from app.clusters.models import Cluster
-from app.auth.utils import oauth2_scheme
-from pydantic import BaseModel
-from app.scheduler.scheduler import schedule_deployment
+from app.auth.utils import Principal, current_principal
+from pydantic import BaseModel, Field
+from app.scheduler import admission
+from app.scheduler.engine import QueuedDeployment, scheduler_engine
+from app.scheduler.models import Preemption
+from app.scheduler.scheduler import finish_deployment, notify_cluster, schedule_deployment
 
 router = APIRouter()
 
+# Largest number of deployments accepted by one /bulk request
+DEPLOYMENT_BULK_LIMIT = int(os.getenv('DEPLOYMENT_BULK_LIMIT', 1000))
+
 class DeploymentCreate(BaseModel):
-    cluster_id: int
+    # Leave empty to let the scheduler place the deployment on one of the organization's clusters
+    cluster_id: Optional[int] = None
     docker_image: str
-    ram_required: int
-    cpu_required: int
-    gpu_required: int
+    ram_required: int = Field(..., ge=0)
+    cpu_required: int = Field(..., ge=0)
+    gpu_required: int = Field(..., ge=0)
     priority: int
 
-@router.post("/create")
-async def create_deployment(deployment: DeploymentCreate, db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    cluster = db.query(Cluster).filter(Cluster.id == deployment.cluster_id).first()
-    if not cluster:
+class DeploymentGroupMember(BaseModel):
+    docker_image: str
+    ram_required: int = Field(..., ge=0)
+    cpu_required: int = Field(..., ge=0)
+    gpu_required: int = Field(..., ge=0)
+
+class DeploymentGroupCreate(BaseModel):
+    # Leave empty to let the scheduler place the whole group on one of the organization's clusters
+    cluster_id: Optional[int] = None
+    # Generated when not given; must not be shared with deployments still queued or running
+    group_id: Optional[str] = None
+    priority: int
+    deployments: List[DeploymentGroupMember] = Field(..., min_items=1)
+
+class DeploymentOut(BaseModel):
+    id: int
+    cluster_id: Optional[int]
+    docker_image: Optional[str]
+    ram_required: Optional[int]
+    cpu_required: Optional[int]
+    gpu_required: Optional[int]
+    priority: Optional[int]
+    status: Optional[models.DeploymentStatus]
+
+class DeploymentEventOut(BaseModel):
+    stage: str
+    at: float
+    cluster_id: int
+    reason: Optional[str]
+
+class DeploymentTimeline(BaseModel):
+    deployment_id: int
+    trace_id: Optional[str]
+    events: List[DeploymentEventOut]
+
+async def _get_cluster(db: AsyncSession, cluster_id: int, principal: Principal) -> Cluster:
+    cluster = await db.get(Cluster, cluster_id)
+    # Other organizations' clusters are reported as missing rather than forbidden
+    if not cluster or cluster.organization_id != principal.organization_id:
         raise HTTPException(status_code=404, detail="Cluster not found")
+    return cluster
+
+async def _get_deployment(db: AsyncSession, deployment_id: int, principal: Principal) -> models.Deployment:
+    result = await db.execute(select(models.Deployment).join(Cluster).filter(
+        models.Deployment.id == deployment_id,
+        Cluster.organization_id == principal.organization_id
+    ))
+    deployment = result.scalars().first()
+    if not deployment:
+        raise HTTPException(status_code=404, detail="Deployment not found")
+    return deployment
+
+@router.post("/create")
+async def create_deployment(deployment: DeploymentCreate, response: Response, db: AsyncSession = Depends(get_async_db),
+                            principal: Principal = Depends(current_principal),
+                            x_trace_id: Optional[str] = Header(None)):
+    submitted_at = time.time()
+    trace_id = timeline.trace_id(x_trace_id)
+    response.headers[timeline.TRACE_HEADER] = trace_id
+    if deployment.cluster_id is None:
+        placed = await db.run_sync(scheduler_engine.place, principal.organization_id, deployment.ram_required,
+                                   deployment.cpu_required, deployment.gpu_required)
+        if placed is None:
+            raise HTTPException(status_code=409, detail="No cluster in the organization can fit this deployment")
+        cluster_id = placed.cluster_id
+    else:
+        cluster = await _get_cluster(db, deployment.cluster_id, principal)
+        too_large = admission.oversized((cluster.total_ram, cluster.total_cpu, cluster.total_gpu),
+                                        (deployment.ram_required, deployment.cpu_required, deployment.gpu_required))
+        if too_large:
+            raise HTTPException(status_code=409, detail=too_large)
+        cluster_id = cluster.id
+    # Last, so requests refused above take nothing from the quota. Rate and queue quota come from memory;
+    # the organization is only read the first time.
+    index = await db.run_sync(scheduler_engine.organization, principal.organization_id)
+    admission.admit(principal.organization_id, index)
 
     new_deployment = models.Deployment(
-        cluster_id=deployment.cluster_id,
+        cluster_id=cluster_id,
         docker_image=deployment.docker_image,
         ram_required=deployment.ram_required,
         cpu_required=deployment.cpu_required,
         gpu_required=deployment.gpu_required,
         priority=deployment.priority,
-        status=models.DeploymentStatus.QUEUED
+        status=models.DeploymentStatus.QUEUED,
+        trace_id=trace_id,
+        queued_since=submitted_at
     )
     db.add(new_deployment)
-    db.commit()
-    db.refresh(new_deployment)
+    await db.flush()
+    db.add(models.DeploymentEvent(**timeline.event(new_deployment.id, cluster_id, models.DeploymentStage.SUBMITTED,
+                                                   at=submitted_at)))
+    await db.commit()
+    versions.bump(cluster_id=cluster_id)
+    status_feed.wake()
+    # Count the demand right away so placements made before the message is consumed see it
+    await db.run_sync(scheduler_engine.enqueue, new_deployment)
 
     # Trigger the scheduling algorithm
-    await schedule_deployment(db, new_deployment.id)
+    await schedule_deployment(new_deployment.id, cluster_id, trace_id)
+
+    return {"message": "Deployment created and queued", "deployment_id": new_deployment.id, "cluster_id": cluster_id,
+            "trace_id": trace_id}
+
+def _insert_deployments(db: Session, mappings: List[dict], submitted_at: float):
+    # return_defaults fills in each mapping's id
+    db.bulk_insert_mappings(models.Deployment, mappings, return_defaults=True)
+    timeline.record(db, [timeline.event(m["id"], m["cluster_id"], models.DeploymentStage.SUBMITTED, at=submitted_at)
+                         for m in mappings])
+
+@router.post("/bulk")
+async def create_deployments_bulk(deployments: List[DeploymentCreate], response: Response,
+                                  db: AsyncSession = Depends(get_async_db),
+                                  principal: Principal = Depends(current_principal),
+                                  x_trace_id: Optional[str] = Header(None)):
+    """Submit many deployments at once.
+
+    Every accepted item is inserted in one transaction and each affected
+    cluster gets a single scheduling pass. Items that cannot be accepted are
+    reported with an error at their index and do not affect the others,
+    including items beyond the organization's rate limit or queue quota;
+    the request gets 429 only if none is left. All of them share the
+    request's trace id.
+    """
+    submitted_at = time.time()
+    trace_id = timeline.trace_id(x_trace_id)
+    response.headers[timeline.TRACE_HEADER] = trace_id
+    if len(deployments) > DEPLOYMENT_BULK_LIMIT:
+        raise HTTPException(status_code=413, detail=f"At most {DEPLOYMENT_BULK_LIMIT} deployments per request")
+
+    requested = {d.cluster_id for d in deployments if d.cluster_id is not None}
+    result = await db.execute(select(Cluster.id, Cluster.total_ram, Cluster.total_cpu, Cluster.total_gpu).filter(
+        Cluster.id.in_(requested),
+        Cluster.organization_id == principal.organization_id
+    ))
+    owned = {row.id: (row.total_ram, row.total_cpu, row.total_gpu) for row in result}
+
+    errors = {}
+    for index, d in enumerate(deployments):
+        if d.cluster_id is not None and d.cluster_id not in owned:
+            errors[index] = "Cluster not found"
+        elif d.cluster_id is not None:
+            too_large = admission.oversized(owned[d.cluster_id], (d.ram_required, d.cpu_required, d.gpu_required))
+            if too_large:
+                errors[index] = too_large
+    accepted = [index for index in range(len(deployments)) if index not in errors]
+    placements = await db.run_sync(scheduler_engine.place_many, principal.organization_id, [
+        (deployments[index].cluster_id, deployments[index].ram_required, deployments[index].cpu_required,
+         deployments[index].gpu_required)
+        for index in accepted
+    ])
+    queues = dict(zip(accepted, placements))
+    for index in accepted:
+        if queues[index] is None:
+            errors[index] = "No cluster in the organization can fit this deployment"
+
+    # Only items that could be queued count against the organization's rate and queue quota
+    accepted = [index for index in accepted if index not in errors]
+    if accepted:
+        organization = await db.run_sync(scheduler_engine.organization, principal.organization_id)
+        granted = admission.admit(principal.organization_id, organization, len(accepted))
+        for index in accepted[granted:]:
+            errors[index] = "Submission rate limit or queue quota exceeded"
+
+    results = []
+    mappings = []
+    for index, deployment in enumerate(deployments):
+        if index in errors:
+            results.append({"index": index, "error": errors[index]})
+        else:
+            mappings.append(dict(
+                cluster_id=queues[index].cluster_id,
+                docker_image=deployment.docker_image,
+                ram_required=deployment.ram_required,
+                cpu_required=deployment.cpu_required,
+                gpu_required=deployment.gpu_required,
+                priority=deployment.priority,
+                status=models.DeploymentStatus.QUEUED,
+                trace_id=trace_id,
+                queued_since=submitted_at
+            ))
+            results.append({"index": index, "mapping": mappings[-1]})
+
+    if mappings:
+        await db.run_sync(_insert_deployments, mappings, submitted_at)
+        await db.commit()
+        status_feed.wake()
+        queued = [QueuedDeployment(m["id"], m["cluster_id"], m["priority"], m["ram_required"], m["cpu_required"],
+                                   m["gpu_required"], queued_since=submitted_at) for m in mappings]
+        await db.run_sync(scheduler_engine.enqueue_many, queued)
+        by_cluster = {}
+        for deployment in queued:
+            by_cluster.setdefault(deployment.cluster_id, []).append(deployment.id)
+        for cluster_id, deployment_ids in by_cluster.items():
+            versions.bump(cluster_id=cluster_id)
+            notify_cluster(cluster_id, deployment_ids)
+
+    for item in results:
+        mapping = item.pop("mapping", None)
+        if mapping is not None:
+            item.update(deployment_id=mapping["id"], cluster_id=mapping["cluster_id"])
+    return {"message": f"{len(mappings)} of {len(deployments)} deployments queued", "results": results,
+            "trace_id": trace_id}
+
+@router.post("/group")
+async def create_deployment_group(group: DeploymentGroupCreate, response: Response,
+                                  db: AsyncSession = Depends(get_async_db),
+                                  principal: Principal = Depends(current_principal),
+                                  x_trace_id: Optional[str] = Header(None)):
+    """Submit deployments that only start all together, such as the replicas of a training job.
+
+    The group goes to one cluster and is admitted in a single scheduling pass
+    once the combined demand of its members fits; until then none of them
+    holds any resources. Cancelling or failing a queued member leaves the rest
+    to start together without it. Under preemption a running group is evicted
+    whole.
+    """
+    submitted_at = time.time()
+    trace_id = timeline.trace_id(x_trace_id)
+    response.headers[timeline.TRACE_HEADER] = trace_id
+    size = len(group.deployments)
+    limit = min(DEPLOYMENT_BULK_LIMIT, admission.buckets.burst) if admission.buckets.rate else DEPLOYMENT_BULK_LIMIT
+    if size > limit:
+        raise HTTPException(status_code=413, detail=f"At most {limit} deployments per group")
+    group_id = group.group_id or uuid.uuid4().hex
+    if len(group_id) > 64:
+        raise HTTPException(status_code=422, detail="group_id is longer than 64 characters")
+    required = tuple(sum(getattr(d, attribute) for d in group.deployments)
+                     for attribute in ("ram_required", "cpu_required", "gpu_required"))
+
+    if group.cluster_id is None:
+        placed = await db.run_sync(scheduler_engine.place, principal.organization_id, *required)
+        if placed is None:
+            raise HTTPException(status_code=409, detail="No cluster in the organization can fit this group")
+        cluster_id = placed.cluster_id
+    else:
+        cluster = await _get_cluster(db, group.cluster_id, principal)
+        too_large = admission.oversized((cluster.total_ram, cluster.total_cpu, cluster.total_gpu), required)
+        if too_large:
+            raise HTTPException(status_code=409, detail=too_large)
+        cluster_id = cluster.id
+
+    # Active members of an earlier group with this id on the cluster would be admitted along with the new ones
+    in_use = await db.execute(select(models.Deployment.id).filter(
+        models.Deployment.group_id == group_id,
+        models.Deployment.cluster_id == cluster_id,
+        models.Deployment.status.in_([models.DeploymentStatus.QUEUED, models.DeploymentStatus.RUNNING])
+    ).limit(1))
+    if in_use.first() is not None:
+        raise HTTPException(status_code=409, detail="Group has deployments queued or running")
+    index = await db.run_sync(scheduler_engine.organization, principal.organization_id)
+    admission.admit(principal.organization_id, index, size, partial=False)
+
+    mappings = [dict(
+        cluster_id=cluster_id,
+        docker_image=deployment.docker_image,
+        ram_required=deployment.ram_required,
+        cpu_required=deployment.cpu_required,
+        gpu_required=deployment.gpu_required,
+        priority=group.priority,
+        status=models.DeploymentStatus.QUEUED,
+        trace_id=trace_id,
+        group_id=group_id,
+        queued_since=submitted_at
+    ) for deployment in group.deployments]
+    await db.run_sync(_insert_deployments, mappings, submitted_at)
+    await db.commit()
+    versions.bump(cluster_id=cluster_id)
+    status_feed.wake()
+    # Members enter the queue, and reach the cluster's owner in one message, together
+    await db.run_sync(scheduler_engine.enqueue_many, [
+        QueuedDeployment(m["id"], cluster_id, group.priority, m["ram_required"], m["cpu_required"],
+                         m["gpu_required"], group_id=group_id, queued_since=submitted_at) for m in mappings
+    ])
+    deployment_ids = [m["id"] for m in mappings]
+    notify_cluster(cluster_id, deployment_ids)
+    return {"message": f"Group of {size} deployments queued", "group_id": group_id, "cluster_id": cluster_id,
+            "deployment_ids": deployment_ids, "trace_id": trace_id}
+
+async def _finish(db: AsyncSession, deployment_id: int, principal: Principal, status: models.DeploymentStatus,
+                  allowed_from: tuple):
+    deployment = await _get_deployment(db, deployment_id, principal)
+    if deployment.status not in allowed_from:
+        raise HTTPException(status_code=409, detail=f"Deployment is {deployment.status.value}")
+    if not await db.run_sync(finish_deployment, deployment, status):
+        await db.refresh(deployment)
+        raise HTTPException(status_code=409, detail=f"Deployment is {deployment.status.value}")
+    # Released capacity shows in the organization's cluster list
+    versions.bump(principal.organization_id, deployment.cluster_id)
+    return {"message": f"Deployment {status.value}", "deployment_id": deployment_id}
+
+@router.post("/{deployment_id}/complete")
+async def complete_deployment(deployment_id: int, db: AsyncSession = Depends(get_async_db),
+                              principal: Principal = Depends(current_principal)):
+    return await _finish(db, deployment_id, principal, models.DeploymentStatus.COMPLETED,
+                         (models.DeploymentStatus.RUNNING,))
+
+@router.post("/{deployment_id}/fail")
+async def fail_deployment(deployment_id: int, db: AsyncSession = Depends(get_async_db),
+                          principal: Principal = Depends(current_principal)):
+    return await _finish(db, deployment_id, principal, models.DeploymentStatus.FAILED,
+                         (models.DeploymentStatus.QUEUED, models.DeploymentStatus.RUNNING))
+
+@router.post("/{deployment_id}/cancel")
+async def cancel_deployment(deployment_id: int, db: AsyncSession = Depends(get_async_db),
+                            principal: Principal = Depends(current_principal)):
+    return await _finish(db, deployment_id, principal, models.DeploymentStatus.CANCELLED,
+                         (models.DeploymentStatus.QUEUED, models.DeploymentStatus.RUNNING))
+
+@router.get("/list", response_model=List[DeploymentOut])
+async def list_deployments(cluster_id: int, request: Request, status: Optional[models.DeploymentStatus] = None,
+                           priority: Optional[int] = None, cursor: Optional[int] = None,
+                           limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_MAX_PAGE_SIZE), stream: bool = False,
+                           db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(current_principal)):
+    # Pass the X-Next-Cursor header back as cursor for the next page; stream=true returns every row as NDJSON.
+    # Pages carry an ETag; until the cluster's deployments change they come from memory, or 304.
+    etag = versions.cluster(cluster_id)
+    statement = select(*columns(models.Deployment, DeploymentOut)).filter(models.Deployment.cluster_id == cluster_id)
+    if status is not None:
+        statement = statement.filter(models.Deployment.status == status)
+    if priority is not None:
+        statement = statement.filter(models.Deployment.priority == priority)
+    statement = keyset(statement, models.Deployment.id, cursor)
+    if stream:
+        await _get_cluster(db, cluster_id, principal)
+        return await stream_ndjson(db, statement, models.Deployment.id, DeploymentOut)
+
+    async def load(page: Response):
+        await _get_cluster(db, cluster_id, principal)
+        return await fetch_page(db, statement, DeploymentOut, limit, page)
+    return await conditional_page(request, principal.organization_id, etag, load)
+
+@router.get("/preemptions")
+async def list_preemptions(cluster_id: int, db: AsyncSession = Depends(get_async_db),
+                           principal: Principal = Depends(current_principal)):
+    await _get_cluster(db, cluster_id, principal)
+    result = await db.execute(select(Preemption).filter(Preemption.cluster_id == cluster_id).order_by(Preemption.id))
+    return result.scalars().all()
+
+@router.get("/events")
+async def deployment_status_events(cluster_id: Optional[int] = None, deployment_id: Optional[int] = None,
+                                   last_event_id: Optional[int] = Header(None),
+                                   db: AsyncSession = Depends(get_async_db),
+                                   principal: Principal = Depends(current_principal)):
+    """Status changes of a cluster's deployments, or of one deployment, as Server-Sent Events.
+
+    Each "status" event carries deployment_id, cluster_id, status, stage, at
+    and reason. Reconnecting with the Last-Event-ID header, as EventSource
+    does by itself, resumes after that event; without it the stream starts
+    with the changes made from now on. A "reset" event means the stream
+    skipped ahead and the current state should be re-read with /list.
+    """
+    if (cluster_id is None) == (deployment_id is None):
+        raise HTTPException(status_code=422, detail="Pass exactly one of cluster_id and deployment_id")
+    if cluster_id is not None:
+        await _get_cluster(db, cluster_id, principal)
+    else:
+        await _get_deployment(db, deployment_id, principal)
+    # The stream outlives this request's session; hand its connection back to the pool now
+    await db.close()
+    return StreamingResponse(status_feed.stream(cluster_id, deployment_id, last_event_id),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.get("/{deployment_id}/timeline", response_model=DeploymentTimeline)
+async def deployment_timeline(deployment_id: int, db: AsyncSession = Depends(get_async_db),
+                              principal: Principal = Depends(current_principal)):
+    # Every recorded state transition, oldest first; at is Unix time in seconds
+    deployment = await _get_deployment(db, deployment_id, principal)
+    result = await db.execute(select(models.DeploymentEvent).filter(
+        models.DeploymentEvent.deployment_id == deployment_id
+    ).order_by(models.DeploymentEvent.at, models.DeploymentEvent.id))
+    events = [DeploymentEventOut(stage=models.DeploymentStage(e.stage).name.lower(), at=e.at, cluster_id=e.cluster_id,
+                                 reason=e.reason) for e in result.scalars().all()]
+    return DeploymentTimeline(deployment_id=deployment.id, trace_id=deployment.trace_id, events=events)
 
-    return {"message": "Deployment created and queued", "deployment_id": new_deployment.id}
+@router.get("/stages")
+async def stage_latencies(cluster_id: int, since: float = Query(3600, gt=0),
+                          db: AsyncSession = Depends(get_async_db), principal: Principal = Depends(current_principal)):
+    """Where the time went for deployments of a cluster with events in the last `since` seconds.
 
-@router.get("/list")
-async def list_deployments(cluster_id: int, db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    deployments = db.query(models.Deployment).filter(models.Deployment.cluster_id == cluster_id).all()
-    return deployments
+    Reports p50, p95 and max of the api (request to publish), broker (publish
+    to consume), queue (consume to start) and total intervals, and counts of
+    the reasons passes could not start deployments.
+    """
+    await _get_cluster(db, cluster_id, principal)
+    result = await db.execute(select(
+        models.DeploymentEvent.deployment_id, models.DeploymentEvent.stage,
+        models.DeploymentEvent.at, models.DeploymentEvent.reason
+    ).filter(
+        models.DeploymentEvent.cluster_id == cluster_id,
+        models.DeploymentEvent.at >= time.time() - since
+    ))
+    return {"cluster_id": cluster_id, "since": since, **timeline.summarize(result.all())}
@@ -0,0 +1,68 @@
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.deployments.models import DeploymentEvent, DeploymentStage
+
+TRACE_HEADER = "X-Trace-Id"
+TRACE_ID_MAX_LENGTH = 64
+
+# Intervals reported by the per-cluster summary, between the first time a
+# deployment reached each stage. Deployments that skipped a stage (bulk
+# submissions on a single worker never pass through the broker) only count
+# towards the intervals they have both ends of.
+STAGE_INTERVALS: List[Tuple[str, DeploymentStage, DeploymentStage]] = [
+    ("api", DeploymentStage.SUBMITTED, DeploymentStage.ENQUEUED),
+    ("broker", DeploymentStage.ENQUEUED, DeploymentStage.DEQUEUED),
+    ("queue", DeploymentStage.DEQUEUED, DeploymentStage.ADMITTED),
+    ("total", DeploymentStage.SUBMITTED, DeploymentStage.ADMITTED),
+]
+
+
+def trace_id(requested: Optional[str] = None) -> str:
+    """The caller's correlation id if it sent a usable one, otherwise a new one."""
+    if requested and len(requested) <= TRACE_ID_MAX_LENGTH and requested.isprintable():
+        return requested
+    return uuid.uuid4().hex
+
+
+def event(deployment_id: int, cluster_id: int, stage: DeploymentStage, at: Optional[float] = None,
+          reason: Optional[str] = None) -> dict:
+    return {"deployment_id": deployment_id, "cluster_id": cluster_id, "stage": int(stage),
+            "at": time.time() if at is None else at, "reason": reason}
+
+
+def record(db: Session, events: List[dict]):
+    """Add events to the session's transaction; the caller commits."""
+    if events:
+        db.bulk_insert_mappings(DeploymentEvent, events)
+
+
+def _percentile(ordered: List[float], percent: int) -> float:
+    return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
+
+def summarize(rows: Iterable[Tuple[int, int, float, Optional[str]]]) -> dict:
+    """Per-stage latency from (deployment_id, stage, at, reason) rows of one cluster."""
+    reached: Dict[int, Dict[int, float]] = {}
+    rejections: Dict[str, int] = {}
+    for deployment_id, stage, at, reason in rows:
+        stages = reached.setdefault(deployment_id, {})
+        if stage not in stages or at < stages[stage]:
+            stages[stage] = at
+        if stage == DeploymentStage.REJECTED:
+            rejections[reason or "unknown"] = rejections.get(reason or "unknown", 0) + 1
+
+    intervals = {}
+    for name, start, end in STAGE_INTERVALS:
+        durations = sorted(stages[end] - stages[start] for stages in reached.values()
+                           if start in stages and end in stages)
+        intervals[name] = {
+            "count": len(durations),
+            "p50_ms": round(_percentile(durations, 50) * 1000, 3) if durations else None,
+            "p95_ms": round(_percentile(durations, 95) * 1000, 3) if durations else None,
+            "max_ms": round(durations[-1] * 1000, 3) if durations else None,
+        }
+    return {"deployments": len(reached), "stages": intervals, "rejections": rejections}
@@ -1,31 +1,68 @@
 import asyncio
+import os
+
 from fastapi import FastAPI
+from sqlalchemy.exc import OperationalError
+from starlette.concurrency import run_in_threadpool
+
 from app.auth.router import router as auth_router
 from app.clusters.router import router as cluster_router
 from app.deployments.router import router as deployment_router
-from app.db.database import engine
-from app.auth import models as auth_models
-from app.clusters import models as cluster_models
-from app.deployments import models as deployment_models
-
+from app.db import versions
+from app.db.database import async_engine, database_locked, ensure_schema
+from app.metrics.middleware import MetricsMiddleware
+from app.metrics.router import router as metrics_router
+from app.scheduler import leader, sharding
+from app.scheduler.broker import deployment_broker
 from app.scheduler.scheduler import run_deployment_processor
 
-app = FastAPI()
+# Create missing tables and apply migrations when the process starts.
+# python -m app.serve does it once before starting its workers and turns it off for them.
+DB_SCHEMA_SETUP = os.getenv('DB_SCHEMA_SETUP', 'true').lower() in ('1', 'true', 'yes')
+
+
+def create_app() -> FastAPI:
+    app = FastAPI()
+
+    # Include routers for different modules
+    app.include_router(auth_router, prefix="/auth", tags=["auth"])
+    app.include_router(cluster_router, prefix="/clusters", tags=["clusters"])
+    app.include_router(deployment_router, prefix="/deployments", tags=["deployments"])
+    app.include_router(metrics_router, prefix="/metrics", tags=["metrics"])
+
+    # A write that waited out SQLite's busy_timeout is worth retrying, not a server error
+    app.add_exception_handler(OperationalError, database_locked)
+
+    # Request latency per route, exposed at /metrics
+    app.add_middleware(MetricsMiddleware, routes=app.routes)
+
+    @app.on_event("startup")
+    async def startup_event():
+        if DB_SCHEMA_SETUP:
+            # create_all and migrations are blocking; keep them off the event loop
+            await run_in_threadpool(ensure_schema)
+        await deployment_broker.start()
+        # Other processes' writes are invisible to this one's list versions
+        versions.shared = leader.SCHEDULER_LEADER_LEASE or sharding.SCHEDULER_WORKERS > 1
+        if leader.SCHEDULER_LEADER_LEASE:
+            # Only forward scheduling work until this process wins the shard's lease
+            sharding.scheduling = False
+            app.state.scheduler_task = asyncio.create_task(leader.lead_scheduler())
+        else:
+            app.state.scheduler_task = asyncio.create_task(run_deployment_processor())
+
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        app.state.scheduler_task.cancel()
+        await asyncio.gather(app.state.scheduler_task, return_exceptions=True)
+        await deployment_broker.close()
+        await async_engine.dispose()
 
-# Create tables in the database at startup (if they don't exist)
-auth_models.Base.metadata.create_all(bind=engine)
-cluster_models.Base.metadata.create_all(bind=engine)
-deployment_models.Base.metadata.create_all(bind=engine)
+    @app.get("/")
+    async def root():
+        return {"message": "Welcome to the Cluster Management API"}
 
-# Include routers for different modules
-app.include_router(auth_router, prefix="/auth", tags=["auth"])
-app.include_router(cluster_router, prefix="/clusters", tags=["clusters"])
-app.include_router(deployment_router, prefix="/deployments", tags=["deployments"])
+    return app
 
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(run_deployment_processor())
 
-@app.get("/")
-async def root():
-    return {"message": "Welcome to the Cluster Management API"}
+app = create_app()
@@ -0,0 +1,40 @@
+from time import perf_counter
+from typing import Dict
+
+from app.metrics.registry import HTTP_REQUEST_DURATION, HistogramValue
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each HTTP request into HTTP_REQUEST_DURATION.
+
+    Requests are labelled by the route template they matched rather than the
+    raw path, so ids in URLs do not create new series. The histogram child of
+    each endpoint is looked up once and cached. Streaming responses are timed
+    until their last chunk is sent.
+    """
+
+    def __init__(self, app, routes: list):
+        self.app = app
+        self.routes = routes
+        self._children: Dict[object, HistogramValue] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            endpoint = scope.get("endpoint")
+            child = self._children.get(endpoint)
+            if child is None:
+                child = self._children[endpoint] = self._child_for(endpoint)
+            child.observe(perf_counter() - started)
+
+    def _child_for(self, endpoint) -> HistogramValue:
+        for route in self.routes:
+            if getattr(route, "endpoint", None) is endpoint and endpoint is not None:
+                methods = ",".join(sorted(getattr(route, "methods", None) or ()))
+                return HTTP_REQUEST_DURATION.labels(methods, route.path)
+        return HTTP_REQUEST_DURATION.labels("", "unmatched")
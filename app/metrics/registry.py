@@ -0,0 +1,198 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# Upper bounds, in seconds, for request, query and pass durations
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds, in seconds, for how long deployments wait to start
+QUEUE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 14400.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class HistogramValue:
+    """Bucket counts and a running sum.
+
+    Buckets are kept non-cumulative so observe() touches a single slot; they
+    are accumulated when scraped.
+    """
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric(ABC):
+    """One metric family and its labelled children.
+
+    Children are created once per label combination and cached; hot paths
+    look a child up once and keep it, so recording is a plain increment
+    with no lock and no allocation. Concurrent threads may in rare cases
+    lose an increment, which is acceptable for monitoring.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: "Registry" = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, object] = {}
+        if not self.labelnames:
+            self._default = self.labels()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        pass
+
+    @abstractmethod
+    def lines(self) -> Iterator[str]:
+        pass
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def lines(self) -> Iterator[str]:
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_number(child.value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: "Registry" = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def lines(self) -> Iterator[str]:
+        names = self.labelnames + ("le",)
+        for values, child in list(self._children.items()):
+            counts = list(child.counts)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(names, values + (_format_number(bound),))} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {_format_number(child.sum)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge(Metric):
+    """A value read from its owner at scrape time instead of being tracked.
+
+    collect returns (label values, value) pairs, so state the application
+    already keeps, such as queue lengths, costs nothing between scrapes.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], Iterable[Tuple[tuple, float]]],
+                 labelnames: Sequence[str] = (), registry: "Registry" = None):
+        self.collect = collect
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return None
+
+    def lines(self) -> Iterator[str]:
+        for values, value in self.collect():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_number(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        if any(existing.name == metric.name for existing in self._metrics):
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to handle a request, by matched route.", ("method", "route"))
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Time spent executing SQL statements; the count is the number of queries.")
+SCHEDULER_PASS_DURATION = Histogram(
+    "scheduler_pass_duration_seconds", "Duration of scheduling passes, including their transaction.")
+SCHEDULER_ADMITTED = Counter(
+    "scheduler_admitted_deployments_total", "Deployments started by scheduling passes.")
+SCHEDULER_CONFLICTS = Counter(
+    "scheduler_capacity_conflicts_total", "Scheduling passes rolled back because the cluster had less capacity.")
+TIME_TO_SCHEDULE = Histogram(
+    "deployment_time_to_schedule_seconds", "Time from queueing a deployment on this worker until it starts.",
+    buckets=QUEUE_BUCKETS)
+BROKER_PUBLISH_DURATION = Histogram(
+    "broker_publish_duration_seconds",
+    "Time from publishing a message until the broker confirmed it (in-memory: until it was consumed).")
+RESPONSE_CACHE_REQUESTS = Counter(
+    "response_cache_requests_total", "List pages requested, by whether the cache had the current version.",
+    ("result",))
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Deployment submissions refused by admission control, by reason.", ("reason",))
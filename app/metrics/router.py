@@ -0,0 +1,36 @@
+from fastapi import APIRouter, Response
+
+from app.auth.utils import password_hasher
+from app.deployments.feed import status_feed
+from app.metrics.registry import REGISTRY, Gauge
+from app.scheduler import sharding
+from app.scheduler.broker import deployment_broker
+from app.scheduler.engine import scheduler_engine
+
+router = APIRouter()
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _owned_clusters():
+    # The engine also holds other workers' clusters for placement; only report this worker's
+    return [(cluster_id, queue) for cluster_id, queue in list(scheduler_engine.clusters.items())
+            if sharding.owns_cluster(cluster_id)]
+
+
+Gauge("scheduler_queued_deployments", "Deployments waiting in a cluster's queue on this worker.",
+      lambda: [((cluster_id,), len(queue)) for cluster_id, queue in _owned_clusters()], ("cluster_id",))
+Gauge("scheduler_running_deployments", "Deployments running on a cluster, as tracked by this worker.",
+      lambda: [((cluster_id,), len(queue.running)) for cluster_id, queue in _owned_clusters()], ("cluster_id",))
+Gauge("broker_pending_messages", "Messages buffered in-process and not yet handed to the broker.",
+      lambda: [((), deployment_broker.pending)])
+Gauge("status_feed_subscribers", "Deployment status streams connected to this process.",
+      lambda: [((), status_feed.subscribers)])
+for _stat in ("workers", "busy", "waiting", "saturation"):
+    Gauge(f"password_hasher_{_stat}", f"Password hashing pool: {_stat}, from PasswordHasher.stats().",
+          lambda stat=_stat: [((), password_hasher.stats()[stat])])
+
+
+@router.get("")
+async def metrics():
+    return Response(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,121 @@
+"""Admission control for deployment submissions.
+
+Checked before anything is written, from state already in memory: a
+deployment larger than its cluster's total capacity is refused outright,
+and each organization is limited by a token bucket of submissions and by
+how many of its deployments may wait in queues at once. Limited requests
+get 429 with Retry-After so well-behaved clients back off.
+
+Buckets and queue counts are per process: with several API workers an
+organization may submit up to ADMISSION_RATE per second to each of them,
+and queue counts for clusters scheduled elsewhere are as fresh as the
+placement index (SCHEDULER_REMOTE_REFRESH).
+"""
+import math
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app.metrics.registry import ADMISSION_REJECTED
+from app.scheduler.capacity import RESOURCES
+from app.scheduler.placement import PlacementIndex
+
+# Submissions per second each organization may sustain (0 disables the limit), and how many at once
+ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', 200))
+ADMISSION_BURST = int(os.getenv('ADMISSION_BURST', 2000))
+# Deployments an organization may have queued across its clusters (0 disables the quota)
+ADMISSION_MAX_QUEUED = int(os.getenv('ADMISSION_MAX_QUEUED', 10000))
+# Seconds a client over its queue quota is told to wait before submitting again
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 5))
+if ADMISSION_RATE < 0 or ADMISSION_MAX_QUEUED < 0:
+    raise ValueError(f"ADMISSION_RATE and ADMISSION_MAX_QUEUED cannot be negative, "
+                     f"got {ADMISSION_RATE} and {ADMISSION_MAX_QUEUED}")
+if ADMISSION_RATE and ADMISSION_BURST < 1:
+    raise ValueError(f"ADMISSION_BURST must be at least 1, got {ADMISSION_BURST}")
+if ADMISSION_RETRY_AFTER < 1:
+    raise ValueError(f"ADMISSION_RETRY_AFTER must be at least 1, got {ADMISSION_RETRY_AFTER}")
+
+# Index of the queued deployment count in a capacity snapshot
+_QUEUED = 10
+
+_rate_limited = ADMISSION_REJECTED.labels("rate")
+_over_quota = ADMISSION_REJECTED.labels("quota")
+_too_large = ADMISSION_REJECTED.labels("size")
+
+
+class TokenBuckets:
+    """One token bucket per key, refilled lazily when it is next used."""
+
+    def __init__(self, rate: float = ADMISSION_RATE, burst: int = ADMISSION_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[int, Tuple[float, float]] = {}
+
+    def take(self, key: int, count: int = 1, now: Optional[float] = None, partial: bool = True) -> Tuple[int, float]:
+        """Take up to count tokens; returns how many were taken and, if short, seconds until enough are back.
+
+        With partial=False it takes all count tokens or none, and the wait is
+        for all of them.
+        """
+        if not self.rate:
+            return count, 0.0
+        now = time.monotonic() if now is None else now
+        tokens, updated = self._buckets.get(key, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+        taken = min(count, int(tokens))
+        if not partial and taken < count:
+            taken = 0
+        tokens -= taken
+        self._buckets[key] = (tokens, now)
+        if taken == count:
+            return taken, 0.0
+        return taken, ((1 if partial else min(count, self.burst)) - tokens) / self.rate
+
+    def clear(self):
+        self._buckets.clear()
+
+
+buckets = TokenBuckets()
+
+
+def _too_many(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+def queue_room(index: Optional[PlacementIndex]) -> Optional[int]:
+    """How many more deployments the organization may queue, or None if there is no quota."""
+    if not ADMISSION_MAX_QUEUED:
+        return None
+    queued = index.totals.values[_QUEUED] if index is not None else 0
+    return max(0, ADMISSION_MAX_QUEUED - queued)
+
+
+def oversized(totals: Tuple[int, int, int], required: Tuple[int, int, int]) -> Optional[str]:
+    """Why a deployment can never fit a cluster of these totals, or None if it can."""
+    short = [f"{resource} {need} > {total}" for resource, total, need in zip(RESOURCES, totals, required)
+             if need > (total or 0)]
+    if short:
+        _too_large.inc()
+        return "Deployment needs more than the cluster's total capacity (" + ", ".join(short) + ")"
+    return None
+
+
+def admit(organization_id: int, index: Optional[PlacementIndex], count: int = 1, partial: bool = True) -> int:
+    """Reserve up to count submissions for an organization; returns how many may go ahead.
+
+    Raises 429 if none may. A bulk submission can be granted fewer than it
+    asked for, in which case the items beyond that are reported as rejected;
+    a deployment group passes partial=False, as only all of it is any use.
+    """
+    room = queue_room(index)
+    if room == 0 or (room is not None and not partial and room < count):
+        _over_quota.inc()
+        raise _too_many(f"Organization would have more than {ADMISSION_MAX_QUEUED} deployments queued",
+                        ADMISSION_RETRY_AFTER)
+    taken, retry_after = buckets.take(organization_id, count if room is None else min(count, room), partial=partial)
+    if not taken:
+        _rate_limited.inc()
+        raise _too_many("Submission rate limit exceeded", retry_after)
+    return taken
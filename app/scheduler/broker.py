@@ -0,0 +1,265 @@
+import asyncio
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, List, Optional
+
+import aio_pika
+from aio_pika.pool import Pool
+
+from app.metrics.registry import BROKER_PUBLISH_DURATION
+from app.scheduler import sharding
+
+DEPLOYMENT_QUEUE = 'deployment_queue'
+# "amqp" talks to RabbitMQ; "memory" keeps messages inside this process
+DEPLOYMENT_BROKER = os.getenv('DEPLOYMENT_BROKER', 'amqp')
+RABBITMQ_CHANNEL_POOL_SIZE = int(os.getenv('RABBITMQ_CHANNEL_POOL_SIZE', 4))
+RABBITMQ_MAX_PENDING = int(os.getenv('RABBITMQ_MAX_PENDING', 10000))
+BROKER_PREFETCH = int(os.getenv('BROKER_PREFETCH', 32))
+
+
+class BrokerMessage:
+    def __init__(self, payload: dict, raw: Any = None):
+        self.payload = payload
+        self.raw = raw
+
+
+MessageHandler = Callable[[BrokerMessage], Awaitable[None]]
+
+
+class Broker(ABC):
+    """Interface the scheduler uses to move deployment messages.
+
+    publish() must not block on the transport: implementations buffer and
+    raise asyncio.QueueFull when they cannot accept more. consume() runs until
+    cancelled and hands each message to the handler, which must ack() or
+    nack() it. Messages go to the queue of one scheduler shard, and each
+    worker consumes only its own.
+    """
+
+    queue_name = DEPLOYMENT_QUEUE
+
+    def shard_queue(self, shard: int) -> str:
+        # A single worker keeps the original queue name
+        if sharding.SCHEDULER_WORKERS == 1:
+            return self.queue_name
+        return f"{self.queue_name}.{shard}"
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    def publish(self, payload: dict, shard: int = 0):
+        pass
+
+    @abstractmethod
+    async def consume(self, handler: MessageHandler, shard: int = 0):
+        pass
+
+    @abstractmethod
+    async def ack(self, message: BrokerMessage):
+        pass
+
+    @abstractmethod
+    async def nack(self, message: BrokerMessage, requeue: bool = True):
+        pass
+
+    @property
+    def pending(self) -> int:
+        return 0
+
+
+async def connect_rabbitmq() -> aio_pika.RobustConnection:
+    """Connect to RabbitMQ, retrying with backoff until the broker is reachable.
+
+    The returned robust connection restores itself (and its channels) after
+    later outages, so this only has to succeed once.
+    """
+    delay = 1
+    while True:
+        try:
+            return await aio_pika.connect_robust(
+                host=os.getenv('RABBITMQ_HOST', 'localhost'),
+                port=int(os.getenv('RABBITMQ_PORT', 5672)),
+                login=os.getenv('RABBITMQ_USER', 'guest'),
+                password=os.getenv('RABBITMQ_PASSWORD', 'guest')
+            )
+        except Exception as e:
+            print(f"Failed to connect to RabbitMQ, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+class AmqpBroker(Broker):
+    """RabbitMQ backend sharing one long-lived connection per process.
+
+    publish() only appends to a bounded in-process outbox, so API latency does
+    not depend on the broker. A small pool of confirm-mode channels drains the
+    outbox in the background and retries until the broker acknowledges each
+    message.
+    """
+
+    def __init__(self, queue_name: str = DEPLOYMENT_QUEUE, pool_size: int = RABBITMQ_CHANNEL_POOL_SIZE,
+                 max_pending: int = RABBITMQ_MAX_PENDING):
+        self.queue_name = queue_name
+        self.pool_size = pool_size
+        self.max_pending = max_pending
+        self._connection: Optional[aio_pika.RobustConnection] = None
+        self._connected: Optional[asyncio.Event] = None
+        self._channels: Optional[Pool] = None
+        self._outbox: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def pending(self) -> int:
+        return self._outbox.qsize() if self._outbox is not None else 0
+
+    async def start(self):
+        self._ensure_started()
+
+    def _ensure_started(self):
+        if self._outbox is None:
+            self._outbox = asyncio.Queue(maxsize=self.max_pending)
+            self._connected = asyncio.Event()
+            self._tasks.append(asyncio.get_running_loop().create_task(self._run()))
+
+    async def _run(self):
+        self._connection = await connect_rabbitmq()
+        self._channels = Pool(self._open_channel, max_size=self.pool_size)
+        self._connected.set()
+        senders = [asyncio.create_task(self._send_forever()) for _ in range(self.pool_size)]
+        self._tasks.extend(senders)
+        await asyncio.gather(*senders)
+
+    async def _open_channel(self) -> aio_pika.abc.AbstractChannel:
+        channel = await self._connection.channel(publisher_confirms=True)
+        for shard in range(sharding.SCHEDULER_WORKERS):
+            await channel.declare_queue(self.shard_queue(shard))
+        return channel
+
+    async def _send_forever(self):
+        while True:
+            routing_key, body, published_at = await self._outbox.get()
+            delay = 0.1
+            while True:
+                try:
+                    async with self._channels.acquire() as channel:
+                        await channel.default_exchange.publish(
+                            aio_pika.Message(body=body),
+                            routing_key=routing_key
+                        )
+                    BROKER_PUBLISH_DURATION.observe(time.perf_counter() - published_at)
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"Publishing to {routing_key} failed, retrying in {delay}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5)
+
+    def publish(self, payload: dict, shard: int = 0):
+        self._ensure_started()
+        self._outbox.put_nowait((self.shard_queue(shard), json.dumps(payload).encode(), time.perf_counter()))
+
+    async def consume(self, handler: MessageHandler, shard: int = 0):
+        self._ensure_started()
+        await self._connected.wait()
+        channel = await self._connection.channel()
+        await channel.set_qos(prefetch_count=BROKER_PREFETCH)
+        queue = await channel.declare_queue(self.shard_queue(shard))
+
+        async def on_message(message: aio_pika.IncomingMessage):
+            await handler(BrokerMessage(json.loads(message.body), message))
+
+        consumer_tag = await queue.consume(on_message)
+        try:
+            await asyncio.Future()  # Run until cancelled
+        finally:
+            # Unacknowledged messages go back to the queue for whoever consumes next
+            await queue.cancel(consumer_tag)
+            await channel.close()
+
+    async def ack(self, message: BrokerMessage):
+        await message.raw.ack()
+
+    async def nack(self, message: BrokerMessage, requeue: bool = True):
+        await message.raw.nack(requeue=requeue)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._outbox = None
+        if self._channels is not None:
+            await self._channels.close()
+            self._channels = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+
+class InMemoryBroker(Broker):
+    """Single-process backend on top of asyncio.Queue.
+
+    Messages never leave the process, so there is no network hop; this suits
+    single-node deployments, tests and benchmarks. With one process there is
+    one shard, so the shard arguments are ignored. Unacked messages are lost
+    on restart, which is fine because QUEUED deployments are reloaded from the
+    database when the scheduler starts.
+    """
+
+    def __init__(self, queue_name: str = DEPLOYMENT_QUEUE, max_pending: int = RABBITMQ_MAX_PENDING):
+        self.queue_name = queue_name
+        self.max_pending = max_pending
+        self._queue: Optional[asyncio.Queue] = None
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+
+    async def start(self):
+        self._ensure_started()
+
+    def publish(self, payload: dict, shard: int = 0):
+        self._ensure_started()
+        self._queue.put_nowait((time.perf_counter(), BrokerMessage(payload)))
+
+    async def consume(self, handler: MessageHandler, shard: int = 0):
+        self._ensure_started()
+        while True:
+            published_at, message = await self._queue.get()
+            BROKER_PUBLISH_DURATION.observe(time.perf_counter() - published_at)
+            await handler(message)
+
+    async def ack(self, message: BrokerMessage):
+        self._queue.task_done()
+
+    async def nack(self, message: BrokerMessage, requeue: bool = True):
+        self._queue.task_done()
+        if requeue:
+            self._queue.put_nowait((time.perf_counter(), message))
+
+    async def close(self):
+        self._queue = None
+
+
+def create_broker(kind: str = DEPLOYMENT_BROKER) -> Broker:
+    if kind == 'amqp':
+        return AmqpBroker()
+    if kind == 'memory':
+        if sharding.SCHEDULER_WORKERS > 1:
+            raise ValueError("DEPLOYMENT_BROKER 'memory' cannot reach other workers; use 'amqp' with SCHEDULER_WORKERS > 1")
+        return InMemoryBroker()
+    raise ValueError(f"Unknown DEPLOYMENT_BROKER {kind!r}, expected 'amqp' or 'memory'")
+
+
+deployment_broker = create_broker()
@@ -0,0 +1,56 @@
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from app.scheduler.engine import ClusterQueue
+
+RESOURCES = ('ram', 'cpu', 'gpu')
+
+Snapshot = Tuple[int, ...]
+# total, available and queued demand per resource, then running and queued deployment counts
+_EMPTY: Snapshot = (0,) * 11
+
+
+def snapshot(queue: 'ClusterQueue') -> Snapshot:
+    return (queue.total_ram, queue.total_cpu, queue.total_gpu,
+            queue.available_ram, queue.available_cpu, queue.available_gpu,
+            queue.queued_ram, queue.queued_cpu, queue.queued_gpu,
+            len(queue.running), len(queue))
+
+
+def describe(values: Snapshot) -> dict:
+    total, available, queued = values[0:3], values[3:6], values[6:9]
+    return {
+        "total": dict(zip(RESOURCES, total)),
+        "allocated": {resource: t - a for resource, t, a in zip(RESOURCES, total, available)},
+        "free": dict(zip(RESOURCES, available)),
+        "queued_demand": dict(zip(RESOURCES, queued)),
+        "running_deployments": values[9],
+        "queued_deployments": values[10],
+    }
+
+
+class CapacityTotals:
+    """Capacity of an organization's clusters, summed as the clusters change.
+
+    Every change to a cluster replaces its previous snapshot, so the totals
+    are adjusted by the difference instead of being recomputed over all
+    clusters.
+    """
+
+    def __init__(self):
+        self.clusters = 0
+        self.values: List[int] = list(_EMPTY)
+
+    def apply(self, previous: Optional[Snapshot], current: Optional[Snapshot]):
+        if previous is None:
+            self.clusters += 1
+            previous = _EMPTY
+        if current is None:
+            self.clusters -= 1
+            current = _EMPTY
+        values = self.values
+        for position, (before, after) in enumerate(zip(previous, current)):
+            values[position] += after - before
+
+    def describe(self) -> dict:
+        return {"clusters": self.clusters, **describe(tuple(self.values))}
@@ -0,0 +1,481 @@
+import heapq
+import itertools
+import os
+import time
+from bisect import bisect_left, insort
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.clusters.models import Cluster
+from app.deployments.models import Deployment, DeploymentStatus
+from app.scheduler import sharding
+from app.scheduler.placement import PLACEMENT_POLICY, PlacementIndex
+
+# Priority levels a queued deployment gains per minute of waiting; 0 orders by priority alone
+SCHEDULER_PRIORITY_AGING = float(os.getenv('SCHEDULER_PRIORITY_AGING', 0))
+if SCHEDULER_PRIORITY_AGING < 0:
+    raise ValueError(f"SCHEDULER_PRIORITY_AGING cannot be negative, got {SCHEDULER_PRIORITY_AGING}")
+
+
+@dataclass
+class QueuedDeployment:
+    id: int
+    cluster_id: int
+    priority: int
+    ram_required: int
+    cpu_required: int
+    gpu_required: int
+    # Deployments sharing a group id are admitted together or not at all
+    group_id: Optional[str] = None
+    # Unix time it entered the queue, which priority aging counts from; now if not given
+    queued_since: Optional[float] = field(default=None, compare=False)
+    # time.monotonic() when this worker queued the deployment, for time-to-schedule
+    queued_at: float = field(default=0.0, compare=False)
+    # Position in the queue, smallest first; see rank()
+    rank: float = field(default=0.0, compare=False)
+    # Whether a REJECTED event was recorded since it was queued
+    rejected: bool = field(default=False, compare=False)
+
+    @classmethod
+    def from_model(cls, deployment: Deployment):
+        return cls(
+            id=deployment.id,
+            cluster_id=deployment.cluster_id,
+            priority=deployment.priority or 0,
+            ram_required=deployment.ram_required or 0,
+            cpu_required=deployment.cpu_required or 0,
+            gpu_required=deployment.gpu_required or 0,
+            group_id=deployment.group_id,
+            queued_since=deployment.queued_since,
+        )
+
+
+def rank(priority: int, queued_since: float, aging: float) -> float:
+    """Queue order of a deployment, smallest first, under aging of `aging` priority levels per minute.
+
+    Its effective priority at time t is priority + aging * (t - queued_since) / 60.
+    Every queued deployment ages at the same rate, so the order of effective
+    priorities never changes as t moves on: it is the order of this rank,
+    the aging a deployment missed by not being queued since time zero minus
+    its priority. Entries keep their place in the heap, and a deployment that
+    has waited long enough passes every later submission whatever its
+    priority, which bounds its wait.
+    """
+    return aging * queued_since / 60 - priority
+
+
+def combined(members: List[QueuedDeployment]) -> QueuedDeployment:
+    """The members of a group as one deployment: the first one's id and priority, and their summed demand."""
+    if len(members) == 1:
+        return members[0]
+    first = members[0]
+    return QueuedDeployment(first.id, first.cluster_id, first.priority,
+                            sum(m.ram_required for m in members), sum(m.cpu_required for m in members),
+                            sum(m.gpu_required for m in members), group_id=first.group_id)
+
+
+class ClusterQueue:
+    """Free resources of one cluster plus a heap of its queued deployments.
+
+    The heap is ordered by effective priority (highest first), which grows
+    with time queued when SCHEDULER_PRIORITY_AGING is set, and then by
+    deployment id, which is assigned in submission order. Removed or
+    re-prioritised entries are dropped lazily when they reach the top of the
+    heap.
+
+    Running deployments are kept in eviction order (lowest priority, then most
+    recently started first) for preemption.
+
+    Members of a deployment group are indexed by group id, queued and running
+    separately, so a pass can admit a group whole and preemption can evict
+    one whole.
+    """
+
+    def __init__(self, cluster_id: int, available_ram: int, available_cpu: int, available_gpu: int,
+                 organization_id: Optional[int] = None, total_ram: Optional[int] = None,
+                 total_cpu: Optional[int] = None, total_gpu: Optional[int] = None, name: Optional[str] = None):
+        self.cluster_id = cluster_id
+        self.name = name
+        self.organization_id = organization_id
+        self.available_ram = available_ram
+        self.available_cpu = available_cpu
+        self.available_gpu = available_gpu
+        self.total_ram = available_ram if total_ram is None else total_ram
+        self.total_cpu = available_cpu if total_cpu is None else total_cpu
+        self.total_gpu = available_gpu if total_gpu is None else total_gpu
+        # Summed demand of the queued deployments
+        self.queued_ram = 0
+        self.queued_cpu = 0
+        self.queued_gpu = 0
+        # Placement index of the owning organization, kept in sync with headroom()
+        self.index: Optional[PlacementIndex] = None
+        self._heap: List[Tuple[float, int]] = []
+        self._entries: Dict[int, QueuedDeployment] = {}
+        self.running: Dict[int, QueuedDeployment] = {}
+        self._eviction_order: List[Tuple[int, int, int]] = []
+        self._eviction_keys: Dict[int, Tuple[int, int, int]] = {}
+        self._start_seq = itertools.count()
+        self._groups: Dict[str, Set[int]] = {}
+        self._running_groups: Dict[str, Set[int]] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, deployment_id: int):
+        return deployment_id in self._entries
+
+    def push(self, deployment: QueuedDeployment):
+        current = self._entries.get(deployment.id)
+        # A refreshed entry keeps waiting since the first push; a re-queued one starts over
+        deployment.queued_at = current.queued_at if current is not None else time.monotonic()
+        deployment.rejected = current.rejected if current is not None else False
+        if deployment.queued_since is None:
+            deployment.queued_since = current.queued_since if current is not None else time.time()
+        deployment.rank = rank(deployment.priority, deployment.queued_since, SCHEDULER_PRIORITY_AGING)
+        self._entries[deployment.id] = deployment
+        _join(self._groups, deployment)
+        if current is not None:
+            self._add_demand(current, -1)
+        self._add_demand(deployment, 1)
+        if current is None or current.rank != deployment.rank:
+            heapq.heappush(self._heap, (deployment.rank, deployment.id))
+            self._compact()
+
+    def remove(self, deployment_id: int) -> Optional[QueuedDeployment]:
+        entry = self._entries.pop(deployment_id, None)
+        if entry is not None:
+            _leave(self._groups, entry)
+            self._add_demand(entry, -1)
+        return entry
+
+    def peek(self) -> Optional[QueuedDeployment]:
+        heap = self._heap
+        while heap:
+            key, deployment_id = heap[0]
+            entry = self._entries.get(deployment_id)
+            if entry is not None and entry.rank == key:
+                return entry
+            heapq.heappop(heap)
+        return None
+
+    def pop(self) -> Optional[QueuedDeployment]:
+        entry = self.peek()
+        if entry is not None:
+            heapq.heappop(self._heap)
+            del self._entries[entry.id]
+            _leave(self._groups, entry)
+            self._add_demand(entry, -1)
+        return entry
+
+    def group(self, deployment: QueuedDeployment) -> List[QueuedDeployment]:
+        """The queued members of deployment's group, deployment first, or just deployment if it has none."""
+        if deployment.group_id is None:
+            return [deployment]
+        others = sorted(self._groups.get(deployment.group_id, ()))
+        return [deployment] + [self._entries[i] for i in others if i != deployment.id]
+
+    def running_group(self, deployment: QueuedDeployment) -> List[QueuedDeployment]:
+        """The running members of deployment's group, deployment first, or just deployment if it has none."""
+        if deployment.group_id is None:
+            return [deployment]
+        others = sorted(self._running_groups.get(deployment.group_id, ()))
+        return [deployment] + [self.running[i] for i in others if i != deployment.id]
+
+    def fits(self, deployment: QueuedDeployment) -> bool:
+        return (self.available_ram >= deployment.ram_required and
+                self.available_cpu >= deployment.cpu_required and
+                self.available_gpu >= deployment.gpu_required)
+
+    def allocate(self, deployment: QueuedDeployment):
+        self.set_available(self.available_ram - deployment.ram_required,
+                           self.available_cpu - deployment.cpu_required,
+                           self.available_gpu - deployment.gpu_required)
+
+    def release(self, deployment: QueuedDeployment):
+        self.set_available(self.available_ram + deployment.ram_required,
+                           self.available_cpu + deployment.cpu_required,
+                           self.available_gpu + deployment.gpu_required)
+
+    def start(self, deployment: QueuedDeployment):
+        self.allocate(deployment)
+        self.track_running(deployment)
+
+    def track_running(self, deployment: QueuedDeployment):
+        # Tracked again, it takes a new place in the eviction order rather than a second one
+        self._untrack(deployment.id)
+        key = (deployment.priority, -next(self._start_seq), deployment.id)
+        self.running[deployment.id] = deployment
+        _join(self._running_groups, deployment)
+        self._eviction_keys[deployment.id] = key
+        insort(self._eviction_order, key)
+        if self.index is not None:
+            self.index.update(self)
+
+    def stop(self, deployment_id: int) -> Optional[QueuedDeployment]:
+        deployment = self._untrack(deployment_id)
+        if deployment is not None:
+            self.release(deployment)
+        return deployment
+
+    def _untrack(self, deployment_id: int) -> Optional[QueuedDeployment]:
+        deployment = self.running.pop(deployment_id, None)
+        if deployment is not None:
+            key = self._eviction_keys.pop(deployment_id)
+            del self._eviction_order[bisect_left(self._eviction_order, key)]
+            _leave(self._running_groups, deployment)
+        return deployment
+
+    def select_victims(self, deployment: QueuedDeployment) -> Optional[List[QueuedDeployment]]:
+        """Cheapest set of lower priority running deployments whose eviction lets deployment fit.
+
+        Walks running deployments from the least valuable up, taking only those
+        that free a resource that is still short, then drops any victim the
+        others already cover. A group member is only taken together with the
+        rest of its running group. Returns None when even evicting everything
+        eligible would not be enough.
+        """
+        short = [deployment.ram_required - self.available_ram,
+                 deployment.cpu_required - self.available_cpu,
+                 deployment.gpu_required - self.available_gpu]
+        if max(short) <= 0:
+            return []
+        if (deployment.ram_required > self.total_ram or deployment.cpu_required > self.total_cpu or
+                deployment.gpu_required > self.total_gpu):
+            return None
+
+        units = []
+        taken = set()
+        for priority, _, deployment_id in self._eviction_order:
+            if priority >= deployment.priority:
+                return None
+            if deployment_id in taken:
+                continue
+            unit = self.running_group(self.running[deployment_id])
+            whole = combined(unit)
+            freed = (whole.ram_required, whole.cpu_required, whole.gpu_required)
+            if not any(missing > 0 and amount > 0 for missing, amount in zip(short, freed)):
+                continue
+            units.append((unit, freed))
+            taken.update(victim.id for victim in unit)
+            short = [missing - amount for missing, amount in zip(short, freed)]
+            if max(short) <= 0:
+                break
+        else:
+            return None
+
+        for unit, freed in reversed(list(units)):
+            if all(missing + amount <= 0 for missing, amount in zip(short, freed)):
+                units.remove((unit, freed))
+                short = [missing + amount for missing, amount in zip(short, freed)]
+        return [victim for unit, _ in units for victim in unit]
+
+    def set_available(self, ram: int, cpu: int, gpu: int):
+        self.available_ram = ram
+        self.available_cpu = cpu
+        self.available_gpu = gpu
+        if self.index is not None:
+            self.index.update(self)
+
+    def headroom(self) -> Tuple[int, int, int]:
+        """Capacity left once everything already queued has been admitted."""
+        return (self.available_ram - self.queued_ram,
+                self.available_cpu - self.queued_cpu,
+                self.available_gpu - self.queued_gpu)
+
+    def _add_demand(self, deployment: QueuedDeployment, sign: int):
+        self.queued_ram += sign * deployment.ram_required
+        self.queued_cpu += sign * deployment.cpu_required
+        self.queued_gpu += sign * deployment.gpu_required
+        if self.index is not None:
+            self.index.update(self)
+
+    def _compact(self):
+        # Stale heap entries are normally discarded by peek(); rebuild only when
+        # they dominate the heap so memory stays proportional to the queue.
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(d.rank, d.id) for d in self._entries.values()]
+            heapq.heapify(self._heap)
+
+
+def _join(groups: Dict[str, Set[int]], deployment: QueuedDeployment):
+    if deployment.group_id is not None:
+        groups.setdefault(deployment.group_id, set()).add(deployment.id)
+
+
+def _leave(groups: Dict[str, Set[int]], deployment: QueuedDeployment):
+    members = groups.get(deployment.group_id) if deployment.group_id is not None else None
+    if members is not None:
+        members.discard(deployment.id)
+        if not members:
+            del groups[deployment.group_id]
+
+
+class SchedulerEngine:
+    """In-memory scheduling state for every cluster.
+
+    Clusters are loaded from the database the first time they are touched (or
+    all at once by load()), after which queued and running deployments are
+    maintained incrementally so scheduling decisions never re-read the
+    deployments table. That holds for the clusters this worker owns; clusters
+    owned by other workers change behind its back, so placement re-reads them
+    every SCHEDULER_REMOTE_REFRESH seconds.
+    """
+
+    def __init__(self):
+        self.clusters: Dict[int, ClusterQueue] = {}
+        self.organizations: Dict[int, PlacementIndex] = {}
+        # Organizations whose every cluster is in memory, so their index can be trusted
+        self._loaded_organizations: Set[int] = set()
+        # When each organization's clusters were read, to age out other workers' clusters
+        self._organization_loaded_at: Dict[int, float] = {}
+        # Ids for stand-in entries that hold demand of deployments not inserted yet
+        self._provisional_ids = itertools.count(-1, -1)
+
+    def reset(self):
+        self.clusters.clear()
+        self.organizations.clear()
+        self._loaded_organizations.clear()
+        self._organization_loaded_at.clear()
+
+    def load(self, db: Session):
+        self.reset()
+        for cluster in db.query(Cluster).all():
+            self.add_cluster(cluster)
+            self._loaded_organizations.add(cluster.organization_id)
+            self._organization_loaded_at[cluster.organization_id] = time.monotonic()
+        active = db.query(Deployment).filter(
+            Deployment.status.in_([DeploymentStatus.QUEUED, DeploymentStatus.RUNNING])
+        ).order_by(Deployment.id)
+        for deployment in active:
+            queue = self.clusters.get(deployment.cluster_id)
+            if queue is not None:
+                self._track(queue, deployment)
+
+    def add_cluster(self, cluster: Cluster) -> ClusterQueue:
+        queue = self.clusters.get(cluster.id)
+        if queue is None:
+            queue = ClusterQueue(cluster.id, cluster.available_ram or 0, cluster.available_cpu or 0,
+                                 cluster.available_gpu or 0, organization_id=cluster.organization_id,
+                                 total_ram=cluster.total_ram or 0, total_cpu=cluster.total_cpu or 0,
+                                 total_gpu=cluster.total_gpu or 0, name=cluster.name)
+            self.clusters[cluster.id] = queue
+            index = self.organizations.get(cluster.organization_id)
+            if index is None:
+                index = self.organizations[cluster.organization_id] = PlacementIndex()
+            queue.index = index
+        queue.set_available(cluster.available_ram or 0, cluster.available_cpu or 0, cluster.available_gpu or 0)
+        return queue
+
+    def _load_clusters(self, db: Session, clusters: List[Cluster]):
+        clusters = [cluster for cluster in clusters if cluster.id not in self.clusters]
+        if not clusters:
+            return
+        for cluster in clusters:
+            self.add_cluster(cluster)
+        active = db.query(Deployment).filter(
+            Deployment.cluster_id.in_([cluster.id for cluster in clusters]),
+            Deployment.status.in_([DeploymentStatus.QUEUED, DeploymentStatus.RUNNING])
+        ).order_by(Deployment.id)
+        for deployment in active:
+            self._track(self.clusters[deployment.cluster_id], deployment)
+
+    @staticmethod
+    def _track(queue: ClusterQueue, deployment: Deployment):
+        # Running deployments already hold their resources in the clusters table
+        if deployment.status == DeploymentStatus.RUNNING:
+            queue.track_running(QueuedDeployment.from_model(deployment))
+        else:
+            queue.push(QueuedDeployment.from_model(deployment))
+
+    def queue_for(self, db: Session, cluster_id: int) -> Optional[ClusterQueue]:
+        queue = self.clusters.get(cluster_id)
+        if queue is not None:
+            return queue
+
+        cluster = db.get(Cluster, cluster_id)
+        if cluster is None:
+            return None
+        self._load_clusters(db, [cluster])
+        return self.clusters[cluster_id]
+
+    def organization(self, db: Session, organization_id: int) -> Optional[PlacementIndex]:
+        """The organization's index with every one of its clusters in memory, or None if it has none."""
+        if not sharding.owns_every_cluster():
+            self._expire_remote(organization_id)
+        if organization_id not in self._loaded_organizations:
+            self._load_clusters(db, db.query(Cluster).filter(Cluster.organization_id == organization_id).all())
+            self._loaded_organizations.add(organization_id)
+            self._organization_loaded_at[organization_id] = time.monotonic()
+        return self.organizations.get(organization_id)
+
+    def place(self, db: Session, organization_id: int, ram: int, cpu: int, gpu: int,
+              policy: str = PLACEMENT_POLICY) -> Optional[ClusterQueue]:
+        """Pick the organization's cluster a new deployment should be queued on."""
+        index = self.organization(db, organization_id)
+        if index is None:
+            return None
+        return index.choose(ram, cpu, gpu, policy)
+
+    def place_many(self, db: Session, organization_id: int, requests: List[Tuple[Optional[int], int, int, int]],
+                   policy: str = PLACEMENT_POLICY) -> List[Optional[ClusterQueue]]:
+        """Resolve the clusters of a batch of (cluster_id, ram, cpu, gpu) requests.
+
+        Requests naming a cluster keep it and the others are placed like
+        place(), each one seeing the demand of the requests before it.
+        """
+        placed = []
+        for cluster_id, ram, cpu, gpu in requests:
+            if cluster_id is None:
+                queue = self.place(db, organization_id, ram, cpu, gpu, policy)
+            else:
+                queue = self.queue_for(db, cluster_id)
+            entry = None
+            if queue is not None:
+                entry = QueuedDeployment(next(self._provisional_ids), queue.cluster_id, 0, ram, cpu, gpu)
+                queue.push(entry)
+            placed.append((queue, entry))
+        for queue, entry in placed:
+            if entry is not None:
+                queue.remove(entry.id)
+        return [queue for queue, _ in placed]
+
+    def enqueue(self, db: Session, deployment: Deployment) -> Optional[ClusterQueue]:
+        queue = self.queue_for(db, deployment.cluster_id)
+        if queue is not None:
+            queue.push(QueuedDeployment.from_model(deployment))
+        return queue
+
+    def enqueue_many(self, db: Session, deployments: List[QueuedDeployment]):
+        """Queue deployments that were already inserted."""
+        for deployment in deployments:
+            queue = self.queue_for(db, deployment.cluster_id)
+            if queue is not None:
+                queue.push(deployment)
+
+    def _expire_remote(self, organization_id: int):
+        loaded_at = self._organization_loaded_at.get(organization_id)
+        if loaded_at is None or time.monotonic() - loaded_at <= sharding.SCHEDULER_REMOTE_REFRESH:
+            return
+        del self._organization_loaded_at[organization_id]
+        # Re-read the organization's cluster list too, it may have gained clusters elsewhere
+        self._loaded_organizations.discard(organization_id)
+        index = self.organizations.get(organization_id)
+        for cluster_id in list(index.clusters) if index is not None else []:
+            if not sharding.owns_cluster(cluster_id):
+                self.forget(cluster_id)
+
+    def forget(self, cluster_id: int):
+        queue = self.clusters.pop(cluster_id, None)
+        if queue is not None and queue.index is not None:
+            queue.index.remove(cluster_id)
+            self._loaded_organizations.discard(queue.organization_id)
+
+    def discard(self, cluster_id: int, deployment_id: int):
+        queue = self.clusters.get(cluster_id)
+        if queue is not None:
+            queue.remove(deployment_id)
+
+
+scheduler_engine = SchedulerEngine()
@@ -0,0 +1,113 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.db.database import AsyncSessionLocal
+from app.scheduler import scheduler, sharding
+from app.scheduler.engine import scheduler_engine
+from app.scheduler.models import SchedulerLease
+
+# Elect the process that schedules this shard through a lease in the database,
+# so several API processes can share a shard; the others take over if it dies
+SCHEDULER_LEADER_LEASE = os.getenv('SCHEDULER_LEADER_LEASE', 'false').lower() in ('1', 'true', 'yes')
+# Seconds a lease lasts without renewal; the holder renews it three times per period
+SCHEDULER_LEASE_TTL = float(os.getenv('SCHEDULER_LEASE_TTL', 15))
+if SCHEDULER_LEASE_TTL <= 0:
+    raise ValueError(f"SCHEDULER_LEASE_TTL must be positive, got {SCHEDULER_LEASE_TTL}")
+
+# Unique per process, including restarts that reuse a pid
+HOLDER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def lease_name(shard: int) -> str:
+    return f"scheduler:{shard}"
+
+
+def try_acquire(db: Session, name: str, holder: str, ttl: float, now: float = None) -> bool:
+    """Take the lease if it is free or expired, or renew it if holder has it.
+
+    Returns whether holder has the lease for the next ttl seconds. Both the
+    conditional update and the insert of a new lease are atomic, so two
+    processes can never both succeed. Expiry compares wall clocks, which must
+    therefore agree across hosts to well within the ttl.
+    """
+    now = time.time() if now is None else now
+    updated = db.query(SchedulerLease).filter(
+        SchedulerLease.name == name,
+        or_(SchedulerLease.holder == holder, SchedulerLease.expires_at < now)
+    ).update({SchedulerLease.holder: holder, SchedulerLease.expires_at: now + ttl}, synchronize_session=False)
+    if not updated:
+        db.add(SchedulerLease(name=name, holder=holder, expires_at=now + ttl))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Someone else holds it
+            db.rollback()
+            return False
+        return True
+    db.commit()
+    return True
+
+
+def release(db: Session, name: str, holder: str):
+    db.query(SchedulerLease).filter(SchedulerLease.name == name, SchedulerLease.holder == holder).update(
+        {SchedulerLease.expires_at: 0.0}, synchronize_session=False)
+    db.commit()
+
+
+async def _step_down(processor: asyncio.Task):
+    sharding.scheduling = False
+    processor.cancel()
+    await asyncio.gather(processor, return_exceptions=True)
+    await scheduler.stop_passes()
+    # The next leader owns these queues now; reload them if leadership comes back
+    scheduler_engine.reset()
+
+
+async def lead_scheduler():
+    """Compete for this shard's lease and run the scheduler while holding it.
+
+    Runs until cancelled, then stops scheduling and gives the lease up so a
+    standby can take over at once. If the lease cannot be renewed, scheduling
+    stops a renewal period before it would expire, so two processes never
+    schedule the same shard.
+    """
+    name = lease_name(sharding.SCHEDULER_WORKER_ID)
+    processor = None
+    held_until = 0.0
+    try:
+        while True:
+            started = time.time()
+            try:
+                async with AsyncSessionLocal() as db:
+                    held = await db.run_sync(try_acquire, name, HOLDER, SCHEDULER_LEASE_TTL, started)
+                if held:
+                    held_until = started + SCHEDULER_LEASE_TTL
+            except Exception as e:
+                print(f"Renewing scheduler lease {name} failed: {e}")
+                held = time.time() < held_until - SCHEDULER_LEASE_TTL / 3
+
+            if held and processor is not None and processor.done():
+                # The processor died (its exception is printed by asyncio); start over
+                await _step_down(processor)
+                processor = None
+            if held and processor is None:
+                print(f"{HOLDER} now schedules shard {sharding.SCHEDULER_WORKER_ID}")
+                sharding.scheduling = True
+                processor = asyncio.create_task(scheduler.run_deployment_processor())
+            elif not held and processor is not None:
+                print(f"{HOLDER} lost the lease for shard {sharding.SCHEDULER_WORKER_ID}, stopping")
+                await _step_down(processor)
+                processor = None
+            await asyncio.sleep(SCHEDULER_LEASE_TTL / 3)
+    finally:
+        if processor is not None:
+            await _step_down(processor)
+            async with AsyncSessionLocal() as db:
+                await db.run_sync(release, name, HOLDER)
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, Float, String
+from app.db.database import Base
+
+
+class Preemption(Base):
+    __tablename__ = "preemptions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cluster_id = Column(Integer, ForeignKey("clusters.id"), index=True)
+    deployment_id = Column(Integer, ForeignKey("deployments.id"), index=True)
+    deployment_priority = Column(Integer)
+    preempted_by_id = Column(Integer, ForeignKey("deployments.id"))
+    preempted_by_priority = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class SchedulerLease(Base):
+    """Which process schedules a shard, until expires_at (Unix seconds) unless renewed."""
+    __tablename__ = "scheduler_leases"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires_at = Column(Float, nullable=False)
@@ -0,0 +1,143 @@
+import os
+from bisect import bisect_left, insort
+from itertools import islice
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+
+from app.scheduler.capacity import RESOURCES, CapacityTotals, Snapshot, snapshot
+
+if TYPE_CHECKING:
+    from app.scheduler.engine import ClusterQueue
+
+# Scoring policy used when a deployment is submitted without a cluster_id
+PLACEMENT_POLICY = os.getenv('PLACEMENT_POLICY', 'best_fit')
+# Fitting clusters scored per placement; the walk starts from the tightest fit
+PLACEMENT_CANDIDATE_LIMIT = int(os.getenv('PLACEMENT_CANDIDATE_LIMIT', 32))
+# Clusters looked at per placement, fitting or not, before falling back to the shortest queue
+PLACEMENT_SCAN_LIMIT = int(os.getenv('PLACEMENT_SCAN_LIMIT', 256))
+
+
+def _leftover_shares(queue: 'ClusterQueue', ram: int, cpu: int, gpu: int) -> Tuple[float, float, float]:
+    return tuple(
+        (headroom - demand) / total if total else 0.0
+        for headroom, demand, total in zip(
+            queue.headroom(), (ram, cpu, gpu), (queue.total_ram, queue.total_cpu, queue.total_gpu)
+        )
+    )
+
+
+def best_fit(queue: 'ClusterQueue', ram: int, cpu: int, gpu: int) -> float:
+    # Smallest total leftover, each resource normalised by the cluster's size
+    return sum(_leftover_shares(queue, ram, cpu, gpu))
+
+
+def dominant_resource(queue: 'ClusterQueue', ram: int, cpu: int, gpu: int) -> float:
+    # Smallest leftover on the cluster's most abundant resource, so no single
+    # dimension is left stranded while the others run out
+    return max(_leftover_shares(queue, ram, cpu, gpu))
+
+
+PLACEMENT_POLICIES: Dict[str, Callable[..., float]] = {
+    'best_fit': best_fit,
+    'dominant_resource': dominant_resource,
+}
+
+
+def placement_policy(name: str) -> Callable[..., float]:
+    if name not in PLACEMENT_POLICIES:
+        raise ValueError(f"Unknown PLACEMENT_POLICY {name!r}, expected one of {sorted(PLACEMENT_POLICIES)}")
+    return PLACEMENT_POLICIES[name]
+
+
+placement_policy(PLACEMENT_POLICY)
+
+
+class PlacementIndex:
+    """Headroom of one organization's clusters, kept sorted per resource.
+
+    Headroom is free capacity minus the demand already queued, so a cluster
+    qualifies only if the new deployment could start once its queue drains.
+    A lookup bisects each resource list to count the clusters with enough of
+    that resource and walks the most selective one from its tightest fit,
+    scoring at most PLACEMENT_CANDIDATE_LIMIT clusters that fit. Clusters in
+    that list can still fall short on another resource, so the walk also
+    stops after PLACEMENT_SCAN_LIMIT clusters, fitting or not. When nothing
+    fits within it, clusters are tried in order of queue length and the
+    first one large enough wins, so a saturated fleet is not scanned either.
+
+    The same updates keep the organization's capacity totals current.
+    """
+
+    def __init__(self):
+        self.clusters: Dict[int, 'ClusterQueue'] = {}
+        self._sorted: Dict[str, List[Tuple[int, int]]] = {resource: [] for resource in RESOURCES}
+        self._by_backlog: List[Tuple[int, int]] = []
+        self._keys: Dict[int, Tuple[Tuple[int, int, int], int]] = {}
+        self.totals = CapacityTotals()
+        self._snapshots: Dict[int, Snapshot] = {}
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def update(self, queue: 'ClusterQueue'):
+        current = snapshot(queue)
+        previous = self._snapshots.get(queue.cluster_id)
+        if current != previous:
+            self.totals.apply(previous, current)
+            self._snapshots[queue.cluster_id] = current
+
+        headroom, backlog = queue.headroom(), len(queue)
+        if self._keys.get(queue.cluster_id) == (headroom, backlog):
+            return
+        self._unlink(queue.cluster_id)
+        for resource, available in zip(RESOURCES, headroom):
+            insort(self._sorted[resource], (available, queue.cluster_id))
+        insort(self._by_backlog, (backlog, queue.cluster_id))
+        self._keys[queue.cluster_id] = (headroom, backlog)
+        self.clusters[queue.cluster_id] = queue
+
+    def remove(self, cluster_id: int):
+        self._unlink(cluster_id)
+        self.clusters.pop(cluster_id, None)
+        previous = self._snapshots.pop(cluster_id, None)
+        if previous is not None:
+            self.totals.apply(previous, None)
+
+    def _unlink(self, cluster_id: int):
+        key = self._keys.pop(cluster_id, None)
+        if key is None:
+            return
+        headroom, backlog = key
+        for resource, available in zip(RESOURCES, headroom):
+            entries = self._sorted[resource]
+            del entries[bisect_left(entries, (available, cluster_id))]
+        del self._by_backlog[bisect_left(self._by_backlog, (backlog, cluster_id))]
+
+    def candidates(self, ram: int, cpu: int, gpu: int) -> Iterator['ClusterQueue']:
+        starts = {
+            resource: bisect_left(self._sorted[resource], (demand, -1))
+            for resource, demand in zip(RESOURCES, (ram, cpu, gpu))
+        }
+        resource = min(RESOURCES, key=lambda r: len(self._sorted[r]) - starts[r])
+        entries = self._sorted[resource]
+        for index in range(starts[resource], min(len(entries), starts[resource] + PLACEMENT_SCAN_LIMIT)):
+            queue = self.clusters[entries[index][1]]
+            headroom_ram, headroom_cpu, headroom_gpu = queue.headroom()
+            if headroom_ram >= ram and headroom_cpu >= cpu and headroom_gpu >= gpu:
+                yield queue
+
+    def choose(self, ram: int, cpu: int, gpu: int, policy: str = PLACEMENT_POLICY) -> Optional['ClusterQueue']:
+        score = placement_policy(policy)
+        best, best_score = None, None
+        for queue in islice(self.candidates(ram, cpu, gpu), PLACEMENT_CANDIDATE_LIMIT):
+            candidate_score = score(queue, ram, cpu, gpu)
+            if best is None or candidate_score < best_score:
+                best, best_score = queue, candidate_score
+        if best is not None:
+            return best
+
+        # Nothing can start right away: queue where it can eventually run with the least backlog
+        for _, cluster_id in self._by_backlog:
+            queue = self.clusters[cluster_id]
+            if queue.total_ram >= ram and queue.total_cpu >= cpu and queue.total_gpu >= gpu:
+                return queue
+        return None
@@ -1,162 +1,403 @@
 import asyncio
 import os
+import time
+from typing import Dict, List, Optional, Set
 
-import pika
-import json
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-import aio_pika
-from app.db.database import SessionLocal
-from app.deployments.models import Deployment, DeploymentStatus
+from app.db.database import AsyncSessionLocal
+from app.deployments import timeline
+from app.db.versions import versions
+from app.deployments.feed import status_feed
+from app.deployments.models import Deployment, DeploymentEvent, DeploymentStage, DeploymentStatus
 from app.clusters.models import Cluster
+from app.metrics.registry import SCHEDULER_ADMITTED, SCHEDULER_CONFLICTS, SCHEDULER_PASS_DURATION, TIME_TO_SCHEDULE
+from app.scheduler import sharding
+from app.scheduler.broker import BrokerMessage, deployment_broker
+from app.scheduler.engine import ClusterQueue, QueuedDeployment, combined, scheduler_engine
+from app.scheduler.models import Preemption
 
 
+class CapacityConflict(Exception):
+    """A cluster had less free capacity in the database than the scheduler believed."""
 
-# async def schedule_deployment(db: Session, deployment_id: int):
-#     # Connect to RabbitMQ
-#
-#     connection = await aio_pika.connect_robust(host='rabbitmq',
-#                                                port=5672,
-#                                                login='guest',
-#                                                password='guest')
-#
-#     channel = connection.channel()
-#
-#     # Declare a queue
-#     channel.declare_queue(name='deployment_queue')
-#
-#     channel.publish(
-#         exchange='',
-#         routing_key='deployment_queue',
-#         body=json.dumps({'deployment_id': deployment_id})
-#     )
 
-    #
-    #
-    #
-    # await connection.close()
+async def schedule_deployment(deployment_id: int, cluster_id: int, trace_id: Optional[str] = None):
+    # Hand the message to the worker that owns the cluster; it is delivered in the background
+    try:
+        deployment_broker.publish({'cluster_id': cluster_id, 'deployment_ids': [deployment_id],
+                                   'trace_id': trace_id, 'published_at': time.time()},
+                                  shard=sharding.shard_for(cluster_id))
+    except asyncio.QueueFull:
+        if sharding.owns_cluster(cluster_id):
+            # The router already queued the deployment in the engine; schedule it from there directly
+            print(f"Publish backlog full, scheduling deployment {deployment_id} in-process")
+            wake_cluster(cluster_id)
+        else:
+            print(f"Publish backlog full, deployment {deployment_id} waits for worker "
+                  f"{sharding.shard_for(cluster_id)} to reload cluster {cluster_id}")
+        return
 
+    print(f"Deployment {deployment_id} scheduled (trace {trace_id})")
 
 
+async def run_deployment_processor():
+    # Rebuild the in-memory queues once; messages keep them up to date afterwards
+    async with AsyncSessionLocal() as db:
+        await db.run_sync(scheduler_engine.load)
+    for cluster_id, queue in scheduler_engine.clusters.items():
+        if len(queue) and sharding.owns_cluster(cluster_id):
+            wake_cluster(cluster_id)
 
+    async def on_message(message: BrokerMessage):
+        payload = message.payload
+        # Messages published before sharding carry a single deployment_id
+        deployment_ids = payload.get("deployment_ids", [payload["deployment_id"]] if "deployment_id" in payload else [])
+        print(f"Processing deployments: {deployment_ids} (trace {payload.get('trace_id')})")
+        try:
+            async with AsyncSessionLocal() as db:
+                await process_deployments(db, deployment_ids, payload.get("published_at"))
+                # Their ENQUEUED and DEQUEUED events
+                await db.commit()
+            if not deployment_ids and "cluster_id" in payload:
+                wake_cluster(payload["cluster_id"])
+        except Exception as e:
+            # Not requeued: the deployments are still in the database and reload with the engine
+            print(f"Processing deployments {deployment_ids} failed: {e}")
+            await deployment_broker.nack(message, requeue=False)
+            return
+        await deployment_broker.ack(message)
 
-async def schedule_deployment(db: Session, deployment_id: int):
-    # Connect to RabbitMQ
+    print(f"Worker {sharding.SCHEDULER_WORKER_ID} of {sharding.SCHEDULER_WORKERS} waiting for deployments. "
+          f"To exit press CTRL+C")
+    await deployment_broker.consume(on_message, shard=sharding.SCHEDULER_WORKER_ID)
 
-    max_retries = 5
-    retry_delay = 5
 
-    for attempt in range(max_retries):
-        try:
-            connection = await aio_pika.connect_robust(
-                host=os.getenv('RABBITMQ_HOST', 'localhost'),
-                port=int(os.getenv('RABBITMQ_PORT', 5672)),
-                login=os.getenv('RABBITMQ_USER', 'guest'),
-                password=os.getenv('RABBITMQ_PASSWORD', 'guest')
-            )
-            return
-        except Exception as e:
-            print(f"Failed to connect to RabbitMQ (attempt {attempt + 1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay)
-            else:
-                print("Max retries reached. Unable to connect to RabbitMQ.")
+# Wake-ups arriving within this window are folded into the same pass
+SCHEDULER_COALESCE_DELAY = float(os.getenv('SCHEDULER_COALESCE_MS', 5)) / 1000
+# Upper bound on admissions per transaction; a full batch re-arms the pass
+SCHEDULER_MAX_BATCH = int(os.getenv('SCHEDULER_MAX_BATCH', 500))
+# Let a deployment that does not fit evict lower priority running deployments
+SCHEDULER_PREEMPTION = os.getenv('SCHEDULER_PREEMPTION', 'false').lower() in ('1', 'true', 'yes')
+# Passes retried after reloading a cluster whose capacity changed underneath them
+SCHEDULER_CONFLICT_RETRIES = int(os.getenv('SCHEDULER_CONFLICT_RETRIES', 3))
+
+_dirty_clusters: Set[int] = set()
+_pass_tasks: Dict[int, asyncio.Task] = {}
+
 
-    async with connection:
-        # Creating channel
-        channel = await connection.channel()
+async def process_deployment(db: AsyncSession, deployment_id: int, published_at: Optional[float] = None):
+    await process_deployments(db, [deployment_id], published_at)
 
-        # Declaring queue
-        queue = await channel.declare_queue('deployment_queue')
 
-        # Publishing message
-        await channel.default_exchange.publish(
-            aio_pika.Message(body=json.dumps({'deployment_id': deployment_id}).encode()),
-            routing_key='deployment_queue'
-        )
+async def process_deployments(db: AsyncSession, deployment_ids: List[int], published_at: Optional[float] = None):
+    """Bring this worker's queues up to date with the deployments a message names.
 
-    print(f"Deployment {deployment_id} scheduled")
+    They are read in one query and pushed without awaiting in between, so the
+    members of a group published in one message never reach a pass without
+    each other.
+    """
+    if not deployment_ids:
+        return
+    result = await db.execute(select(Deployment).filter(Deployment.id.in_(deployment_ids)))
+    found = {deployment.id: deployment for deployment in result.scalars()}
+    deployments = []
+    forwarded: Dict[int, List[int]] = {}
+    for deployment_id in deployment_ids:
+        deployment = found.get(deployment_id)
+        if not deployment:
+            print(f"Deployment {deployment_id} not found.")
+        elif not sharding.owns_cluster(deployment.cluster_id):
+            # Sent here before the workers were resized; pass it on to the owner
+            forwarded.setdefault(deployment.cluster_id, []).append(deployment_id)
+        else:
+            deployments.append(deployment)
+    for cluster_id, ids in forwarded.items():
+        notify_cluster(cluster_id, ids)
 
+    queues = {}
+    for cluster_id in {deployment.cluster_id for deployment in deployments}:
+        queues[cluster_id] = await db.run_sync(scheduler_engine.queue_for, cluster_id)
 
+    for deployment in deployments:
+        queue = queues[deployment.cluster_id]
+        if queue is None:
+            print(f"Cluster for Deployment {deployment.id} not found.")
+            continue
+        if deployment.status == DeploymentStatus.RUNNING:
+            continue
+        if deployment.status != DeploymentStatus.QUEUED:
+            # Finished through another worker: give back what it held here as well
+            if queue.stop(deployment.id) is None:
+                queue.remove(deployment.id)
+        elif deployment.id in queue.running:
+            # Read as queued, but a pass started it while this message awaited its queues; the running
+            # set, not the row, is what tells, and pushing it would start it twice
+            continue
+        else:
+            if published_at is not None:
+                db.add(DeploymentEvent(**timeline.event(deployment.id, deployment.cluster_id,
+                                                        DeploymentStage.ENQUEUED, at=published_at)))
+            db.add(DeploymentEvent(**timeline.event(deployment.id, deployment.cluster_id, DeploymentStage.DEQUEUED)))
+            queue.push(QueuedDeployment.from_model(deployment))
+        wake_cluster(deployment.cluster_id)
 
-async def run_deployment_processor():
-    # Connect to RabbitMQ
-    max_retries = 5
-    retry_delay = 5  # seconds
 
-    for attempt in range(max_retries):
-        try:
-            connection = await aio_pika.connect_robust(
-                host=os.getenv('RABBITMQ_HOST', 'localhost'),
-                port=int(os.getenv('RABBITMQ_PORT', 5672)),
-                login=os.getenv('RABBITMQ_USER', 'guest'),
-                password=os.getenv('RABBITMQ_PASSWORD', 'guest')
-            )
-            return
-        except Exception as e:
-            print(f"Failed to connect to RabbitMQ (attempt {attempt + 1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay)
-            else:
-                print("Max retries reached. Unable to connect to RabbitMQ.")
-
-    async with connection:
-        channel = await connection.channel()
-        await channel.set_qos(prefetch_count=1)
-        queue = await channel.declare_queue("deployment_queue")
-        async def on_message(message: aio_pika.IncomingMessage):
-            async with message.process():
-                deployment_data = json.loads(message.body)
-                deployment_id = deployment_data["deployment_id"]
-                print(f"Processing deployment: {deployment_id}")
-                db = SessionLocal()
-                try:
-                    await process_deployment(db, deployment_id)
-                finally:
-                    db.close()
-        await queue.consume(on_message)
-        print("Waiting for deployments. To exit press CTRL+C")
-
-        await asyncio.Future()  # Run forever
-
-
-async def process_deployment(db: Session, deployment_id: int):
-    deployment = db.query(Deployment).filter(Deployment.id == deployment_id).first()
-    if not deployment:
-        print(f"Deployment {deployment_id} not found.")
+def finish_deployment(db: Session, deployment: Deployment, status: DeploymentStatus) -> bool:
+    """Move a queued or running deployment to a final status and free what it holds.
+
+    The status change is guarded by the status that was read, and the cluster's
+    resources are returned in the same transaction, so concurrent calls cannot
+    release twice. Returns False if the deployment changed state in between.
+    """
+    previous = deployment.status
+    updated = db.query(Deployment).filter(
+        Deployment.id == deployment.id,
+        Deployment.status == previous
+    ).update({Deployment.status: status}, synchronize_session=False)
+    if not updated:
+        db.rollback()
+        return False
+
+    timeline.record(db, [timeline.event(deployment.id, deployment.cluster_id, DeploymentStage.FINISHED,
+                                        reason=status.value)])
+    if previous == DeploymentStatus.RUNNING:
+        db.query(Cluster).filter(Cluster.id == deployment.cluster_id).update({
+            Cluster.available_ram: Cluster.available_ram + deployment.ram_required,
+            Cluster.available_cpu: Cluster.available_cpu + deployment.cpu_required,
+            Cluster.available_gpu: Cluster.available_gpu + deployment.gpu_required,
+        }, synchronize_session=False)
+    db.commit()
+    status_feed.wake()
+
+    queue = scheduler_engine.clusters.get(deployment.cluster_id)
+    if queue is not None and sharding.owns_cluster(deployment.cluster_id):
+        if queue.stop(deployment.id) is None:
+            queue.remove(deployment.id)
+    # Freed capacity, or a removed queue head, may let waiting deployments start
+    notify_cluster(deployment.cluster_id, [deployment.id])
+    print(f"Deployment {deployment.id} {previous.value} -> {status.value} on cluster {deployment.cluster_id}")
+    return True
+
+
+def wake_cluster(cluster_id: int):
+    """Request a scheduling pass for a cluster.
+
+    At most one pass task exists per cluster; wake-ups that arrive while it is
+    waiting or running only mark the cluster dirty, so a burst of submissions
+    collapses into a handful of passes. Clusters owned by another worker are
+    handed to it instead.
+    """
+    if not sharding.owns_cluster(cluster_id):
+        notify_cluster(cluster_id)
         return
+    _dirty_clusters.add(cluster_id)
+    if cluster_id not in _pass_tasks:
+        _pass_tasks[cluster_id] = asyncio.get_running_loop().create_task(_run_passes(cluster_id))
+
+
+async def stop_passes():
+    """Cancel every pending scheduling pass, for when this process stops scheduling."""
+    tasks = list(_pass_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _dirty_clusters.clear()
+
+
+def notify_cluster(cluster_id: int, deployment_ids: List[int] = ()):
+    """Tell the worker that owns a cluster that its deployments changed.
 
-    cluster = db.query(Cluster).filter(Cluster.id == deployment.cluster_id).first()
-    if not cluster:
-        print(f"Cluster for Deployment {deployment_id} not found.")
+    This worker passes through wake_cluster; the caller has already updated
+    its engine. Others get a message naming the deployments to re-read.
+    """
+    if sharding.owns_cluster(cluster_id):
+        wake_cluster(cluster_id)
         return
+    try:
+        deployment_broker.publish({'cluster_id': cluster_id, 'deployment_ids': list(deployment_ids)},
+                                  shard=sharding.shard_for(cluster_id))
+    except asyncio.QueueFull:
+        print(f"Publish backlog full, worker {sharding.shard_for(cluster_id)} not told about cluster {cluster_id}")
+
+
+async def _run_passes(cluster_id: int):
+    conflicts = 0
+    try:
+        while cluster_id in _dirty_clusters:
+            await asyncio.sleep(SCHEDULER_COALESCE_DELAY)
+            _dirty_clusters.discard(cluster_id)
+            started = time.perf_counter()
+            try:
+                async with AsyncSessionLocal() as db:
+                    # The pass itself is synchronous code; run_sync keeps its queries off the event loop
+                    admitted = await db.run_sync(run_scheduling_pass, cluster_id)
+            except CapacityConflict:
+                SCHEDULER_CONFLICTS.inc()
+                # Reload the cluster from the database and try again with what is really free
+                scheduler_engine.forget(cluster_id)
+                conflicts += 1
+                if conflicts > SCHEDULER_CONFLICT_RETRIES:
+                    print(f"Scheduling pass for cluster {cluster_id} gave up after {conflicts} capacity conflicts")
+                    break
+                _dirty_clusters.add(cluster_id)
+                continue
+            except Exception as e:
+                # The in-memory queue may be ahead of the database now; reload it next time
+                scheduler_engine.forget(cluster_id)
+                print(f"Scheduling pass for cluster {cluster_id} failed: {e}")
+                break
+            finally:
+                SCHEDULER_PASS_DURATION.observe(time.perf_counter() - started)
+            conflicts = 0
+            if len(admitted) >= SCHEDULER_MAX_BATCH:
+                _dirty_clusters.add(cluster_id)
+    finally:
+        del _pass_tasks[cluster_id]
+
+
+def run_scheduling_pass(db: Session, cluster_id: int) -> List[QueuedDeployment]:
+    """Admit queued deployments of a cluster in priority order while they fit.
+
+    Stops at the first deployment that does not fit so lower priority work
+    never overtakes it, unless preemption is enabled and evicting lower
+    priority running deployments makes room. A deployment group is admitted
+    whole when the combined demand of its queued members fits, and otherwise
+    blocks like a single deployment of that size. All admissions and evictions are
+    written in a single transaction, whose capacity update only applies if the
+    database still has room; otherwise it is rolled back and CapacityConflict
+    raised, leaving the in-memory queue to be reloaded by the caller.
+    """
+    queue = scheduler_engine.queue_for(db, cluster_id)
+    if queue is None:
+        return []
 
-    # Get all queued deployments for this cluster, ordered by priority (highest first)
-    queued_deployments = db.query(Deployment).filter(
-        Deployment.cluster_id == cluster.id,
-        Deployment.status == DeploymentStatus.QUEUED
-    ).order_by(Deployment.priority.desc()).all()
-
-    # Check if there are higher priority deployments
-    higher_priority_exists = any(d.priority > deployment.priority for d in queued_deployments)
-
-    if (cluster.available_ram >= deployment.ram_required and
-            cluster.available_cpu >= deployment.cpu_required and
-            cluster.available_gpu >= deployment.gpu_required and
-            not higher_priority_exists):
-        # Allocate resources and start deployment
-        cluster.available_ram -= deployment.ram_required
-        cluster.available_cpu -= deployment.cpu_required
-        cluster.available_gpu -= deployment.gpu_required
-        deployment.status = DeploymentStatus.RUNNING
+    admitted = []
+    preempted = []
+    blocked = None
+    # Evicted deployments queue again from now, and age from now
+    requeued_at = time.time()
+    while len(admitted) < SCHEDULER_MAX_BATCH:
+        head = queue.peek()
+        if head is None:
+            break
+        members = queue.group(head)
+        need = combined(members)
+        if not queue.fits(need):
+            victims = queue.select_victims(need) if SCHEDULER_PREEMPTION else None
+            if not victims:
+                blocked = (head, need)
+                break
+            # Only evict for a deployment that is really still waiting
+            if not _ids_with_status(db, [head.id], DeploymentStatus.QUEUED):
+                queue.remove(head.id)
+                continue
+            for victim in victims:
+                queue.stop(victim.id)
+                victim.queued_since = requeued_at
+                queue.push(victim)
+                preempted.append((victim, head))
+        for member in members:
+            queue.remove(member.id)
+            queue.start(member)
+            admitted.append(member)
+
+    if admitted:
+        # Deployments that left QUEUED behind the engine's back keep their resources
+        still_queued = _ids_with_status(db, [d.id for d in admitted], DeploymentStatus.QUEUED)
+        for deployment in admitted:
+            if deployment.id not in still_queued:
+                queue.stop(deployment.id)
+        admitted = [d for d in admitted if d.id in still_queued]
+
+    if preempted:
+        # A victim that already stopped elsewhere had its resources returned there
+        still_running = _ids_with_status(db, [victim.id for victim, _ in preempted], DeploymentStatus.RUNNING)
+        for victim, _ in preempted:
+            if victim.id not in still_running:
+                queue.remove(victim.id)
+        preempted = [(victim, by) for victim, by in preempted if victim.id in still_running]
+
+    events = [timeline.event(d.id, cluster_id, DeploymentStage.ADMITTED) for d in admitted]
+    events += [timeline.event(victim.id, cluster_id, DeploymentStage.PREEMPTED, reason=f"by deployment {by.id}")
+               for victim, by in preempted]
+    if blocked is not None and not blocked[0].rejected:
+        # Once per stay in the queue, not on every pass that finds it still waiting
+        head, need = blocked
+        head.rejected = True
+        events.append(timeline.event(head.id, cluster_id, DeploymentStage.REJECTED, reason=_shortfall(queue, need)))
+    timeline.record(db, events)
+
+    if admitted or preempted:
+        if admitted:
+            db.query(Deployment).filter(Deployment.id.in_([d.id for d in admitted])).update(
+                {Deployment.status: DeploymentStatus.RUNNING}, synchronize_session=False)
+        if preempted:
+            db.query(Deployment).filter(Deployment.id.in_([victim.id for victim, _ in preempted])).update(
+                {Deployment.status: DeploymentStatus.QUEUED, Deployment.queued_since: requeued_at},
+                synchronize_session=False)
+            db.bulk_insert_mappings(Preemption, [{
+                "cluster_id": cluster_id,
+                "deployment_id": victim.id,
+                "deployment_priority": victim.priority,
+                "preempted_by_id": by.id,
+                "preempted_by_priority": by.priority,
+            } for victim, by in preempted])
+        victims = [victim for victim, _ in preempted]
+        ram, cpu, gpu = (_delta(victims, admitted, attribute)
+                         for attribute in ("ram_required", "cpu_required", "gpu_required"))
+        updated = db.query(Cluster).filter(
+            Cluster.id == cluster_id,
+            Cluster.available_ram + ram >= 0,
+            Cluster.available_cpu + cpu >= 0,
+            Cluster.available_gpu + gpu >= 0,
+        ).update({
+            Cluster.available_ram: Cluster.available_ram + ram,
+            Cluster.available_cpu: Cluster.available_cpu + cpu,
+            Cluster.available_gpu: Cluster.available_gpu + gpu,
+        }, synchronize_session=False)
+        if not updated:
+            db.rollback()
+            raise CapacityConflict(f"Cluster {cluster_id} cannot give up {-ram} RAM, {-cpu} CPU, {-gpu} GPU")
         db.commit()
-        print(f"Deployment {deployment_id} (priority: {deployment.priority}) started on cluster {cluster.name}")
-    else:
-        # Keep in queue if resources are not available or there are higher priority deployments
-        deployment.status = DeploymentStatus.QUEUED
+        # Statuses on the cluster and its free capacity in the organization's list
+        versions.bump(queue.organization_id, cluster_id)
+        status_feed.wake()
+        now = time.monotonic()
+        SCHEDULER_ADMITTED.inc(len(admitted))
+        for deployment in admitted:
+            TIME_TO_SCHEDULE.observe(now - deployment.queued_at)
+        for victim, by in preempted:
+            print(f"Deployment {victim.id} (priority: {victim.priority}) preempted on cluster {cluster_id} "
+                  f"by deployment {by.id} (priority: {by.priority})")
+        for deployment in admitted:
+            print(f"Deployment {deployment.id} (priority: {deployment.priority}) started on cluster {cluster_id}")
+    elif events:
         db.commit()
-        if higher_priority_exists:
-            print(
-                f"Deployment {deployment_id} (priority: {deployment.priority}) queued due to higher priority deployments")
-        else:
-            print(f"Deployment {deployment_id} (priority: {deployment.priority}) queued due to insufficient resources")
 
+    head = queue.peek()
+    if head is not None and len(admitted) < SCHEDULER_MAX_BATCH:
+        print(f"Cluster {cluster_id}: {len(queue)} deployments queued due to insufficient resources "
+              f"(next: {head.id}, priority: {head.priority})")
+    return admitted
+
+
+def _shortfall(queue: ClusterQueue, deployment: QueuedDeployment) -> str:
+    short = [resource for resource, available, required in (
+        ("ram", queue.available_ram, deployment.ram_required),
+        ("cpu", queue.available_cpu, deployment.cpu_required),
+        ("gpu", queue.available_gpu, deployment.gpu_required),
+    ) if available < required]
+    return "insufficient " + ", ".join(short)
+
+
+def _ids_with_status(db: Session, ids: List[int], status: DeploymentStatus) -> Set[int]:
+    return {deployment_id for (deployment_id,) in db.query(Deployment.id).filter(
+        Deployment.id.in_(ids),
+        Deployment.status == status
+    )}
+
+
+def _delta(released: List[QueuedDeployment], allocated: List[QueuedDeployment], attribute: str) -> int:
+    return sum(getattr(d, attribute) for d in released) - sum(getattr(d, attribute) for d in allocated)
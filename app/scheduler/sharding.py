@@ -0,0 +1,34 @@
+import os
+
+# Scheduler processes splitting the clusters between them, and which one this is.
+# Every process must use the same SCHEDULER_WORKERS and a distinct SCHEDULER_WORKER_ID.
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', 1))
+SCHEDULER_WORKER_ID = int(os.getenv('SCHEDULER_WORKER_ID', 0))
+# Seconds another worker's clusters may be served from memory before being re-read
+SCHEDULER_REMOTE_REFRESH = float(os.getenv('SCHEDULER_REMOTE_REFRESH', 1.0))
+
+if SCHEDULER_WORKERS < 1:
+    raise ValueError(f"SCHEDULER_WORKERS must be at least 1, got {SCHEDULER_WORKERS}")
+if not 0 <= SCHEDULER_WORKER_ID < SCHEDULER_WORKERS:
+    raise ValueError(f"SCHEDULER_WORKER_ID must be between 0 and {SCHEDULER_WORKERS - 1}, got {SCHEDULER_WORKER_ID}")
+
+
+# Whether this process schedules its shard. Always true unless the shard is
+# handed out by lease (see app/scheduler/leader.py), in which case only the
+# lease holder sets it and the other processes serve the API and forward
+# scheduling work to the holder through the broker.
+scheduling = True
+
+
+def shard_for(cluster_id: int) -> int:
+    """The worker that schedules a cluster; only it admits deployments there."""
+    return cluster_id % SCHEDULER_WORKERS
+
+
+def owns_cluster(cluster_id: int) -> bool:
+    return scheduling and shard_for(cluster_id) == SCHEDULER_WORKER_ID
+
+
+def owns_every_cluster() -> bool:
+    """True when no other process changes this one's clusters behind its back."""
+    return scheduling and SCHEDULER_WORKERS == 1
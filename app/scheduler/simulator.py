@@ -0,0 +1,254 @@
+"""What-if replay of the scheduler's admission rules for one cluster.
+
+A snapshot of the cluster's QUEUED and RUNNING deployments is read into NumPy
+arrays, hypothetical capacity and priority changes are applied to the copy,
+and the pass is replayed: deployments start in order of (aged) priority
+while they fit, stopping at the first that does not, optionally preempting lower
+priority running deployments as the scheduler does. A deployment group is
+replayed as one entry with its members' combined demand. Nothing is written to
+the database or to the live scheduler. Run from the command line with:
+
+    python -m app.scheduler.simulator --cluster-id 1 --total-ram 131072 --priority 42=9
+"""
+import argparse
+import json
+import time
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app.clusters.models import Cluster
+from app.deployments.models import Deployment, DeploymentStatus
+from app.scheduler.capacity import RESOURCES
+from app.scheduler.engine import SCHEDULER_PRIORITY_AGING, ClusterQueue, QueuedDeployment, combined, rank
+from app.scheduler.scheduler import SCHEDULER_PREEMPTION
+
+
+@dataclass
+class ClusterSnapshot:
+    cluster_id: int
+    total: np.ndarray       # (3,) ram, cpu, gpu
+    available: np.ndarray   # (3,)
+    ids: np.ndarray         # (n,) ascending
+    priorities: np.ndarray  # (n,)
+    demand: np.ndarray      # (n, 3)
+    running: np.ndarray     # (n,) True for RUNNING, False for QUEUED
+    groups: Optional[np.ndarray] = None  # (n,) group number, -1 outside any group; None if there are none
+    queued_since: Optional[np.ndarray] = None  # (n,) Unix time each entered the queue; None for all now
+
+
+def load_snapshot(db: Session, cluster_id: int) -> Optional[ClusterSnapshot]:
+    cluster = db.get(Cluster, cluster_id)
+    if cluster is None:
+        return None
+    rows = db.execute(select(
+        Deployment.id, func.coalesce(Deployment.priority, 0), func.coalesce(Deployment.ram_required, 0),
+        func.coalesce(Deployment.cpu_required, 0), func.coalesce(Deployment.gpu_required, 0), Deployment.status,
+        Deployment.group_id, Deployment.queued_since
+    ).filter(
+        Deployment.cluster_id == cluster_id,
+        Deployment.status.in_([DeploymentStatus.QUEUED, DeploymentStatus.RUNNING])
+    ).order_by(Deployment.id)).all()
+    values = np.array([row[:5] for row in rows], dtype=np.int64).reshape(-1, 5)
+    numbers: Dict[str, int] = {}
+    groups = [-1 if row[6] is None else numbers.setdefault(row[6], len(numbers)) for row in rows]
+    # Rows queued before aging was recorded age from now, as the scheduler loads them
+    now = time.time()
+    return ClusterSnapshot(
+        cluster_id=cluster.id,
+        total=np.array([cluster.total_ram or 0, cluster.total_cpu or 0, cluster.total_gpu or 0], dtype=np.int64),
+        available=np.array([cluster.available_ram or 0, cluster.available_cpu or 0, cluster.available_gpu or 0],
+                           dtype=np.int64),
+        ids=values[:, 0],
+        priorities=values[:, 1],
+        demand=values[:, 2:5],
+        running=np.array([row[5] == DeploymentStatus.RUNNING for row in rows], dtype=bool),
+        groups=np.array(groups, dtype=np.int64),
+        queued_since=np.array([now if row[7] is None else row[7] for row in rows], dtype=np.float64),
+    )
+
+
+def with_changes(snapshot: ClusterSnapshot, total: Sequence[Optional[int]] = (None, None, None),
+                 priorities: Optional[Dict[int, int]] = None) -> ClusterSnapshot:
+    """A copy with new cluster sizes and deployment priorities.
+
+    Resizing moves free capacity by the same amount, so what is allocated
+    stays allocated; shrinking below it leaves free capacity negative.
+    """
+    new_total = np.array([old if new is None else new for old, new in zip(snapshot.total, total)], dtype=np.int64)
+    new_priorities = snapshot.priorities.copy()
+    if priorities:
+        keys = np.array(list(priorities), dtype=np.int64)
+        positions = np.searchsorted(snapshot.ids, keys)
+        found = positions < len(snapshot.ids)
+        found[found] = snapshot.ids[positions[found]] == keys[found]
+        new_priorities[positions[found]] = np.array(list(priorities.values()), dtype=np.int64)[found]
+    return replace(snapshot, total=new_total, available=snapshot.available + (new_total - snapshot.total),
+                   priorities=new_priorities)
+
+
+def _utilization(total: np.ndarray, available: np.ndarray) -> dict:
+    return {resource: round(float((t - a) / t), 4) if t else 0.0
+            for resource, t, a in zip(RESOURCES, total.tolist(), available.tolist())}
+
+
+def _fold_groups(ids: np.ndarray, demand: np.ndarray, groups: np.ndarray
+                 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[int, List[int]]]:
+    """Fold each group of queue entries into its first member, as the scheduler admits groups.
+
+    Returns which entries remain, the demand and size of each entry (a
+    group's first member standing for all of them), and the member ids of
+    each group by the id of that first member.
+    """
+    grouped = np.flatnonzero(groups >= 0)
+    sizes = np.ones(len(ids), dtype=np.int64)
+    if not len(grouped):
+        return np.ones(len(ids), dtype=bool), demand, sizes, {}
+    _, first, number, counts = np.unique(groups[grouped], return_index=True, return_inverse=True,
+                                         return_counts=True)
+    heads = grouped[first]
+    number = number.reshape(-1)
+    sums = np.zeros((len(heads), 3), dtype=np.int64)
+    np.add.at(sums, number, demand[grouped])
+    demand = demand.copy()
+    demand[heads] = sums
+    sizes[heads] = counts
+    members: Dict[int, List[int]] = {}
+    for position, head in zip(grouped.tolist(), heads[number].tolist()):
+        members.setdefault(int(ids[head]), []).append(int(ids[position]))
+    keep = groups < 0
+    keep[heads] = True
+    return keep, demand, sizes, members
+
+
+def simulate(snapshot: ClusterSnapshot, preemption: bool = SCHEDULER_PREEMPTION,
+             aging: float = SCHEDULER_PRIORITY_AGING, now: Optional[float] = None) -> dict:
+    """Replay one scheduling pass at Unix time `now` over the snapshot and report what would start.
+
+    Queued deployments are ordered as in the scheduler's heap: by rank under
+    `aging` priority levels per minute waited, then id. With cumulative
+    demand sums the longest prefix that fits on every resource is found by
+    binary search, which admits the same deployments as the scheduler's
+    one-at-a-time loop. When preemption is on and the next deployment does not
+    fit, victims are chosen with the scheduler's own ClusterQueue and the
+    search resumes after re-queueing them.
+    """
+    started = time.perf_counter()
+    now = time.time() if now is None else now
+    queued = ~snapshot.running
+    since = snapshot.queued_since if snapshot.queued_since is not None else np.full(len(snapshot.ids), now)
+    ranks = rank(snapshot.priorities, since, aging)
+    order = np.flatnonzero(queued)[np.lexsort((snapshot.ids[queued], ranks[queued]))]
+    groups = snapshot.groups if snapshot.groups is not None else np.full(len(snapshot.ids), -1, dtype=np.int64)
+    keep, demand, sizes, members = _fold_groups(snapshot.ids[order], snapshot.demand[order], groups[order])
+    ids, priorities, ranks = snapshot.ids[order][keep], snapshot.priorities[order][keep], ranks[order][keep]
+    demand, sizes = demand[keep], sizes[keep]
+    available = snapshot.available.copy()
+
+    running = None
+    if preemption:
+        running = ClusterQueue(snapshot.cluster_id, *available.tolist(), total_ram=int(snapshot.total[0]),
+                               total_cpu=int(snapshot.total[1]), total_gpu=int(snapshot.total[2]))
+        for position in np.flatnonzero(snapshot.running):
+            group = int(groups[position])
+            running.track_running(QueuedDeployment(int(snapshot.ids[position]), snapshot.cluster_id,
+                                                   int(snapshot.priorities[position]),
+                                                   *snapshot.demand[position].tolist(),
+                                                   group_id=None if group < 0 else str(group)))
+
+    admitted = []
+    preempted = []
+    position = 0
+    while position < len(ids):
+        fitting = np.cumsum(demand[position:], axis=0)
+        count = min(int(np.searchsorted(fitting[:, r], available[r], side="right")) for r in range(3))
+        if count:
+            admitted.append(ids[position:position + count])
+            available -= fitting[count - 1]
+            position += count
+        if position == len(ids) or running is None:
+            break
+
+        head = QueuedDeployment(int(ids[position]), snapshot.cluster_id, int(priorities[position]),
+                                *demand[position].tolist())
+        running.set_available(*available.tolist())
+        victims = running.select_victims(head)
+        if not victims:
+            break
+        requeued: Dict[object, List[QueuedDeployment]] = {}
+        for victim in victims:
+            running.stop(victim.id)
+            preempted.append({"deployment_id": victim.id, "preempted_by": head.id})
+            requeued.setdefault(victim.group_id or victim.id, []).append(victim)
+        available = np.array([running.available_ram, running.available_cpu, running.available_gpu], dtype=np.int64)
+        # Victims queue again from now, an evicted group as one entry again
+        units = [combined(sorted(unit, key=lambda v: (-v.priority, v.id))) for unit in requeued.values()]
+        for unit, group in zip(units, requeued.values()):
+            if len(group) > 1:
+                members[unit.id] = sorted(v.id for v in group)
+        ids = np.concatenate([ids, [u.id for u in units]])
+        priorities = np.concatenate([priorities, [u.priority for u in units]])
+        ranks = np.concatenate([ranks, [rank(u.priority, now, aging) for u in units]])
+        demand = np.concatenate([demand, [[u.ram_required, u.cpu_required, u.gpu_required] for u in units]])
+        sizes = np.concatenate([sizes, [len(group) for group in requeued.values()]])
+        tail = position + 1 + np.lexsort((ids[position + 1:], ranks[position + 1:]))
+        ids[position + 1:], priorities[position + 1:], ranks[position + 1:] = ids[tail], priorities[tail], ranks[tail]
+        demand[position + 1:], sizes[position + 1:] = demand[tail], sizes[tail]
+
+    admitted_ids = [member for unit in (np.concatenate(admitted).tolist() if admitted else [])
+                    for member in members.get(unit, [unit])]
+    blocked = None
+    if position < len(ids):
+        short = [resource for resource, need, free in zip(RESOURCES, demand[position].tolist(), available.tolist())
+                 if need > free]
+        blocked = {"deployment_id": int(ids[position]), "priority": int(priorities[position]), "short": short}
+    return {
+        "cluster_id": snapshot.cluster_id,
+        "total": dict(zip(RESOURCES, snapshot.total.tolist())),
+        "free_before": dict(zip(RESOURCES, snapshot.available.tolist())),
+        "free_after": dict(zip(RESOURCES, available.tolist())),
+        "utilization_before": _utilization(snapshot.total, snapshot.available),
+        "utilization_after": _utilization(snapshot.total, available),
+        "admitted": admitted_ids,
+        "preempted": preempted,
+        "still_queued": int(sizes[position:].sum()),
+        "blocked": blocked,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+    }
+
+
+def _priority(text: str):
+    deployment_id, priority = text.split("=")
+    return int(deployment_id), int(priority)
+
+
+def main(argv=None):
+    from app.db.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Replay a scheduling pass for a cluster with hypothetical changes.")
+    parser.add_argument("--cluster-id", type=int, required=True)
+    for resource in RESOURCES:
+        parser.add_argument(f"--total-{resource}", type=int, help=f"resize the cluster's {resource}")
+    parser.add_argument("--priority", type=_priority, action="append", default=[], metavar="DEPLOYMENT_ID=PRIORITY",
+                        help="change a deployment's priority; repeatable")
+    parser.add_argument("--preemption", action=argparse.BooleanOptionalAction, default=SCHEDULER_PREEMPTION)
+    parser.add_argument("--aging", type=float, default=SCHEDULER_PRIORITY_AGING,
+                        help="priority levels gained per minute queued")
+    args = parser.parse_args(argv)
+
+    db = SessionLocal()
+    try:
+        snapshot = load_snapshot(db, args.cluster_id)
+    finally:
+        db.close()
+    if snapshot is None:
+        parser.error(f"Cluster {args.cluster_id} not found")
+    snapshot = with_changes(snapshot, (args.total_ram, args.total_cpu, args.total_gpu), dict(args.priority))
+    print(json.dumps(simulate(snapshot, args.preemption, args.aging), indent=2))
+
+
+if __name__ == "__main__":
+    main()
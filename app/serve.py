@@ -0,0 +1,37 @@
+"""Serve the API from several worker processes.
+
+    python -m app.serve --workers 4
+
+The schema is set up once here, before the workers start, instead of by
+each of them. With more than one worker the scheduler runs in whichever
+worker holds the shard's lease (SCHEDULER_LEADER_LEASE), and the others take
+over if it exits. Workers talk to the scheduler through the broker, so this
+needs DEPLOYMENT_BROKER=amqp.
+"""
+import argparse
+import os
+
+import uvicorn
+
+from app.db.database import init_db
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the API from several worker processes.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    if args.workers > 1:
+        if os.getenv("DEPLOYMENT_BROKER", "amqp") == "memory":
+            parser.error("DEPLOYMENT_BROKER=memory cannot reach the scheduler in another worker; use amqp")
+        os.environ.setdefault("SCHEDULER_LEADER_LEASE", "true")
+    init_db()
+    # Inherited by the workers
+    os.environ["DB_SCHEMA_SETUP"] = "false"
+    uvicorn.run("app.main:create_app", factory=True, host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Load and scheduling benchmark for the API and the scheduler.
+
+Seeds organizations and clusters in a throwaway SQLite database, then
+submits deployments through the HTTP API with a fixed concurrency while the
+scheduler runs in the same process on the in-memory broker. Running
+deployments are completed after --runtime-ms so capacity keeps turning over.
+Reports submission and scheduling rates, API latency percentiles and
+time-in-queue, and writes them as JSON so runs can be compared. Admission
+limits are off unless ADMISSION_RATE or ADMISSION_MAX_QUEUED are set; 429
+responses are retried after their Retry-After and counted as throttled.
+Other failed requests are counted by status and the run goes on:
+
+    python -m benchmarks.load --deployments 5000 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, List
+
+# The app reads its settings at import time
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "load.db"))
+os.environ.setdefault("DEPLOYMENT_BROKER", "memory")
+os.environ.setdefault("ADMISSION_RATE", "0")
+os.environ.setdefault("ADMISSION_MAX_QUEUED", "0")
+
+import httpx  # noqa: E402
+
+from app.auth.models import Organization  # noqa: E402
+from app.auth.utils import create_access_token  # noqa: E402
+from app.clusters.models import Cluster  # noqa: E402
+from app.db.database import SessionLocal, ensure_schema  # noqa: E402
+from app.main import app  # noqa: E402
+from app.scheduler import scheduler  # noqa: E402
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+    return {f"p{p}": round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))], 3) for p in (50, 95, 99)}
+
+
+def error_rate(requests: int, errors: Dict[int, int]) -> dict:
+    """Share of requests that failed, and how many failed with each status."""
+    failed = sum(errors.values())
+    return {"requests": requests, "error_rate": round(failed / requests, 4) if requests else None,
+            "errors": {str(status): count for status, count in sorted(errors.items())}}
+
+
+def parse_choices(spec: str) -> List[int]:
+    """"1-9" is a uniform range, "512,1024,2048" picks from a list (repeat values to weight them)."""
+    if "-" in spec:
+        low, high = (int(part) for part in spec.split("-"))
+        return list(range(low, high + 1))
+    return [int(part) for part in spec.split(",")]
+
+
+def seed(args) -> Dict[int, str]:
+    """Organizations and clusters, written directly; returns a bearer token per organization."""
+    ensure_schema()
+    db = SessionLocal()
+    try:
+        tokens = {}
+        for n in range(args.organizations):
+            organization = Organization(name=f"bench-org-{n}", invite_code=f"bench-{n}")
+            db.add(organization)
+            db.flush()
+            for c in range(args.clusters):
+                db.add(Cluster(name=f"bench-{n}-{c}", organization_id=organization.id,
+                               total_ram=args.cluster_ram, total_cpu=args.cluster_cpu, total_gpu=args.cluster_gpu,
+                               available_ram=args.cluster_ram, available_cpu=args.cluster_cpu,
+                               available_gpu=args.cluster_gpu))
+            tokens[organization.id] = create_access_token({"sub": "bench", "organization_id": organization.id},
+                                                          expires_delta=timedelta(hours=1))
+        db.commit()
+        return tokens
+    finally:
+        db.close()
+
+
+class Recorder:
+    """Timestamps of submissions and admissions, taken from the scheduler's own pass."""
+
+    def __init__(self):
+        self.submitted: Dict[int, float] = {}
+        self.owner: Dict[int, str] = {}
+        self.started: Dict[int, float] = {}
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        # Route -> status -> responses that were neither 2xx nor 429
+        self.errors: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self.passes = 0
+        self.throttled = 0
+
+    def install(self):
+        run_scheduling_pass = scheduler.run_scheduling_pass
+
+        def recording_pass(db, cluster_id):
+            admitted = run_scheduling_pass(db, cluster_id)
+            now = time.perf_counter()
+            self.passes += 1
+            for deployment in admitted:
+                self.started[deployment.id] = now
+            return admitted
+
+        scheduler.run_scheduling_pass = recording_pass
+
+
+async def timed(recorder: Recorder, route: str, request):
+    started = time.perf_counter()
+    response = await request
+    recorder.latency[route].append((time.perf_counter() - started) * 1000)
+    if response.status_code != 429 and not response.is_success:
+        recorder.errors[route][response.status_code] += 1
+    return response
+
+
+async def submit_all(client, args, tokens, recorder: Recorder):
+    rng = random.Random(args.seed)
+    rams, cpus, gpus, priorities = (parse_choices(spec) for spec in (args.ram, args.cpu, args.gpu, args.priority))
+    organizations = list(tokens)
+    pending = asyncio.Queue()
+    for _ in range(args.deployments):
+        pending.put_nowait({
+            "docker_image": "bench:latest",
+            "ram_required": rng.choice(rams),
+            "cpu_required": rng.choice(cpus),
+            "gpu_required": rng.choice(gpus),
+            "priority": rng.choice(priorities),
+            "organization_id": rng.choice(organizations),
+        })
+
+    async def worker():
+        while not pending.empty():
+            body = pending.get_nowait()
+            token = tokens[body.pop('organization_id')]
+            while True:
+                response = await timed(recorder, "POST /deployments/create", client.post(
+                    "/deployments/create", json=body, headers={"Authorization": f"Bearer {token}"}
+                ))
+                if response.status_code != 429:
+                    break
+                recorder.throttled += 1
+                await asyncio.sleep(float(response.headers["Retry-After"]))
+            if not response.is_success:
+                continue
+            deployment_id = response.json()["deployment_id"]
+            recorder.submitted[deployment_id] = time.perf_counter()
+            recorder.owner[deployment_id] = token
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+
+async def complete_running(client, args, recorder: Recorder, done: asyncio.Event):
+    """Finish deployments once they have run for --runtime-ms, freeing their capacity."""
+    runtime = args.runtime_ms / 1000
+    completed = set()
+    while not done.is_set():
+        await asyncio.sleep(runtime / 4)
+        now = time.perf_counter()
+        due = [deployment_id for deployment_id, started in list(recorder.started.items())
+               if deployment_id not in completed and now - started >= runtime]
+        for deployment_id in due:
+            completed.add(deployment_id)
+            await timed(recorder, "POST /deployments/{id}/complete", client.post(
+                f"/deployments/{deployment_id}/complete",
+                headers={"Authorization": f"Bearer {recorder.owner[deployment_id]}"}
+            ))
+
+
+async def run(args) -> dict:
+    tokens = seed(args)
+    recorder = Recorder()
+    recorder.install()
+    await app.router.startup()
+    done = asyncio.Event()
+    # Unhandled exceptions come back as 500s to be counted rather than ending the run
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        completer = asyncio.create_task(complete_running(client, args, recorder, done))
+        started = time.perf_counter()
+        await submit_all(client, args, tokens, recorder)
+        submitted = time.perf_counter()
+
+        # Wait for the scheduler to drain, or to stop making progress
+        last_progress, admitted = time.perf_counter(), len(recorder.started)
+        while len(recorder.started) < len(recorder.submitted):
+            await asyncio.sleep(0.05)
+            if len(recorder.started) != admitted:
+                last_progress, admitted = time.perf_counter(), len(recorder.started)
+            elif time.perf_counter() - last_progress > args.settle_timeout:
+                break
+        finished = time.perf_counter()
+        done.set()
+        await completer
+    await app.router.shutdown()
+
+    scheduled = [recorder.started[d] - recorder.submitted[d] for d in recorder.started if d in recorder.submitted]
+    return {
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "commit": _git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "submissions": len(recorder.submitted),
+        "throttled": recorder.throttled,
+        "scheduled": len(recorder.started),
+        "scheduling_passes": recorder.passes,
+        "submissions_per_second": round(len(recorder.submitted) / (submitted - started), 1),
+        "scheduling_decisions_per_second": round(len(recorder.started) / (finished - started), 1),
+        "api_latency_ms": {route: {**percentiles(values), **error_rate(len(values), recorder.errors[route])}
+                           for route, values in recorder.latency.items()},
+        "time_in_queue_ms": percentiles([seconds * 1000 for seconds in scheduled]),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--organizations", type=int, default=4)
+    parser.add_argument("--clusters", type=int, default=8, help="clusters per organization")
+    parser.add_argument("--deployments", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight")
+    parser.add_argument("--cluster-ram", type=int, default=65536)
+    parser.add_argument("--cluster-cpu", type=int, default=64)
+    parser.add_argument("--cluster-gpu", type=int, default=8)
+    parser.add_argument("--ram", default="512,1024,1024,2048,4096", help="RAM per deployment")
+    parser.add_argument("--cpu", default="1-4", help="CPUs per deployment")
+    parser.add_argument("--gpu", default="0,0,0,1", help="GPUs per deployment")
+    parser.add_argument("--priority", default="0-9", help="priority per deployment")
+    parser.add_argument("--runtime-ms", type=int, default=200, help="how long deployments run before completing")
+    parser.add_argument("--settle-timeout", type=float, default=5.0,
+                        help="seconds without an admission before giving up on the rest")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    print(text)
+    return results
+
+
+if __name__ == "__main__":
+    sys.exit(main() is None)
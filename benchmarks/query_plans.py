@@ -0,0 +1,123 @@
+"""Query plans and latency of the scheduler's hot queries before and after the migrations.
+
+Seeds a throwaway SQLite database shaped like a long-lived installation (a
+large deployment history, few of them still queued or running), drops the
+indexes added by app/db/migrations.py to mimic a database created before
+them, then measures each query, applies the migrations and measures again.
+
+    python -m benchmarks.query_plans --clusters 200 --deployments 200000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, select, text
+
+from app.auth import models as auth_models  # noqa: F401  (registers the organizations table)
+from app.clusters.models import Cluster
+from app.db import migrations
+from app.db.database import Base
+from app.deployments.models import Deployment, DeploymentStatus
+from app.scheduler import models as scheduler_models  # noqa: F401
+
+ACTIVE = [DeploymentStatus.QUEUED, DeploymentStatus.RUNNING]
+
+
+def seed(engine, clusters: int, deployments: int, organizations: int):
+    random.seed(0)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        for _, _, statements in migrations.MIGRATIONS:
+            # Column steps are callables; the columns stay, as the models have them
+            for statement in statements:
+                if callable(statement) or not statement.startswith("CREATE INDEX"):
+                    continue
+                name = statement.split("EXISTS ")[1].split()[0]
+                connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        connection.execute(auth_models.Organization.__table__.insert(), [
+            {"id": i, "name": f"org-{i}", "invite_code": f"code-{i}"} for i in range(1, organizations + 1)
+        ])
+        connection.execute(Cluster.__table__.insert(), [
+            {"id": i, "name": f"cluster-{i}", "organization_id": random.randint(1, organizations),
+             "total_ram": 65536, "total_cpu": 64, "total_gpu": 8,
+             "available_ram": 65536, "available_cpu": 64, "available_gpu": 8}
+            for i in range(1, clusters + 1)
+        ])
+        statuses = ([DeploymentStatus.COMPLETED] * 90 + [DeploymentStatus.FAILED] * 5 +
+                    [DeploymentStatus.QUEUED] * 3 + [DeploymentStatus.RUNNING] * 2)
+        batch = []
+        for i in range(1, deployments + 1):
+            batch.append({"id": i, "cluster_id": random.randint(1, clusters), "docker_image": "bench:latest",
+                          "ram_required": 512, "cpu_required": 1, "gpu_required": 0,
+                          "priority": random.randint(0, 9), "status": random.choice(statuses)})
+            if len(batch) == 10000:
+                connection.execute(Deployment.__table__.insert(), batch)
+                batch = []
+        if batch:
+            connection.execute(Deployment.__table__.insert(), batch)
+        connection.execute(text("ANALYZE"))
+
+
+def hot_queries(cluster_id: int, organization_id: int):
+    return {
+        # SchedulerEngine._load_clusters
+        "active deployments of a cluster": select(Deployment).filter(
+            Deployment.cluster_id.in_([cluster_id]), Deployment.status.in_(ACTIVE)
+        ).order_by(Deployment.id),
+        # GET /deployments/list?status=&priority=
+        "filtered deployment page": select(Deployment.id, Deployment.status).filter(
+            Deployment.cluster_id == cluster_id, Deployment.status == DeploymentStatus.QUEUED,
+            Deployment.priority == 5
+        ).order_by(Deployment.id).limit(100),
+        # SchedulerEngine.place and GET /clusters/list
+        "clusters of an organization": select(Cluster).filter(
+            Cluster.organization_id == organization_id
+        ).order_by(Cluster.id),
+    }
+
+
+def measure(engine, repeat: int):
+    results = {}
+    with engine.connect() as connection:
+        for name, statement in hot_queries(cluster_id=7, organization_id=3).items():
+            sql = str(statement.compile(engine, compile_kwargs={"literal_binds": True}))
+            plan = [row[-1] for row in connection.execute(text("EXPLAIN QUERY PLAN " + sql))]
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                connection.execute(statement).fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = (plan, statistics.median(timings))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--deployments", type=int, default=200000)
+    parser.add_argument("--organizations", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+    print(f"Seeding {args.deployments} deployments on {args.clusters} clusters into {path}")
+    seed(engine, args.clusters, args.deployments, args.organizations)
+
+    before = measure(engine, args.repeat)
+    migrations.migrate(engine)
+    with engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+    after = measure(engine, args.repeat)
+
+    for name in before:
+        print(f"\n{name}")
+        for label, (plan, median_ms) in (("before", before[name]), ("after", after[name])):
+            print(f"  {label:6} {median_ms:8.3f} ms  " + " | ".join(plan))
+
+
+if __name__ == "__main__":
+    main()
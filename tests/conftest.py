@@ -0,0 +1,123 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from app.auth.models import Organization
+from app.auth.utils import create_access_token
+from app.clusters.models import Cluster
+from app.db.database import Base, create_async_db_engine, get_async_db
+from app.db.versions import response_cache, versions
+from app.deployments import feed
+from app.deployments.models import Deployment, DeploymentStatus
+from app.main import app
+from app.scheduler import admission, scheduler
+from app.scheduler.broker import InMemoryBroker
+from app.scheduler.engine import scheduler_engine
+
+# A file, not ":memory:", so the sync fixtures and the async sessions under test share it
+DATABASE_URL = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Tests run on several event loops, and pooled aiosqlite connections belong to one
+async_engine = create_async_db_engine(DATABASE_URL, poolclass=NullPool)
+AsyncTestingSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+@pytest.fixture
+def session_factory():
+    return TestingSessionLocal
+
+
+@pytest.fixture
+def async_session_factory(monkeypatch):
+    # The scheduler and the status feed open their own sessions
+    monkeypatch.setattr(scheduler, "AsyncSessionLocal", AsyncTestingSessionLocal)
+    monkeypatch.setattr(feed, "AsyncSessionLocal", AsyncTestingSessionLocal)
+    return AsyncTestingSessionLocal
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    scheduler_engine.reset()
+    # Ids restart with every test's database, and so must list versions
+    versions.clear()
+    response_cache.clear()
+    admission.buckets.clear()
+    session = TestingSessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        # A pass still waiting would otherwise run in the next test, against that test's clusters
+        tasks = list(scheduler._pass_tasks.values())
+        if tasks and not tasks[0].get_loop().is_closed():
+            tasks[0].get_loop().run_until_complete(scheduler.stop_passes())
+        scheduler._pass_tasks.clear()
+        scheduler._dirty_clusters.clear()
+        Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def client(db, async_session_factory, monkeypatch):
+    async def override_get_async_db():
+        async with async_session_factory() as session:
+            yield session
+
+    monkeypatch.setattr(scheduler, "deployment_broker", InMemoryBroker())
+    monkeypatch.setitem(app.dependency_overrides, get_async_db, override_get_async_db)
+    return TestClient(app)
+
+
+@pytest.fixture
+def make_cluster(db):
+    def make(ram=1024, cpu=4, gpu=2, org=None):
+        if org is None:
+            org = Organization(name=f"org-{ram}-{cpu}-{gpu}")
+            db.add(org)
+            db.commit()
+        cluster = Cluster(name="cluster", organization_id=org.id,
+                          total_ram=ram, total_cpu=cpu, total_gpu=gpu,
+                          available_ram=ram, available_cpu=cpu, available_gpu=gpu)
+        db.add(cluster)
+        db.commit()
+        return cluster
+    return make
+
+
+@pytest.fixture
+def make_deployment(db):
+    def make(cluster, ram=512, cpu=2, gpu=1, priority=1, group_id=None):
+        deployment = Deployment(cluster_id=cluster.id, docker_image="test:latest",
+                                ram_required=ram, cpu_required=cpu, gpu_required=gpu,
+                                priority=priority, status=DeploymentStatus.QUEUED, group_id=group_id)
+        db.add(deployment)
+        db.commit()
+        return deployment
+    return make
+
+
+@pytest.fixture
+def auth_headers():
+    def headers(organization_id, username="tester"):
+        token = create_access_token({"sub": username, "organization_id": organization_id})
+        return {"Authorization": f"Bearer {token}"}
+    return headers
+
+
+@pytest.fixture
+def drain_passes():
+    def drain(loop=None):
+        # Woken passes run on the loop that woke them; wait until none is pending
+        async def wait():
+            while scheduler._pass_tasks:
+                await asyncio.sleep(0.01)
+        (loop or asyncio.get_event_loop()).run_until_complete(wait())
+    return drain
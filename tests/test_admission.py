@@ -0,0 +1,128 @@
+from app.deployments.models import Deployment
+from app.metrics.registry import DB_QUERY_DURATION
+from app.scheduler import admission, scheduler
+from app.scheduler.admission import TokenBuckets
+
+
+def _body(cluster, ram=256, cpu=1, gpu=0):
+    return {"cluster_id": cluster.id, "docker_image": "test:latest",
+            "ram_required": ram, "cpu_required": cpu, "gpu_required": gpu, "priority": 1}
+
+
+def test_token_bucket_refills_at_its_rate():
+    buckets = TokenBuckets(rate=2, burst=3)
+
+    assert buckets.take(1, 5, now=0.0) == (3, 0.5)
+    assert buckets.take(1, 1, now=0.25) == (0, 0.25)
+    assert buckets.take(1, 1, now=0.5) == (1, 0.0)
+    # Idle time refills up to the burst, not beyond
+    assert buckets.take(1, 10, now=100.0)[0] == 3
+    assert buckets.take(2, 1, now=0.0) == (1, 0.0)
+    assert TokenBuckets(rate=0, burst=0).take(1, 10) == (10, 0.0)
+
+
+def test_deployments_larger_than_the_cluster_are_refused(client, db, make_cluster, auth_headers):
+    cluster = make_cluster(ram=1024, cpu=4, gpu=0)
+    auth = auth_headers(cluster.organization_id)
+
+    response = client.post("/deployments/create", headers=auth, json=_body(cluster, ram=2048, gpu=1))
+    assert response.status_code == 409
+    assert response.json()["detail"] == "Deployment needs more than the cluster's total capacity (ram 2048 > 1024, gpu 1 > 0)"
+
+    results = client.post("/deployments/bulk", headers=auth, json=[
+        _body(cluster, ram=4096), _body(cluster, ram=1024),
+    ]).json()["results"]
+    assert results[0]["error"].startswith("Deployment needs more")
+    assert "deployment_id" in results[1]
+    assert db.query(Deployment).count() == 1
+
+
+def test_rate_limit_answers_429_from_memory(client, make_cluster, auth_headers, monkeypatch):
+    cluster = make_cluster(ram=1024)
+    auth = auth_headers(cluster.organization_id)
+    monkeypatch.setattr(admission, "buckets", TokenBuckets(rate=0.5, burst=2))
+
+    assert [client.post("/deployments/create", headers=auth, json=_body(cluster)).status_code
+            for _ in range(2)] == [200, 200]
+    queries = sum(DB_QUERY_DURATION.labels().counts)
+    # Placed from the in-memory index, so nothing is read before the bucket refuses it
+    limited = client.post("/deployments/create", headers=auth, json=dict(_body(cluster), cluster_id=None))
+    assert limited.status_code == 429
+    assert limited.headers["Retry-After"] == "2"
+    assert sum(DB_QUERY_DURATION.labels().counts) == queries
+
+    # Other organizations have their own bucket
+    other = make_cluster(ram=2048)
+    assert client.post("/deployments/create", headers=auth_headers(other.organization_id),
+                       json=_body(other)).status_code == 200
+    assert client.post("/deployments/bulk", headers=auth, json=[_body(cluster)]).status_code == 429
+
+
+def test_refused_submissions_spend_no_tokens(client, db, make_cluster, auth_headers, monkeypatch, drain_passes):
+    cluster = make_cluster(ram=1024)
+    auth = auth_headers(cluster.organization_id)
+    monkeypatch.setattr(admission, "buckets", TokenBuckets(rate=0.5, burst=2))
+    member = {"docker_image": "test:latest", "ram_required": 256, "cpu_required": 1, "gpu_required": 0}
+
+    assert client.post("/deployments/create", headers=auth, json=_body(cluster, ram=-1)).status_code == 422
+    assert client.post("/deployments/group", headers=auth,
+                       json={"priority": 1, "deployments": [dict(member, gpu_required=-1)]}).status_code == 422
+    assert client.post("/deployments/group", headers=auth, json={"priority": 1, "deployments": []}).status_code == 422
+    assert client.post("/deployments/create", headers=auth, json=_body(cluster, ram=2048)).status_code == 409
+    assert client.post("/deployments/create", headers=auth,
+                       json=dict(_body(cluster), cluster_id=cluster.id + 1)).status_code == 404
+    assert client.post("/deployments/group", headers=auth,
+                       json={"priority": 1, "deployments": [dict(member, ram_required=600)] * 2}).status_code == 409
+    results = client.post("/deployments/bulk", headers=auth, json=[
+        _body(cluster, ram=2048), dict(_body(cluster), cluster_id=cluster.id + 1), dict(_body(cluster, ram=2048),
+                                                                                    cluster_id=None),
+    ]).json()["results"]
+    assert all("error" in result for result in results)
+
+    # The whole burst is still there
+    results = client.post("/deployments/bulk", headers=auth, json=[_body(cluster)] * 3).json()["results"]
+    assert [r.get("error") for r in results] == [None, None, "Submission rate limit or queue quota exceeded"]
+    assert db.query(Deployment).count() == 2
+    drain_passes()
+
+
+def test_queue_quota_applies_until_deployments_start(client, db, make_cluster, auth_headers, monkeypatch):
+    cluster = make_cluster(ram=1024)
+    auth = auth_headers(cluster.organization_id)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_QUEUED", 3)
+    # Passes are run by hand below, so the deployments stay queued until then
+    monkeypatch.setattr(scheduler, "wake_cluster", lambda cluster_id: None)
+
+    results = client.post("/deployments/bulk", headers=auth, json=[_body(cluster)] * 4).json()["results"]
+    assert [r.get("error") for r in results] == [None, None, None, "Submission rate limit or queue quota exceeded"]
+    full = client.post("/deployments/create", headers=auth, json=_body(cluster))
+    assert full.status_code == 429
+    assert full.headers["Retry-After"] == str(admission.ADMISSION_RETRY_AFTER)
+
+    # Started deployments no longer count against the quota
+    scheduler.run_scheduling_pass(db, cluster.id)
+    assert client.post("/deployments/create", headers=auth, json=_body(cluster)).status_code == 200
+
+
+def test_groups_are_admitted_whole_or_not_at_all(client, db, make_cluster, auth_headers, monkeypatch, drain_passes):
+    cluster = make_cluster(ram=4096)
+    auth = auth_headers(cluster.organization_id)
+    monkeypatch.setattr(admission, "buckets", TokenBuckets(rate=1, burst=3))
+    member = {"docker_image": "test:latest", "ram_required": 256, "cpu_required": 1, "gpu_required": 0}
+
+    assert client.post("/deployments/create", headers=auth, json=_body(cluster)).status_code == 200
+    limited = client.post("/deployments/group", headers=auth,
+                          json={"cluster_id": cluster.id, "priority": 1, "deployments": [member] * 3})
+    assert limited.status_code == 429
+    assert limited.headers["Retry-After"] == "1"
+    assert db.query(Deployment).count() == 1
+    # Tokens are not spent on a group that was refused
+    assert client.post("/deployments/group", headers=auth,
+                       json={"cluster_id": cluster.id, "priority": 1, "deployments": [member] * 2}).status_code == 200
+    assert client.post("/deployments/group", headers=auth,
+                       json={"priority": 1, "deployments": [member] * 4}).status_code == 413
+    drain_passes()
+
+    buckets = TokenBuckets(rate=2, burst=3)
+    assert buckets.take(1, 2, now=0.0, partial=False) == (2, 0.0)
+    assert buckets.take(1, 2, now=0.0, partial=False) == (0, 0.5)
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from app.auth import utils
+from app.auth.utils import ClaimsCache, PasswordHasher, verify_password
+
+
+def test_password_hashing_runs_off_the_event_loop():
+    hasher = PasswordHasher(workers=1)
+
+    async def run():
+        gaps = []
+
+        async def tick():
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(0.005)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        ticker = asyncio.create_task(tick())
+        await asyncio.sleep(0.01)
+        started = time.perf_counter()
+        hashing = [asyncio.create_task(hasher.hash(f"secret-{i}")) for i in range(2)]
+        await asyncio.sleep(0)
+        stats = hasher.stats()
+        hashes = await asyncio.gather(*hashing)
+        elapsed = time.perf_counter() - started
+        ticker.cancel()
+        return stats, hashes, gaps, elapsed
+
+    stats, hashes, gaps, elapsed = asyncio.run(run())
+
+    assert stats == {"workers": 1, "busy": 1, "waiting": 1, "saturation": 2.0}
+    assert verify_password("secret-1", hashes[1])
+    # The loop kept its 5 ms ticks while each bcrypt round held a worker for far longer;
+    # a backend that keeps the GIL would stall it for a whole round
+    assert max(gaps) < elapsed / 4
+    assert hasher.stats()["busy"] == 0
+
+
+def test_decoded_claims_are_cached_until_the_token_expires(monkeypatch):
+    decoded = []
+    original = utils.jwt.decode
+
+    def counting_decode(*args, **kwargs):
+        decoded.append(args[0])
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(utils.jwt, "decode", counting_decode)
+    monkeypatch.setattr(utils, "claims_cache", ClaimsCache(max_size=2))
+    token = utils.create_access_token({"sub": "alice", "organization_id": 3})
+
+    assert asyncio.run(utils.current_principal(token)) == utils.Principal("alice", 3)
+    assert asyncio.run(utils.current_principal(token)).organization_id == 3
+    assert len(decoded) == 1
+
+    # Least recently used tokens are evicted beyond max_size
+    for organization_id in (4, 5):
+        utils.decode_token(utils.create_access_token({"sub": "bob", "organization_id": organization_id}))
+    assert len(utils.claims_cache) == 2
+    assert utils.claims_cache.get(token) is None
+
+
+def test_claims_cache_drops_expired_tokens():
+    cache = ClaimsCache(max_size=8)
+    cache.put("fresh", {"sub": "alice", "exp": time.time() + 60})
+    cache.put("stale", {"sub": "bob", "exp": time.time() - 1})
+    cache.put("no-exp", {"sub": "carol"})
+
+    assert cache.get("fresh")["sub"] == "alice"
+    assert cache.get("stale") is None
+    assert cache.get("no-exp") is None
+    assert len(cache) == 1
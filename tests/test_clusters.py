@@ -0,0 +1,81 @@
+from app.auth.models import Organization
+from app.metrics.registry import DB_QUERY_DURATION
+from app.scheduler import scheduler
+
+
+def _submit(client, auth, cluster, ram, cpu, gpu):
+    response = client.post("/deployments/create", headers=auth, json={
+        "cluster_id": cluster.id, "docker_image": "test:latest",
+        "ram_required": ram, "cpu_required": cpu, "gpu_required": gpu, "priority": 1,
+    })
+    assert response.status_code == 200
+    return response.json()["deployment_id"]
+
+
+def test_summary_follows_allocations_without_queries(client, db, make_cluster, auth_headers, drain_passes):
+    organization = Organization(name="summary-org")
+    db.add(organization)
+    db.commit()
+    large = make_cluster(ram=8192, cpu=8, gpu=2, org=organization)
+    small = make_cluster(ram=4096, cpu=4, gpu=0, org=organization)
+    auth = auth_headers(organization.id)
+
+    _submit(client, auth, large, 4096, 2, 1)
+    blocking = _submit(client, auth, small, 4096, 4, 0)
+    _submit(client, auth, small, 1024, 1, 0)
+    scheduler.run_scheduling_pass(db, large.id)
+    scheduler.run_scheduling_pass(db, small.id)
+
+    summary = client.get("/clusters/summary", headers=auth).json()
+    assert summary["clusters"] == 2
+    assert summary["total"] == {"ram": 12288, "cpu": 12, "gpu": 2}
+    assert summary["allocated"] == {"ram": 8192, "cpu": 6, "gpu": 1}
+    assert summary["free"] == {"ram": 4096, "cpu": 6, "gpu": 1}
+    assert summary["queued_demand"] == {"ram": 1024, "cpu": 1, "gpu": 0}
+    assert (summary["running_deployments"], summary["queued_deployments"]) == (2, 1)
+    per_cluster = {c["cluster_id"]: c for c in summary["per_cluster"]}
+    assert per_cluster[small.id]["free"] == {"ram": 0, "cpu": 0, "gpu": 0}
+    assert per_cluster[small.id]["queued_deployments"] == 1
+
+    assert client.post(f"/deployments/{blocking}/complete", headers=auth).status_code == 200
+    drain_passes()
+    queries = sum(DB_QUERY_DURATION.labels().counts)
+    summary = client.get("/clusters/summary", params={"per_cluster": False}, headers=auth).json()
+    # Answered from the scheduler's aggregates alone
+    assert sum(DB_QUERY_DURATION.labels().counts) == queries
+    assert "per_cluster" not in summary
+    assert summary["allocated"] == {"ram": 5120, "cpu": 3, "gpu": 1}
+    assert summary["queued_demand"] == {"ram": 0, "cpu": 0, "gpu": 0}
+    assert (summary["running_deployments"], summary["queued_deployments"]) == (2, 0)
+
+    other = client.get("/clusters/summary", headers=auth_headers(organization.id + 1)).json()
+    assert other["clusters"] == 0
+    assert other["total"] == {"ram": 0, "cpu": 0, "gpu": 0}
+    assert other["per_cluster"] == []
+
+
+def test_list_is_served_from_memory_until_a_write_changes_it(client, db, make_cluster, auth_headers):
+    cluster = make_cluster(ram=2048)
+    auth = auth_headers(cluster.organization_id)
+
+    first = client.get("/clusters/list", headers=auth)
+    etag = first.headers["ETag"]
+    queries = sum(DB_QUERY_DURATION.labels().counts)
+    assert client.get("/clusters/list", headers=auth).json() == first.json()
+    unchanged = client.get("/clusters/list", headers={**auth, "If-None-Match": etag})
+    assert unchanged.status_code == 304
+    assert sum(DB_QUERY_DURATION.labels().counts) == queries
+
+    # An allocation changes the free capacity shown, so the old ETag no longer matches
+    _submit(client, auth, cluster, 1024, 1, 0)
+    scheduler.run_scheduling_pass(db, cluster.id)
+    changed = client.get("/clusters/list", headers={**auth, "If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.json()[0]["available_ram"] == 1024
+    assert changed.headers["ETag"] != etag
+
+    created = client.post("/clusters/create", headers=auth, json={
+        "name": "second", "total_ram": 1, "total_cpu": 1, "total_gpu": 0,
+    })
+    listed = client.get("/clusters/list", headers={**auth, "If-None-Match": changed.headers["ETag"]})
+    assert [c["id"] for c in listed.json()] == [cluster.id, created.json()["cluster_id"]]
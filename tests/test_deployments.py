@@ -0,0 +1,403 @@
+import asyncio
+import json
+import sqlite3
+import time
+
+import pytest
+
+from app.clusters.models import Cluster
+from app.deployments import feed
+from app.deployments.feed import status_feed
+from app.deployments.models import Deployment, DeploymentStatus
+from app.scheduler import scheduler
+from app.scheduler.engine import scheduler_engine
+
+
+@pytest.fixture
+def submit(client, auth_headers):
+    def create(cluster, ram=512, cpu=2, gpu=1, priority=1):
+        response = client.post("/deployments/create", headers=auth_headers(cluster.organization_id), json={
+            "cluster_id": cluster.id,
+            "docker_image": "test:latest",
+            "ram_required": ram,
+            "cpu_required": cpu,
+            "gpu_required": gpu,
+            "priority": priority,
+        })
+        assert response.status_code == 200
+        return response.json()["deployment_id"]
+    return create
+
+
+def test_complete_releases_resources_and_admits_waiting_deployment(client, db, make_cluster, submit, auth_headers, drain_passes):
+    cluster = make_cluster()
+    auth = auth_headers(cluster.organization_id)
+    first = submit(cluster, ram=1024)
+    second = submit(cluster, ram=1024)
+    scheduler.run_scheduling_pass(db, cluster.id)
+
+    response = client.post(f"/deployments/{first}/complete", headers=auth)
+    assert response.status_code == 200
+    assert client.post(f"/deployments/{first}/complete", headers=auth).status_code == 409
+
+    # The freed capacity is handed to the waiting deployment by the woken pass
+    drain_passes()
+    db.expire_all()
+    assert db.get(Deployment, first).status == DeploymentStatus.COMPLETED
+    assert db.get(Deployment, second).status == DeploymentStatus.RUNNING
+    assert db.get(Cluster, cluster.id).available_ram == 0
+
+
+def test_cancel_queued_deployment_keeps_capacity(client, db, make_cluster, submit, auth_headers, drain_passes):
+    cluster = make_cluster()
+    auth = auth_headers(cluster.organization_id)
+    running = submit(cluster, ram=1024)
+    queued = submit(cluster, ram=1024)
+    scheduler.run_scheduling_pass(db, cluster.id)
+
+    assert client.post(f"/deployments/{queued}/cancel", headers=auth).status_code == 200
+    assert client.post(f"/deployments/{queued}/complete", headers=auth).status_code == 409
+    assert client.post(f"/deployments/{running}/fail", headers=auth).status_code == 200
+    drain_passes()
+
+    db.expire_all()
+    assert db.get(Deployment, queued).status == DeploymentStatus.CANCELLED
+    assert db.get(Cluster, cluster.id).available_ram == 1024
+    assert len(scheduler_engine.clusters[cluster.id]) == 0
+
+
+def test_cancelling_blocking_head_admits_deployments_behind_it(client, db, make_cluster, submit, auth_headers, drain_passes):
+    cluster = make_cluster()
+    auth = auth_headers(cluster.organization_id)
+    submit(cluster, ram=512, priority=5)
+    scheduler.run_scheduling_pass(db, cluster.id)
+    blocker = submit(cluster, ram=1024, cpu=1, gpu=0, priority=9)
+    small = submit(cluster, ram=256, cpu=1, gpu=0, priority=1)
+    scheduler.run_scheduling_pass(db, cluster.id)
+
+    assert client.post(f"/deployments/{blocker}/cancel", headers=auth).status_code == 200
+    drain_passes()
+
+    db.expire_all()
+    assert db.get(Deployment, small).status == DeploymentStatus.RUNNING
+    assert db.get(Cluster, cluster.id).available_ram == 256
+
+
+def test_other_organizations_cannot_see_or_change_deployments(client, db, make_cluster, submit, auth_headers):
+    cluster = make_cluster()
+    deployment = submit(cluster)
+    outsider = auth_headers(cluster.organization_id + 1)
+
+    assert client.get("/deployments/list", params={"cluster_id": cluster.id}, headers=outsider).status_code == 404
+    assert client.post(f"/deployments/{deployment}/cancel", headers=outsider).status_code == 404
+    assert client.post("/deployments/create", headers=outsider, json={
+        "cluster_id": cluster.id, "docker_image": "test:latest",
+        "ram_required": 1, "cpu_required": 1, "gpu_required": 0, "priority": 1,
+    }).status_code == 404
+    assert client.get("/deployments/list", params={"cluster_id": cluster.id}).status_code == 401
+    assert client.post(f"/deployments/{deployment}/cancel",
+                       headers={"Authorization": "Bearer not-a-token"}).status_code == 401
+
+    db.expire_all()
+    assert db.get(Deployment, deployment).status == DeploymentStatus.QUEUED
+
+
+def test_bulk_submission_reports_each_item_and_wakes_each_cluster_once(client, db, make_cluster, auth_headers,
+                                                                       monkeypatch, drain_passes):
+    first = make_cluster(ram=1024, cpu=4, gpu=0)
+    org = first.organization
+    second = make_cluster(ram=1024, cpu=4, gpu=0, org=org)
+    foreign = make_cluster(ram=4096, cpu=16, gpu=0)
+    woken = []
+    original_notify = scheduler.notify_cluster
+
+    def counting_notify(cluster_id, deployment_ids=()):
+        woken.append(cluster_id)
+        original_notify(cluster_id, deployment_ids)
+
+    monkeypatch.setattr("app.deployments.router.notify_cluster", counting_notify)
+    item = {"docker_image": "test:latest", "ram_required": 1024, "cpu_required": 1, "gpu_required": 0, "priority": 1}
+    response = client.post("/deployments/bulk", headers=auth_headers(org.id), json=[
+        dict(item, cluster_id=first.id),
+        dict(item, cluster_id=foreign.id),
+        dict(item),
+        dict(item, ram_required=8192),
+        dict(item, cluster_id=first.id, ram_required=1),
+    ])
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["index"] for r in results] == [0, 1, 2, 3, 4]
+    assert results[1]["error"] == "Cluster not found"
+    assert "error" in results[3]
+    # The placed item sees the demand queued on the first cluster earlier in the batch
+    assert [results[i]["cluster_id"] for i in (0, 2, 4)] == [first.id, second.id, first.id]
+    assert sorted(woken) == [first.id, second.id]
+
+    drain_passes()
+    db.expire_all()
+    statuses = {d.id: d.status for d in db.query(Deployment)}
+    assert len(statuses) == 3
+    assert statuses[results[0]["deployment_id"]] == DeploymentStatus.RUNNING
+    assert statuses[results[2]["deployment_id"]] == DeploymentStatus.RUNNING
+    assert statuses[results[4]["deployment_id"]] == DeploymentStatus.QUEUED
+
+
+def test_bulk_submission_is_bounded(client, make_cluster, auth_headers, monkeypatch):
+    cluster = make_cluster()
+    monkeypatch.setattr("app.deployments.router.DEPLOYMENT_BULK_LIMIT", 2)
+    item = {"cluster_id": cluster.id, "docker_image": "test:latest", "ram_required": 1, "cpu_required": 1,
+            "gpu_required": 0, "priority": 1}
+
+    response = client.post("/deployments/bulk", headers=auth_headers(cluster.organization_id), json=[item] * 3)
+    assert response.status_code == 413
+
+
+def test_write_blocked_by_another_process_is_retried_later(client, db, make_cluster, auth_headers, monkeypatch):
+    cluster = make_cluster()
+    monkeypatch.setattr("app.db.database.SQLITE_BUSY_TIMEOUT", 50)
+    # Another process holding SQLite's write lock past busy_timeout
+    other = sqlite3.connect(db.get_bind().url.database, isolation_level=None)
+    # In WAL mode already, as the app's connections would switch it when they open
+    other.execute("PRAGMA journal_mode=WAL")
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        response = client.post("/deployments/create", headers=auth_headers(cluster.organization_id), json={
+            "cluster_id": cluster.id, "docker_image": "test:latest", "ram_required": 1, "cpu_required": 1,
+            "gpu_required": 0, "priority": 1,
+        })
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert db.query(Deployment).count() == 0
+
+
+def test_group_starts_only_when_all_of_it_fits(client, db, make_cluster, submit, auth_headers, drain_passes):
+    cluster = make_cluster(ram=8192, cpu=16, gpu=4)
+    auth = auth_headers(cluster.organization_id)
+    holder = submit(cluster, ram=512, cpu=1, gpu=2)
+    scheduler.run_scheduling_pass(db, cluster.id)
+
+    response = client.post("/deployments/group", headers=auth, json={
+        "cluster_id": cluster.id, "group_id": "train-1", "priority": 5,
+        "deployments": [{"docker_image": "trainer:latest", "ram_required": 1024, "cpu_required": 2,
+                         "gpu_required": 1}] * 3,
+    })
+    assert response.status_code == 200
+    members = response.json()["deployment_ids"]
+    assert response.json()["group_id"] == "train-1" and len(members) == 3
+    behind = submit(cluster, ram=512, cpu=1, gpu=1, priority=1)
+    drain_passes()
+
+    # Two free GPUs would take two replicas; the group holds nothing and blocks the queue instead
+    db.expire_all()
+    assert {db.get(Deployment, d).status for d in members + [behind]} == {DeploymentStatus.QUEUED}
+    assert db.get(Cluster, cluster.id).available_gpu == 2
+    events = client.get(f"/deployments/{members[0]}/timeline", headers=auth).json()["events"]
+    assert events[-1]["stage"] == "rejected" and events[-1]["reason"] == "insufficient gpu"
+    assert client.post("/deployments/group", headers=auth, json={
+        "cluster_id": cluster.id, "group_id": "train-1", "priority": 5,
+        "deployments": [{"docker_image": "trainer:latest", "ram_required": 1, "cpu_required": 1, "gpu_required": 0}],
+    }).status_code == 409
+
+    assert client.post(f"/deployments/{holder}/complete", headers=auth).status_code == 200
+    drain_passes()
+    db.expire_all()
+    assert {db.get(Deployment, d).status for d in members + [behind]} == {DeploymentStatus.RUNNING}
+    assert db.get(Cluster, cluster.id).available_gpu == 0
+
+
+def test_cancelled_member_leaves_the_rest_of_the_group_to_start(client, db, make_cluster, submit, auth_headers,
+                                                                drain_passes):
+    cluster = make_cluster(ram=4096, cpu=8, gpu=2)
+    auth = auth_headers(cluster.organization_id)
+    holder = submit(cluster, ram=512, cpu=1, gpu=1)
+    scheduler.run_scheduling_pass(db, cluster.id)
+    response = client.post("/deployments/group", headers=auth, json={
+        "priority": 1, "deployments": [{"docker_image": "trainer:latest", "ram_required": 512, "cpu_required": 1,
+                                        "gpu_required": 1}] * 2,
+    })
+    # Placed by the combined demand, on the only cluster that can ever fit it
+    assert response.json()["cluster_id"] == cluster.id
+    first, second = response.json()["deployment_ids"]
+    drain_passes()
+    db.expire_all()
+    assert db.get(Deployment, first).status == DeploymentStatus.QUEUED
+
+    assert client.post(f"/deployments/{first}/cancel", headers=auth).status_code == 200
+    drain_passes()
+    db.expire_all()
+    assert db.get(Deployment, second).status == DeploymentStatus.RUNNING
+    assert db.get(Deployment, holder).status == DeploymentStatus.RUNNING
+
+    too_large = client.post("/deployments/group", headers=auth, json={
+        "cluster_id": cluster.id, "priority": 1,
+        "deployments": [{"docker_image": "trainer:latest", "ram_required": 512, "cpu_required": 1,
+                         "gpu_required": 1}] * 3,
+    })
+    assert too_large.status_code == 409
+    assert too_large.json()["detail"].endswith("(gpu 3 > 2)")
+
+
+def test_list_pages_by_cursor_and_filters(client, make_cluster, make_deployment, auth_headers):
+    cluster = make_cluster()
+    auth = auth_headers(cluster.organization_id)
+    ids = [make_deployment(cluster, priority=i % 2).id for i in range(5)]
+
+    pages, cursor = [], None
+    while True:
+        params = {"cluster_id": cluster.id, "limit": 2}
+        if cursor is not None:
+            params["cursor"] = cursor
+        response = client.get("/deployments/list", params=params, headers=auth)
+        assert response.status_code == 200
+        pages.append([d["id"] for d in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert pages == [ids[0:2], ids[2:4], ids[4:5]]
+    assert set(response.json()[0]) == {"id", "cluster_id", "docker_image", "ram_required", "cpu_required",
+                                       "gpu_required", "priority", "status"}
+    filtered = client.get("/deployments/list", params={"cluster_id": cluster.id, "status": "queued", "priority": 1},
+                          headers=auth)
+    assert [d["id"] for d in filtered.json()] == [ids[1], ids[3]]
+    assert client.get("/deployments/list", params={"cluster_id": cluster.id, "limit": 0},
+                      headers=auth).status_code == 422
+
+
+def test_list_pages_are_revalidated_with_etags(client, db, make_cluster, make_deployment, auth_headers):
+    cluster = make_cluster()
+    auth = auth_headers(cluster.organization_id)
+    ids = [make_deployment(cluster).id for _ in range(3)]
+    params = {"cluster_id": cluster.id, "limit": 2}
+
+    page = client.get("/deployments/list", params=params, headers=auth)
+    etag = page.headers["ETag"]
+    cached = client.get("/deployments/list", params=params, headers={**auth, "If-None-Match": f'W/{etag}, "x"'})
+    assert cached.status_code == 304
+    assert cached.headers["X-Next-Cursor"] == str(ids[1])
+    # A cached page is not handed to other organizations
+    assert client.get("/deployments/list", params=params,
+                      headers=auth_headers(cluster.organization_id + 1)).status_code == 404
+
+    assert client.post(f"/deployments/{ids[0]}/cancel", headers=auth).status_code == 200
+    page = client.get("/deployments/list", params=params, headers={**auth, "If-None-Match": etag})
+    assert page.status_code == 200
+    assert page.json()[0]["status"] == "cancelled"
+
+
+def test_list_streams_ndjson(client, make_cluster, make_deployment, auth_headers, monkeypatch):
+    import json
+
+    # Several batches, the last one full
+    monkeypatch.setattr("app.db.pagination.LIST_STREAM_BATCH", 2)
+    cluster = make_cluster()
+    ids = [make_deployment(cluster).id for _ in range(5)]
+
+    response = client.get("/deployments/list", params={"cluster_id": cluster.id, "stream": True, "cursor": ids[0]},
+                          headers=auth_headers(cluster.organization_id))
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["id"] for row in rows] == ids[1:]
+    assert rows[0]["status"] == "queued"
+
+    clusters = client.get("/clusters/list", params={"stream": True}, headers=auth_headers(cluster.organization_id))
+    assert [json.loads(line)["id"] for line in clusters.text.splitlines()] == [cluster.id]
+
+
+def test_timeline_follows_a_deployment_from_request_to_start(client, db, make_cluster, auth_headers,
+                                                             async_session_factory, drain_passes):
+    cluster = make_cluster(ram=1024)
+    auth = auth_headers(cluster.organization_id)
+    responses = [client.post("/deployments/create", headers={**auth, "X-Trace-Id": f"trace-{n}"}, json={
+        "cluster_id": cluster.id, "docker_image": "test:latest",
+        "ram_required": 1024, "cpu_required": 1, "gpu_required": 0, "priority": 1,
+    }) for n in range(2)]
+    assert responses[0].headers["X-Trace-Id"] == "trace-0"
+    first, second = (response.json()["deployment_id"] for response in responses)
+
+    # What the broker consumer does with the published messages
+    async def consume():
+        async with async_session_factory() as session:
+            for deployment_id in (first, second):
+                await scheduler.process_deployment(session, deployment_id, time.time())
+            await session.commit()
+    asyncio.get_event_loop().run_until_complete(consume())
+    drain_passes()
+    assert client.post(f"/deployments/{first}/complete", headers=auth).status_code == 200
+    drain_passes()
+
+    response = client.get(f"/deployments/{second}/timeline", headers=auth)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["trace_id"] == "trace-1"
+    assert [(e["stage"], e["reason"]) for e in body["events"]] == [
+        ("submitted", None), ("enqueued", None), ("dequeued", None),
+        ("rejected", "insufficient ram"), ("admitted", None),
+    ]
+    stages = [e["stage"] for e in client.get(f"/deployments/{first}/timeline", headers=auth).json()["events"]]
+    assert stages[-2:] == ["admitted", "finished"]
+
+    summary = client.get("/deployments/stages", params={"cluster_id": cluster.id}, headers=auth).json()
+    assert summary["deployments"] == 2
+    assert summary["stages"]["queue"]["count"] == 2
+    assert summary["stages"]["total"]["p95_ms"] >= summary["stages"]["total"]["p50_ms"]
+    assert summary["rejections"] == {"insufficient ram": 1}
+
+    other = auth_headers(cluster.organization_id + 1)
+    assert client.get(f"/deployments/{second}/timeline", headers=other).status_code == 404
+    assert client.get("/deployments/stages", params={"cluster_id": cluster.id}, headers=other).status_code == 404
+
+
+def test_status_stream_pushes_changes_and_resumes_after_last_event(client, db, make_cluster, submit, auth_headers,
+                                                                   drain_passes, monkeypatch):
+    cluster = make_cluster(ram=1024)
+    auth = auth_headers(cluster.organization_id)
+    loop = asyncio.get_event_loop()
+    # Small enough that a burst overflows it and is replayed from the database
+    monkeypatch.setattr(feed, "STATUS_FEED_BUFFER", 1)
+
+    def read(stream, count):
+        async def take():
+            messages = []
+            while len(messages) < count:
+                message = await asyncio.wait_for(stream.__anext__(), 5)
+                if message.startswith("id:"):
+                    lines = dict(line.split(": ", 1) for line in message.strip().split("\n"))
+                    messages.append((int(lines["id"]), lines["event"], json.loads(lines["data"])))
+            return messages
+        return loop.run_until_complete(take())
+
+    live = status_feed.stream(cluster_id=cluster.id)
+    assert loop.run_until_complete(live.__anext__()).startswith("retry:")
+    first = submit(cluster, ram=1024)
+    second = submit(cluster, ram=1024)
+    scheduler.run_scheduling_pass(db, cluster.id)
+    assert client.post(f"/deployments/{first}/complete", headers=auth).status_code == 200
+    drain_passes()
+
+    events = read(live, 5)
+    assert [(e["deployment_id"], e["status"]) for _, _, e in events] == [
+        (first, "queued"), (second, "queued"), (first, "running"), (first, "completed"), (second, "running"),
+    ]
+    ids = [event_id for event_id, _, _ in events]
+    assert ids == sorted(ids)
+
+    # A reconnecting client gets what came after the last event it saw
+    resumed = status_feed.stream(deployment_id=second, last_event_id=ids[1])
+    assert [(e["deployment_id"], e["status"]) for _, _, e in read(resumed, 1)] == [(second, "running")]
+    monkeypatch.setattr(feed, "STATUS_FEED_REPLAY_LIMIT", 2)
+    too_far = status_feed.stream(cluster_id=cluster.id, last_event_id=0)
+    assert read(too_far, 1)[0][1] == "reset"
+
+    for stream in (live, resumed, too_far):
+        loop.run_until_complete(stream.aclose())
+    assert status_feed.subscribers == 0
+
+    assert client.get("/deployments/events", params={"cluster_id": cluster.id},
+                      headers=auth_headers(cluster.organization_id + 1)).status_code == 404
+    assert client.get("/deployments/events", headers=auth).status_code == 422
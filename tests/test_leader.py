@@ -0,0 +1,66 @@
+import asyncio
+
+from app.scheduler import leader, scheduler, sharding
+from app.scheduler.models import SchedulerLease
+
+
+def test_lease_has_one_holder_until_it_expires(db):
+    assert leader.try_acquire(db, "scheduler:0", "a", ttl=10, now=100)
+    assert not leader.try_acquire(db, "scheduler:0", "b", ttl=10, now=105)
+    # Renewal by the holder pushes the expiry out
+    assert leader.try_acquire(db, "scheduler:0", "a", ttl=10, now=108)
+    assert not leader.try_acquire(db, "scheduler:0", "b", ttl=10, now=115)
+    assert leader.try_acquire(db, "scheduler:0", "b", ttl=10, now=119)
+    assert not leader.try_acquire(db, "scheduler:0", "a", ttl=10, now=120)
+
+    leader.release(db, "scheduler:0", "a")
+    assert not leader.try_acquire(db, "scheduler:0", "a", ttl=10, now=121)
+    leader.release(db, "scheduler:0", "b")
+    assert leader.try_acquire(db, "scheduler:0", "a", ttl=10, now=121)
+
+
+def test_standby_takes_over_and_steps_down_with_the_lease(db, monkeypatch, async_session_factory):
+    monkeypatch.setattr(leader, "AsyncSessionLocal", async_session_factory)
+    monkeypatch.setattr(leader, "SCHEDULER_LEASE_TTL", 0.3)
+    monkeypatch.setattr(sharding, "scheduling", False)
+    processors = []
+
+    async def processor():
+        processors.append("running")
+        try:
+            await asyncio.Future()
+        finally:
+            processors.append("stopped")
+    monkeypatch.setattr(scheduler, "run_deployment_processor", processor)
+
+    def steal(holder, expires_in):
+        db.query(SchedulerLease).update({SchedulerLease.holder: holder,
+                                         SchedulerLease.expires_at: leader.time.time() + expires_in})
+        db.commit()
+
+    async def run():
+        # Another process holds the lease and then dies without releasing it
+        assert leader.try_acquire(db, leader.lease_name(0), "other", ttl=0.3)
+        election = asyncio.create_task(leader.lead_scheduler())
+        await asyncio.sleep(0.15)
+        assert not sharding.scheduling and processors == []
+        await asyncio.sleep(0.4)
+        assert sharding.scheduling and processors == ["running"]
+
+        # Losing the lease stops scheduling here
+        steal("other", 60)
+        await asyncio.sleep(0.25)
+        assert not sharding.scheduling and processors == ["running", "stopped"]
+
+        steal("other", -1)
+        await asyncio.sleep(0.25)
+        assert sharding.scheduling
+        election.cancel()
+        await asyncio.gather(election, return_exceptions=True)
+
+    asyncio.run(run())
+    assert not sharding.scheduling
+    assert processors == ["running", "stopped", "running", "stopped"]
+    db.expire_all()
+    lease = db.get(SchedulerLease, leader.lease_name(0))
+    assert lease.holder == leader.HOLDER and lease.expires_at == 0.0
@@ -1,85 +1,56 @@
-import pytest
-from fastapi.testclient import TestClient
-from app.main import app
 from app.auth.models import Organization
 from app.clusters.models import Cluster
 from app.deployments.models import Deployment, DeploymentStatus
-from app.db.database import get_db, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from app.scheduler.engine import scheduler_engine
+from app.scheduler.scheduler import run_scheduling_pass
 
-# Set up a test database
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def _login(client, organization_name):
+    invite_code = client.post("/auth/create_organization/", params={"name": organization_name}).json()["invite_code"]
+    client.post("/auth/register", params={"username": f"user-{organization_name}", "password": "secret",
+                                          "invite_code": invite_code})
+    token = client.post("/auth/token", data={"username": f"user-{organization_name}",
+                                             "password": "secret"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
 
-# Override the dependency
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
-        yield db
-    finally:
-        db.close()
 
-
-app.dependency_overrides[get_db] = override_get_db
-
-client = TestClient(app)
-
-
-@pytest.fixture(scope="module")
-def test_db():
-    # Create tables
-    Base.metadata.create_all(bind=engine)
-    yield
-    # Drop tables
-    Base.metadata.drop_all(bind=engine)
-
-
-def test_create_organization(test_db):
-    response = client.post("/auth/create-organization/", json={"name": "Test Org"})
+def test_create_organization(client):
+    response = client.post("/auth/create_organization/", params={"name": "Test Org"})
     assert response.status_code == 200
     assert "invite_code" in response.json()
 
 
-def test_create_duplicate_organization(test_db):
-    client.post("/auth/create-organization/", json={"name": "Duplicate Org"})
-    response = client.post("/auth/create-organization/", json={"name": "Duplicate Org"})
+def test_create_duplicate_organization(client):
+    client.post("/auth/create_organization/", params={"name": "Duplicate Org"})
+    response = client.post("/auth/create_organization/", params={"name": "Duplicate Org"})
     assert response.status_code == 400
     assert "Organization with this name already exists" in response.json()["detail"]
 
 
-def test_create_cluster(test_db):
-    # First, create an organization
-    org_response = client.post("/auth/create-organization/", json={"name": "Org for Cluster"})
-    org_id = org_response.json()["id"]
+def test_create_cluster(client):
+    headers = _login(client, "Org for Cluster")
 
     cluster_data = {
         "name": "Test Cluster",
-        "organization_id": org_id,
         "total_ram": 1024,
         "total_cpu": 4,
         "total_gpu": 2
     }
-    response = client.post("/clusters/create", json=cluster_data)
+    response = client.post("/clusters/create", json=cluster_data, headers=headers)
     assert response.status_code == 200
     assert "cluster_id" in response.json()
 
 
-def test_create_deployment(test_db):
-    # Create an organization and a cluster first
-    org_response = client.post("/auth/create-organization/", json={"name": "Org for Deployment"})
-    org_id = org_response.json()["id"]
+def test_create_deployment(client):
+    headers = _login(client, "Org for Deployment")
 
     cluster_data = {
         "name": "Cluster for Deployment",
-        "organization_id": org_id,
         "total_ram": 1024,
         "total_cpu": 4,
         "total_gpu": 2
     }
-    cluster_response = client.post("/clusters/create", json=cluster_data)
+    cluster_response = client.post("/clusters/create", json=cluster_data, headers=headers)
     cluster_id = cluster_response.json()["cluster_id"]
 
     deployment_data = {
@@ -90,15 +61,12 @@ def test_create_deployment(test_db):
         "gpu_required": 1,
         "priority": 1
     }
-    response = client.post("/deployments/create", json=deployment_data)
+    response = client.post("/deployments/create", json=deployment_data, headers=headers)
     assert response.status_code == 200
     assert "deployment_id" in response.json()
 
 
-def test_process_deployment(test_db):
-    # This test will need to mock the RabbitMQ connection
-    # For simplicity, we'll just test the database operations
-    db = next(override_get_db())
+def test_process_deployment(db):
     org = Organization(name="Org for Processing")
     db.add(org)
     db.commit()
@@ -115,8 +83,8 @@ def test_process_deployment(test_db):
     db.add(deployment)
     db.commit()
 
-    from app.scheduler.scheduler import process_deployment
-    process_deployment(db, deployment.id)
+    scheduler_engine.enqueue(db, deployment)
+    run_scheduling_pass(db, cluster.id)
 
     updated_deployment = db.query(Deployment).filter(Deployment.id == deployment.id).first()
     assert updated_deployment.status == DeploymentStatus.RUNNING
@@ -127,8 +95,7 @@ def test_process_deployment(test_db):
     assert updated_cluster.available_gpu == 1
 
 
-def test_insufficient_resources(test_db):
-    db = next(override_get_db())
+def test_insufficient_resources(db):
     org = Organization(name="Org for Insufficient Resources")
     db.add(org)
     db.commit()
@@ -145,8 +112,8 @@ def test_insufficient_resources(test_db):
     db.add(deployment)
     db.commit()
 
-    from app.scheduler.scheduler import process_deployment
-    process_deployment(db, deployment.id)
+    scheduler_engine.enqueue(db, deployment)
+    run_scheduling_pass(db, cluster.id)
 
     updated_deployment = db.query(Deployment).filter(Deployment.id == deployment.id).first()
     assert updated_deployment.status == DeploymentStatus.QUEUED
@@ -0,0 +1,86 @@
+import pytest
+
+from app.metrics.registry import Counter, Gauge, Histogram, Metric, Registry
+from app.scheduler import scheduler
+
+
+def _sample(text, line_prefix):
+    for line in text.splitlines():
+        if line.startswith(line_prefix + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    requests = Counter("requests_total", "Requests.", ("route",), registry=registry)
+    latency = Histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0), registry=registry)
+    Gauge("queued", "Queued.", lambda: [((7,), 3)], ("cluster_id",), registry=registry)
+
+    child = requests.labels("/a")
+    child.inc()
+    child.inc(2)
+    assert requests.labels("/a") is child
+    for value in (0.05, 0.1, 0.5, 5):
+        latency.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{route="/a"} 3',
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 5.65",
+        "latency_seconds_count 4",
+        "# HELP queued Queued.",
+        "# TYPE queued gauge",
+        'queued{cluster_id="7"} 3',
+    ]
+
+
+def test_metric_kinds_must_implement_children_and_lines():
+    class Unrendered(Metric):
+        def _new_child(self):
+            return None
+
+    with pytest.raises(TypeError):
+        Unrendered("unrendered", "Never rendered.", registry=Registry())
+
+
+def test_metrics_endpoint_reports_requests_queries_and_scheduling(client, db, make_cluster, auth_headers,
+                                                                  drain_passes):
+    cluster = make_cluster(ram=1024)
+    auth = auth_headers(cluster.organization_id)
+    before = client.get("/metrics").text
+
+    ids = [client.post("/deployments/create", headers=auth, json={
+        "cluster_id": cluster.id, "docker_image": "test:latest",
+        "ram_required": 1024, "cpu_required": 1, "gpu_required": 0, "priority": 1,
+    }).json()["deployment_id"] for _ in range(2)]
+    scheduler.run_scheduling_pass(db, cluster.id)
+    assert client.post(f"/deployments/{ids[0]}/complete", headers=auth).status_code == 200
+    drain_passes()
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    after = response.text
+
+    route = 'http_request_duration_seconds_count{method="POST",route="/deployments/create"}'
+    assert _sample(after, route) - _sample(before, route) == 2
+    # Requests to unknown paths share one series instead of one per URL
+    client.get("/no/such/path/1")
+    client.get("/no/such/path/2")
+    assert _sample(client.get("/metrics").text, 'http_request_duration_seconds_count{method="",route="unmatched"}') >= 2
+
+    assert _sample(after, "db_query_duration_seconds_count") > _sample(before, "db_query_duration_seconds_count")
+    assert _sample(after, "deployment_time_to_schedule_seconds_count") - \
+        _sample(before, "deployment_time_to_schedule_seconds_count") == 2
+    assert _sample(after, "scheduler_pass_duration_seconds_count") > \
+        _sample(before, "scheduler_pass_duration_seconds_count")
+    assert _sample(after, f'scheduler_queued_deployments{{cluster_id="{cluster.id}"}}') == 0
+    assert _sample(after, f'scheduler_running_deployments{{cluster_id="{cluster.id}"}}') == 1
+    assert "password_hasher_workers" in after
@@ -0,0 +1,44 @@
+import os
+import tempfile
+
+from sqlalchemy import create_engine, inspect, text
+
+from app.db import migrations
+from app.db.database import Base
+
+
+def _indexes(engine, table):
+    return {index["name"] for index in inspect(engine).get_indexes(table)}
+
+
+def test_migrations_add_indexes_to_existing_databases_once():
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "old.db"))
+    Base.metadata.create_all(bind=engine)
+    # A database created before the indexes were declared
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_deployments_cluster_status_priority"))
+        connection.execute(text("DROP INDEX ix_clusters_organization_id"))
+
+    assert migrations.migrate(engine) == [1, 2, 3, 4]
+    assert "ix_deployments_cluster_status_priority" in _indexes(engine, "deployments")
+    assert "ix_clusters_organization_id" in _indexes(engine, "clusters")
+    assert migrations.migrate(engine) == []
+    assert migrations.applied_versions(engine) == [1, 2, 3, 4]
+
+
+def test_migrations_accept_databases_created_from_the_models():
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "new.db"))
+    Base.metadata.create_all(bind=engine)
+
+    assert migrations.migrate(engine) == [1, 2, 3, 4]
+    assert "ix_deployments_cluster_status_priority" in _indexes(engine, "deployments")
+
+
+def test_migrations_add_trace_id_column():
+    engine = create_engine("sqlite:///" + os.path.join(tempfile.mkdtemp(), "old.db"))
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE deployments DROP COLUMN trace_id"))
+
+    migrations.migrate(engine)
+    assert "trace_id" in {column["name"] for column in inspect(engine).get_columns("deployments")}
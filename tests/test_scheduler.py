@@ -0,0 +1,473 @@
+import asyncio
+
+import pytest
+
+from app.deployments.models import Deployment, DeploymentStatus
+from app.scheduler.broker import Broker
+from app.scheduler.engine import ClusterQueue, QueuedDeployment, scheduler_engine
+from app.scheduler import engine, scheduler
+from app.scheduler.scheduler import process_deployment, run_scheduling_pass
+
+
+def test_cluster_queue_orders_by_priority_then_submission():
+    queue = ClusterQueue(1, 100, 100, 100)
+    for deployment_id, priority in [(1, 1), (2, 5), (3, 5), (4, 3)]:
+        queue.push(QueuedDeployment(deployment_id, 1, priority, 1, 1, 0))
+
+    queue.remove(3)
+    queue.push(QueuedDeployment(4, 1, 9, 1, 1, 0))
+
+    assert [queue.pop().id for _ in range(len(queue))] == [4, 2, 1]
+    assert queue.pop() is None
+
+
+def test_aging_bounds_the_wait_behind_a_stream_of_higher_priority_work(monkeypatch):
+    monkeypatch.setattr(engine, "SCHEDULER_PRIORITY_AGING", 1.0)
+    queue = ClusterQueue(1, 100, 100, 100)
+    queue.push(QueuedDeployment(1, 1, 0, 1, 1, 0, queued_since=0.0))
+    # Priority 5 work arriving every minute; after five minutes the old deployment has caught up
+    for minute in range(1, 9):
+        queue.push(QueuedDeployment(minute + 1, 1, 5, 1, 1, 0, queued_since=minute * 60.0))
+    assert [queue.pop().id for _ in range(len(queue))] == [2, 3, 4, 5, 1, 6, 7, 8, 9]
+
+    monkeypatch.setattr(engine, "SCHEDULER_PRIORITY_AGING", 0.0)
+    queue = ClusterQueue(1, 100, 100, 100)
+    queue.push(QueuedDeployment(1, 1, 0, 1, 1, 0, queued_since=0.0))
+    queue.push(QueuedDeployment(2, 1, 5, 1, 1, 0, queued_since=3600.0))
+    assert [queue.pop().id for _ in range(len(queue))] == [2, 1]
+
+
+def test_scheduling_pass_admits_in_priority_order(db, make_cluster, make_deployment):
+    cluster = make_cluster()
+    low = make_deployment(cluster, priority=1)
+    high = make_deployment(cluster, priority=5)
+    medium = make_deployment(cluster, priority=3)
+    later = make_deployment(cluster, ram=1, cpu=0, gpu=0, priority=0)
+
+    admitted = run_scheduling_pass(db, cluster.id)
+
+    assert [d.id for d in admitted] == [high.id, medium.id]
+    db.expire_all()
+    assert high.status == DeploymentStatus.RUNNING
+    assert medium.status == DeploymentStatus.RUNNING
+    assert low.status == DeploymentStatus.QUEUED
+    assert later.status == DeploymentStatus.QUEUED
+    assert (cluster.available_ram, cluster.available_cpu, cluster.available_gpu) == (0, 0, 0)
+
+
+def test_scheduling_pass_skips_deployments_that_left_the_queue(db, make_cluster, make_deployment):
+    cluster = make_cluster()
+    deployment = make_deployment(cluster)
+    scheduler_engine.queue_for(db, cluster.id)
+    deployment.status = DeploymentStatus.FAILED
+    db.commit()
+
+    assert run_scheduling_pass(db, cluster.id) == []
+    db.refresh(cluster)
+    assert cluster.available_ram == 1024
+    assert scheduler_engine.clusters[cluster.id].available_ram == 1024
+
+
+def test_burst_of_submissions_is_coalesced(db, monkeypatch, make_cluster, make_deployment, async_session_factory):
+    cluster = make_cluster(ram=100, cpu=100, gpu=0)
+    deployments = [make_deployment(cluster, ram=1, cpu=1, gpu=0) for _ in range(50)]
+    passes = []
+    original = scheduler.run_scheduling_pass
+
+    def counting_pass(session, cluster_id):
+        passes.append(cluster_id)
+        return original(session, cluster_id)
+
+    monkeypatch.setattr(scheduler, "run_scheduling_pass", counting_pass)
+    # Each submission now awaits a real query; keep the whole burst inside one window
+    monkeypatch.setattr(scheduler, "SCHEDULER_COALESCE_DELAY", 0.2)
+
+    async def submit_all():
+        async with async_session_factory() as session:
+            for deployment in deployments:
+                await process_deployment(session, deployment.id)
+        while scheduler._pass_tasks:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(submit_all())
+
+    assert len(passes) == 1
+    db.expire_all()
+    assert all(d.status == DeploymentStatus.RUNNING for d in deployments)
+    assert cluster.available_ram == 50
+
+
+def test_publisher_buffers_without_waiting_for_the_broker(monkeypatch):
+    from app.scheduler import broker
+
+    async def unreachable_broker():
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(broker, "connect_rabbitmq", unreachable_broker)
+    publisher = broker.AmqpBroker(max_pending=2)
+
+    async def publish_three():
+        publisher.publish({"deployment_id": 1})
+        publisher.publish({"deployment_id": 2})
+        assert publisher.pending == 2
+        with pytest.raises(asyncio.QueueFull):
+            publisher.publish({"deployment_id": 3})
+        await publisher.close()
+
+    asyncio.run(publish_three())
+
+
+def test_in_memory_broker_drives_the_scheduler(db, monkeypatch, make_cluster, make_deployment,
+                                               async_session_factory):
+    from app.scheduler.broker import InMemoryBroker
+
+    cluster = make_cluster()
+    deployments = [make_deployment(cluster, priority=p) for p in (1, 2, 3)]
+    memory_broker = InMemoryBroker()
+    monkeypatch.setattr(scheduler, "deployment_broker", memory_broker)
+
+    async def run():
+        processor = asyncio.create_task(scheduler.run_deployment_processor())
+        for deployment in deployments:
+            await scheduler.schedule_deployment(deployment.id, cluster.id)
+        await memory_broker._queue.join()
+        while scheduler._pass_tasks:
+            await asyncio.sleep(0.01)
+        processor.cancel()
+
+    asyncio.run(run())
+
+    db.expire_all()
+    assert [d.status for d in deployments] == [DeploymentStatus.QUEUED, DeploymentStatus.RUNNING,
+                                               DeploymentStatus.RUNNING]
+
+
+def test_placement_prefers_tightest_fit(db, make_cluster):
+    small = make_cluster(ram=600, cpu=2, gpu=1)
+    org = small.organization
+    large = make_cluster(ram=4096, cpu=16, gpu=8, org=org)
+    tiny = make_cluster(ram=256, cpu=1, gpu=0, org=org)
+
+    assert scheduler_engine.place(db, org.id, 512, 2, 1).cluster_id == small.id
+    assert scheduler_engine.place(db, org.id, 128, 1, 0).cluster_id == tiny.id
+    assert scheduler_engine.place(db, org.id, 2048, 4, 2).cluster_id == large.id
+    assert scheduler_engine.place(db, org.id, 8192, 1, 0) is None
+
+
+def test_placement_walk_is_bounded_by_clusters_visited(db, monkeypatch, make_cluster):
+    from app.scheduler import placement
+
+    # Tightest on RAM but out of CPU, so the walk over the RAM list passes it first
+    short = make_cluster(ram=600, cpu=0, gpu=0)
+    org = short.organization
+    roomy = make_cluster(ram=4096, cpu=4, gpu=0, org=org)
+    make_cluster(ram=128, cpu=4, gpu=0, org=org)
+    make_cluster(ram=128, cpu=4, gpu=0, org=org)
+    index = scheduler_engine.organization(db, org.id)
+
+    assert [queue.cluster_id for queue in index.candidates(512, 1, 0)] == [roomy.id]
+    monkeypatch.setattr(placement, "PLACEMENT_SCAN_LIMIT", 1)
+    assert list(index.candidates(512, 1, 0)) == []
+    # Past the limit it queues on the shortest backlog that can ever fit
+    assert index.choose(512, 1, 0).cluster_id == roomy.id
+
+
+def test_placement_counts_queued_demand(db, make_cluster, make_deployment):
+    first = make_cluster(ram=1024, cpu=4, gpu=0)
+    org = first.organization
+    second = make_cluster(ram=2048, cpu=4, gpu=0, org=org)
+
+    assert scheduler_engine.place(db, org.id, 1024, 4, 0).cluster_id == first.id
+    make_deployment(first, ram=1024, cpu=4, gpu=0)
+    scheduler_engine.enqueue(db, db.query(Deployment).one())
+
+    assert scheduler_engine.place(db, org.id, 1024, 4, 0).cluster_id == second.id
+    make_deployment(second, ram=1024, cpu=4, gpu=0)
+    scheduler_engine.enqueue(db, db.query(Deployment).filter(Deployment.cluster_id == second.id).one())
+    # Nowhere to start immediately: fall back to the shortest queue that can ever fit
+    assert scheduler_engine.place(db, org.id, 2048, 4, 0).cluster_id == second.id
+
+
+def test_preemption_evicts_cheapest_lower_priority_set(db, monkeypatch, make_cluster, make_deployment):
+    from app.scheduler.models import Preemption
+
+    monkeypatch.setattr(scheduler, "SCHEDULER_PREEMPTION", True)
+    cluster = make_cluster(ram=1000, cpu=10, gpu=0)
+    big_low = make_deployment(cluster, ram=600, cpu=1, gpu=0, priority=1)
+    small_low = make_deployment(cluster, ram=200, cpu=1, gpu=0, priority=1)
+    mid = make_deployment(cluster, ram=200, cpu=1, gpu=0, priority=4)
+    run_scheduling_pass(db, cluster.id)
+
+    urgent = make_deployment(cluster, ram=500, cpu=1, gpu=0, priority=9)
+    scheduler_engine.enqueue(db, urgent)
+    admitted = run_scheduling_pass(db, cluster.id)
+
+    assert [d.id for d in admitted] == [urgent.id]
+    db.expire_all()
+    assert big_low.status == DeploymentStatus.QUEUED
+    assert small_low.status == DeploymentStatus.RUNNING
+    assert mid.status == DeploymentStatus.RUNNING
+    assert cluster.available_ram == 100
+    audit = db.query(Preemption).one()
+    assert (audit.deployment_id, audit.preempted_by_id) == (big_low.id, urgent.id)
+
+
+def test_preemption_never_evicts_equal_or_higher_priority(db, monkeypatch, make_cluster, make_deployment):
+    monkeypatch.setattr(scheduler, "SCHEDULER_PREEMPTION", True)
+    cluster = make_cluster(ram=1000, cpu=10, gpu=0)
+    running = make_deployment(cluster, ram=800, cpu=1, gpu=0, priority=5)
+    run_scheduling_pass(db, cluster.id)
+
+    waiting = make_deployment(cluster, ram=500, cpu=1, gpu=0, priority=5)
+    scheduler_engine.enqueue(db, waiting)
+
+    assert run_scheduling_pass(db, cluster.id) == []
+    db.expire_all()
+    assert running.status == DeploymentStatus.RUNNING
+    assert waiting.status == DeploymentStatus.QUEUED
+
+
+def test_full_publish_backlog_wakes_the_cluster(db, monkeypatch, make_cluster, make_deployment,
+                                                async_session_factory):
+    from app.scheduler.broker import InMemoryBroker
+
+    cluster = make_cluster()
+    deployment = make_deployment(cluster)
+    scheduler_engine.enqueue(db, deployment)
+
+    async def run():
+        full = InMemoryBroker(max_pending=1)
+        full.publish({"deployment_id": 0})
+        monkeypatch.setattr(scheduler, "deployment_broker", full)
+        await scheduler.schedule_deployment(deployment.id, cluster.id)
+        while scheduler._pass_tasks:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+
+    db.expire_all()
+    assert deployment.status == DeploymentStatus.RUNNING
+
+
+def test_broker_backends_must_implement_the_interface():
+    from app.scheduler.broker import Broker
+
+    class PublishOnly(Broker):
+        def publish(self, payload):
+            pass
+
+    with pytest.raises(TypeError):
+        PublishOnly()
+
+
+def test_unknown_placement_policy_is_rejected():
+    from app.scheduler.placement import PlacementIndex
+
+    with pytest.raises(ValueError):
+        PlacementIndex().choose(1, 1, 0, policy="bestfit")
+
+
+def test_preemption_skips_head_that_left_the_queue(db, monkeypatch, make_cluster, make_deployment):
+    from app.scheduler.models import Preemption
+
+    monkeypatch.setattr(scheduler, "SCHEDULER_PREEMPTION", True)
+    cluster = make_cluster(ram=1000, cpu=10, gpu=0)
+    low = make_deployment(cluster, ram=800, cpu=1, gpu=0, priority=1)
+    run_scheduling_pass(db, cluster.id)
+
+    urgent = make_deployment(cluster, ram=500, cpu=1, gpu=0, priority=9)
+    scheduler_engine.enqueue(db, urgent)
+    urgent.status = DeploymentStatus.CANCELLED
+    db.commit()
+
+    assert run_scheduling_pass(db, cluster.id) == []
+    db.expire_all()
+    assert low.status == DeploymentStatus.RUNNING
+    assert db.query(Preemption).count() == 0
+    assert cluster.available_ram == 200
+
+
+def test_pass_never_takes_more_than_the_database_has(db, make_cluster, make_deployment, async_session_factory,
+                                                     drain_passes):
+    from app.clusters.models import Cluster
+
+    cluster = make_cluster(ram=1024, cpu=4, gpu=0)
+    first = make_deployment(cluster, ram=256, cpu=1, gpu=0, priority=2)
+    second = make_deployment(cluster, ram=256, cpu=1, gpu=0, priority=1)
+    scheduler_engine.queue_for(db, cluster.id)
+    # Another worker took most of the cluster behind this worker's back
+    db.query(Cluster).filter(Cluster.id == cluster.id).update({Cluster.available_ram: 256})
+    db.commit()
+
+    with pytest.raises(scheduler.CapacityConflict):
+        run_scheduling_pass(db, cluster.id)
+    db.expire_all()
+    assert cluster.available_ram == 256
+    assert first.status == second.status == DeploymentStatus.QUEUED
+
+    # Make the engine stale again; a woken pass hits the conflict, reloads the cluster and admits what fits
+    scheduler_engine.forget(cluster.id)
+    scheduler_engine.queue_for(db, cluster.id).set_available(1024, 4, 0)
+    loop = asyncio.new_event_loop()
+    loop.call_soon(scheduler.wake_cluster, cluster.id)
+    drain_passes(loop)
+    loop.close()
+
+    db.expire_all()
+    assert cluster.available_ram == 0
+    assert (first.status, second.status) == (DeploymentStatus.RUNNING, DeploymentStatus.QUEUED)
+
+
+class RecordingBroker(Broker):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, payload, shard=0):
+        self.published.append((shard, payload))
+
+    async def consume(self, handler, shard=0):
+        pass
+
+    async def ack(self, message):
+        pass
+
+    async def nack(self, message, requeue=True):
+        pass
+
+
+def test_other_workers_clusters_are_forwarded_to_their_owner(db, monkeypatch, make_cluster, make_deployment,
+                                                             async_session_factory):
+    from app.scheduler import broker, sharding
+
+    monkeypatch.setattr(sharding, "SCHEDULER_WORKERS", 2)
+    monkeypatch.setattr(sharding, "SCHEDULER_WORKER_ID", 0)
+    recording = RecordingBroker()
+    monkeypatch.setattr(scheduler, "deployment_broker", recording)
+    cluster = make_cluster()
+    if sharding.owns_cluster(cluster.id):
+        cluster = make_cluster()
+    deployment = make_deployment(cluster)
+
+    async def run():
+        scheduler.wake_cluster(cluster.id)
+        await scheduler.schedule_deployment(deployment.id, cluster.id)
+        async with async_session_factory() as session:
+            await process_deployment(session, deployment.id)
+
+    asyncio.run(run())
+
+    assert scheduler._pass_tasks == {}
+    # Submissions also carry their trace id and publish time
+    assert "published_at" in recording.published[1][1]
+    assert [(shard, {key: payload[key] for key in ("cluster_id", "deployment_ids")})
+            for shard, payload in recording.published] == [
+        (1, {"cluster_id": cluster.id, "deployment_ids": []}),
+        (1, {"cluster_id": cluster.id, "deployment_ids": [deployment.id]}),
+        (1, {"cluster_id": cluster.id, "deployment_ids": [deployment.id]}),
+    ]
+    assert broker.AmqpBroker().shard_queue(1) == "deployment_queue.1"
+    with pytest.raises(ValueError):
+        broker.create_broker("memory")
+
+
+def test_owner_releases_deployments_finished_by_another_worker(db, make_cluster, make_deployment,
+                                                               async_session_factory, drain_passes):
+    cluster = make_cluster()
+    deployment = make_deployment(cluster, ram=1024)
+    run_scheduling_pass(db, cluster.id)
+    assert scheduler_engine.clusters[cluster.id].available_ram == 0
+
+    # Completed through an API process that does not own the cluster
+    deployment.status = DeploymentStatus.COMPLETED
+    db.commit()
+
+    async def run():
+        async with async_session_factory() as session:
+            await process_deployment(session, deployment.id)
+        while scheduler._pass_tasks:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert scheduler_engine.clusters[cluster.id].available_ram == 1024
+    assert deployment.id not in scheduler_engine.clusters[cluster.id].running
+
+
+def test_consumer_does_not_requeue_a_deployment_started_while_it_was_read(db, monkeypatch, make_cluster,
+                                                                          make_deployment, async_session_factory):
+    cluster = make_cluster()
+    deployment = make_deployment(cluster, ram=512)
+    queue = scheduler_engine.queue_for(db, cluster.id)
+    queue_for = scheduler_engine.queue_for
+    started = []
+
+    def pass_then_queue_for(session, cluster_id):
+        # The consumer has read the deployment as queued; a pass starts it before the consumer pushes it
+        monkeypatch.setattr(scheduler_engine, "queue_for", queue_for)
+        started.extend(run_scheduling_pass(db, cluster_id))
+        return queue_for(session, cluster_id)
+
+    monkeypatch.setattr(scheduler_engine, "queue_for", pass_then_queue_for)
+
+    async def run():
+        async with async_session_factory() as session:
+            await process_deployment(session, deployment.id)
+        while scheduler._pass_tasks:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+
+    assert [d.id for d in started] == [deployment.id]
+    assert deployment.id not in queue
+    assert deployment.id in queue.running
+    assert queue.available_ram == 512
+    # Tracking it again replaces its place in the eviction order
+    queue.track_running(queue.running[deployment.id])
+    queue.stop(deployment.id)
+    assert queue.available_ram == 1024
+    assert queue.select_victims(QueuedDeployment(0, cluster.id, 9, 2048, 0, 0)) is None
+
+
+def test_placement_rereads_clusters_owned_by_other_workers(db, monkeypatch, make_cluster):
+    from app.clusters.models import Cluster
+    from app.scheduler import sharding
+
+    monkeypatch.setattr(sharding, "SCHEDULER_WORKERS", 2)
+    monkeypatch.setattr(sharding, "SCHEDULER_WORKER_ID", 0)
+    monkeypatch.setattr(sharding, "SCHEDULER_REMOTE_REFRESH", 0)
+    first = make_cluster(ram=1024, cpu=4, gpu=0)
+    second = make_cluster(ram=1024, cpu=4, gpu=0, org=first.organization)
+    remote = first if not sharding.owns_cluster(first.id) else second
+    local = second if remote is first else first
+    db.query(Cluster).filter(Cluster.id == local.id).update({Cluster.available_ram: 512})
+    db.commit()
+
+    assert scheduler_engine.place(db, remote.organization_id, 512, 1, 0).cluster_id == local.id
+    # The other worker fills its cluster; this worker only learns of it from the database
+    db.query(Cluster).filter(Cluster.id == remote.id).update({Cluster.available_ram: 256})
+    db.commit()
+    scheduler_engine.place(db, remote.organization_id, 384, 1, 0)
+    assert scheduler_engine.clusters[remote.id].available_ram == 256
+    assert scheduler_engine.clusters[local.id].available_ram == 512
+
+
+def test_preemption_evicts_a_group_whole(db, monkeypatch, make_cluster, make_deployment):
+    monkeypatch.setattr(scheduler, "SCHEDULER_PREEMPTION", True)
+    cluster = make_cluster(ram=1000, cpu=10, gpu=0)
+    members = [make_deployment(cluster, ram=300, cpu=1, gpu=0, priority=1, group_id="job") for _ in range(2)]
+    single = make_deployment(cluster, ram=300, cpu=1, gpu=0, priority=2)
+    assert len(run_scheduling_pass(db, cluster.id)) == 3
+
+    urgent = make_deployment(cluster, ram=200, cpu=1, gpu=0, priority=9)
+    scheduler_engine.enqueue(db, urgent)
+    assert [d.id for d in run_scheduling_pass(db, cluster.id)] == [urgent.id]
+
+    # One replica would have made room, but half a group is of no use running
+    db.expire_all()
+    assert {m.status for m in members} == {DeploymentStatus.QUEUED}
+    # Queued again from the eviction, which is where aging starts over
+    assert all(m.queued_since is not None for m in members)
+    assert single.status == DeploymentStatus.RUNNING
+    assert cluster.available_ram == 500
+    # Back in the queue the group needs 600 again and does not start in part
+    assert run_scheduling_pass(db, cluster.id) == []
+    assert [d.id for d in scheduler_engine.clusters[cluster.id].group(members[1])] == [members[1].id, members[0].id]